@@ -194,7 +194,7 @@ class AlphaBase {
     /**
      * Query data with filters
      * @param {string} collection 
-     * @param {Object} options - { where: 'field==value', orderBy: 'field', limit: 10 }
+     * @param {Object} options - { where: 'field==value', orderBy: 'field' (or '-field' for descending), limit: 10 }
      * @returns {Promise<Object>}
      */
     async query(collection, options = {}) {
@@ -206,6 +206,7 @@ class AlphaBase {
             const params = new URLSearchParams();
             if (options.where) params.append('where', options.where);
             if (options.orderBy) params.append('orderBy', options.orderBy);
+            if (options.orderDirection) params.append('orderDirection', options.orderDirection);
             if (options.limit) params.append('limit', options.limit);
 
             const response = await fetch(`${this.baseURL}/data/query/${collection}?${params}`, {
@@ -4,6 +4,8 @@ const api = {
     baseURL: 'http://localhost:8000',
     authToken: null,
     currentUsername: null,
+    snapshot: null,
+    maxGetMany: 500,  // MAX_GET_MANY on the server
 
     // Login to AlphaBase
     async login(username, password) {
@@ -31,60 +33,38 @@ const api = {
         }
     },
 
-    // Fetch all accessible collections (auto-discovery)
+    // Fetch all accessible collections in one snapshot request
     async fetchAllCollections() {
         const collections = {};
 
         try {
-            // Get list of all collections from server
-            const response = await fetch(`${this.baseURL}/data/collections`, {
-                headers: {
-                    'Authorization': `Bearer ${this.authToken}`
-                }
-            });
+            const headers = {
+                'Authorization': `Bearer ${this.authToken}`
+            };
+            // Only the same user's snapshot may be revalidated
+            if (this.snapshot && this.snapshot.username === this.currentUsername) {
+                headers['If-None-Match'] = this.snapshot.etag;
+            }
 
-            // Option 2: Try common collection names + any we find
-            const knownCollections = [
-                'sensors', 'devices', 'my_collection', 'presses', 'todos',
-                'users', 'products', 'orders', 'customers', 'inventory',
-                'tasks', 'notes', 'messages', 'notifications', 'settings',
-                'logs', 'events', 'analytics', 'files', 'uploads',
-                // ESP32 related collections
-                'esp32', 'esp32_sensors', 'esp32_data', 'esp32_logs',
-                'iot_devices', 'iot_sensors', 'microcontroller', 'arduino',
-                'sensor_data', 'device_data', 'telemetry', 'iot_telemetry'
-            ];
+            const response = await fetch(`${this.baseURL}/data/snapshot`, { headers });
 
-            let availableCollections = [];
+            if (response.status === 304) {
+                // Nothing changed since the last refresh
+                return this.snapshot.collections;
+            }
 
             if (response.ok) {
                 const result = await response.json();
-                if (result.success && result.collections.length > 0) {
-                    availableCollections = result.collections;
-                }
-            }
-
-            // Combine server collections with known collections
-            const allCollectionsToTry = [...new Set([...availableCollections, ...knownCollections])];
 
-            // Fetch data from each collection
-            for (const collectionName of allCollectionsToTry) {
-                try {
-                    const dataResponse = await fetch(`${this.baseURL}/data/list/${collectionName}`, {
-                        headers: {
-                            'Authorization': `Bearer ${this.authToken}`
+                if (result.success) {
+                    Object.entries(result.collections).forEach(([collectionName, items]) => {
+                        if (Object.keys(items).length > 0) {
+                            collections[collectionName] = items;
                         }
                     });
 
-                    if (dataResponse.ok) {
-                        const dataResult = await dataResponse.json();
-
-                        if (dataResult.success && Object.keys(dataResult.items).length > 0) {
-                            collections[collectionName] = dataResult.items;
-                        }
-                    }
-                } catch (error) {
-                    console.log(`⏭️ Skipping ${collectionName}: ${error.message}`);
+                    const etag = response.headers.get('ETag');
+                    this.snapshot = etag ? { etag, username: this.currentUsername, collections } : null;
                 }
             }
         } catch (error) {
@@ -94,6 +74,72 @@ const api = {
         return collections;
     },
 
+    // Patch the cached snapshot with changes ({collection: {key: action}}),
+    // fetching only the updated documents; null when a full reload is needed
+    async applyChanges(changes) {
+        if (!this.snapshot || this.snapshot.username !== this.currentUsername) {
+            return null;
+        }
+        const collections = this.snapshot.collections;
+        const removeItem = (collection, key) => {
+            if (collections[collection]) {
+                delete collections[collection][key];
+                if (Object.keys(collections[collection]).length === 0) {
+                    delete collections[collection];
+                }
+            }
+        };
+
+        const refs = [];
+        Object.entries(changes).forEach(([collection, keys]) => {
+            Object.entries(keys).forEach(([key, action]) => {
+                if (action === 'delete') {
+                    removeItem(collection, key);
+                } else {
+                    refs.push({ collection, key });
+                }
+            });
+        });
+        if (refs.length === 0) {
+            return collections;
+        }
+        if (refs.length > this.maxGetMany) {
+            return null;
+        }
+
+        const result = await this.getMany(refs);
+        if (!result.success) {
+            return null;
+        }
+        result.items.forEach(item => {
+            collections[item.collection] = collections[item.collection] || {};
+            collections[item.collection][item.key] = item.data;
+        });
+        // Deleted again since, or no longer readable
+        [...result.missing, ...result.denied].forEach(ref => removeItem(ref.collection, ref.key));
+        return collections;
+    },
+
+    // Get several documents, from any collections, in one request
+    async getMany(refs) {
+        try {
+            const response = await fetch(`${this.baseURL}/data/getMany`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Authorization': `Bearer ${this.authToken}`
+                },
+                body: JSON.stringify({ items: refs })
+            });
+
+            const result = await response.json();
+            return result;
+        } catch (error) {
+            console.error('Get many error:', error);
+            return { success: false, error: error.message };
+        }
+    },
+
     // Get specific data
     async getData(collection, key) {
         try {
@@ -0,0 +1,111 @@
+# auth_cache.py
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Set
+
+class AuthCache:
+    """Bounded LRU of verified tokens: decoded claims plus the user record, until the token expires"""
+    
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 300):
+        self.max_entries = max_entries
+        # Upper bound on how long an entry is trusted, even if the token lives longer
+        self.ttl_seconds = ttl_seconds
+        
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.by_user: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+        
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evictions": 0,
+            "invalidations": 0
+        }
+    
+    @staticmethod
+    def digest(token: str) -> str:
+        """Cache key; the raw token is never stored"""
+        return hashlib.sha256(token.encode()).hexdigest()
+    
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        """Cached entry ({"claims", "user"}) for a token, or None"""
+        key = self.digest(token)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if time.time() >= entry["expires_at"]:
+                self._remove(key)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+    
+    def put(self, token: str, claims: Dict[str, Any]):
+        """Remember a token's decoded claims until it (or the TTL) expires"""
+        key = self.digest(token)
+        expires_at = time.time() + self.ttl_seconds
+        if claims.get("exp"):
+            expires_at = min(expires_at, float(claims["exp"]))
+        username = claims.get("sub")
+        
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = {"claims": claims, "user": None, "expires_at": expires_at}
+            self.by_user.setdefault(username, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.stats["evictions"] += 1
+    
+    def get_user(self, token: str) -> Optional[Dict[str, Any]]:
+        """User record attached to a cached token (the token itself was checked by get())"""
+        with self._lock:
+            entry = self.entries.get(self.digest(token))
+            return entry["user"] if entry else None
+    
+    def set_user(self, token: str, user: Dict[str, Any]):
+        """Attach the user record to a cached token"""
+        with self._lock:
+            entry = self.entries.get(self.digest(token))
+            if entry is not None:
+                entry["user"] = user
+    
+    def invalidate_user(self, username: str):
+        """Forget every cached token of a user (call whenever the user changes)"""
+        with self._lock:
+            keys = self.by_user.pop(username, set())
+            for key in keys:
+                self.entries.pop(key, None)
+            self.stats["invalidations"] += len(keys)
+    
+    def _remove(self, key: str):
+        entry = self.entries.pop(key)
+        username = entry["claims"].get("sub")
+        keys = self.by_user.get(username)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_user[username]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self.entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats.update({
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hit_rate": round(stats["hits"] / lookups, 3) if lookups else 0.0
+        })
+        return stats
+
+# Create global instance
+auth_cache = AuthCache()
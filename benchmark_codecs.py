@@ -0,0 +1,87 @@
+# benchmark_codecs.py - Parse throughput of JSON vs MessagePack vs CBOR sensor payloads
+# Usage: python benchmark_codecs.py --messages 50000 --fields 8
+#
+# Encodes a batch of ESP32-style readings in each format, then times decoding
+# them with the raw library and through payload_codecs (the layer MQTT and
+# /data/set use, including format sniffing and type checks). No server needed.
+# Formats whose package is not installed are skipped.
+import argparse
+import json
+import random
+import time
+
+from payload_codecs import payload_codecs, msgpack, cbor2
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def make_readings(count: int, fields: int, seed: int = 1):
+    rng = random.Random(seed)
+    readings = []
+    for n in range(count):
+        reading = {"device_id": f"esp32-{n % 64:02d}", "ts": 1700000000000 + n * 250, "status": "ok"}
+        for field in range(fields):
+            reading[f"f{field}"] = round(rng.uniform(-50, 150), 2)
+        readings.append(reading)
+    return readings
+
+def measure(decode, payloads, repeat: int) -> float:
+    """Best-of-repeat messages per second"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for payload in payloads:
+            decode(payload)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(payloads) / best if best else 0.0
+
+def run(args):
+    readings = make_readings(args.messages, args.fields)
+    
+    encoders = {"json": lambda value: json.dumps(value).encode()}
+    if msgpack is not None:
+        encoders["msgpack"] = msgpack.packb
+    if cbor2 is not None:
+        encoders["cbor"] = cbor2.dumps
+    
+    # (name, encoding, decode function)
+    decoders = [("json", "json", json.loads)]
+    if orjson is not None:
+        decoders.append(("orjson", "json", orjson.loads))
+    if msgpack is not None:
+        decoders.append(("msgpack", "msgpack", lambda data: msgpack.unpackb(data, raw=False)))
+    if cbor2 is not None:
+        decoders.append(("cbor2", "cbor", cbor2.loads))
+    for codec in encoders:
+        decoders.append((f"layer {codec}", codec, lambda data, codec=codec: payload_codecs.decode_document(data, codec)))
+        decoders.append((f"layer auto/{codec}", codec, payload_codecs.decode_document))
+    
+    encoded = {codec: [encode(reading) for reading in readings] for codec, encode in encoders.items()}
+    baseline = None
+    
+    print(f"{args.messages} messages, {args.fields} numeric fields, best of {args.repeat}")
+    print(f"{'format':<10} {'avg bytes':>10}")
+    for codec, payloads in encoded.items():
+        print(f"{codec:<10} {sum(len(payload) for payload in payloads) / len(payloads):>10.1f}")
+    print()
+    print(f"{'decoder':<20} {'msg/s':>12} {'MB/s':>8} {'vs json':>8}")
+    for name, codec, decode in decoders:
+        payloads = encoded[codec]
+        rate = measure(decode, payloads, args.repeat)
+        baseline = baseline or rate
+        megabytes = rate * sum(len(payload) for payload in payloads) / len(payloads) / 1e6
+        print(f"{name:<20} {rate:>12,.0f} {megabytes:>8.1f} {rate / baseline:>7.2f}x")
+    
+    skipped = [name for name, module in (("msgpack", msgpack), ("cbor", cbor2), ("orjson", orjson)) if module is None]
+    if skipped:
+        print(f"\nSkipped (not installed): {', '.join(skipped)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Payload parse throughput benchmark")
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--fields", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    run(parser.parse_args())
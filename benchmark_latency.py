@@ -0,0 +1,132 @@
+# benchmark_latency.py - Mixed read/write latency against a running AlphaBase server
+# Usage: python benchmark_latency.py --url http://localhost:8000 --clients 32 --duration 20
+#
+# Each client thread loops over a mix of /data/set, /data/get, /data/list and
+# /data/query calls. A separate probe hits GET / (no database work) to show how
+# long requests wait for the event loop while the database is busy.
+# Run it once per server build (e.g. before and after a change) and compare p99.
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class Client:
+    """One keep-alive HTTP connection"""
+    
+    def __init__(self, url: str, token: str = None):
+        parsed = urlparse(url)
+        self.connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=60)
+        self.headers = {"Content-Type": "application/json"}
+        if token:
+            self.headers["Authorization"] = f"Bearer {token}"
+    
+    def request(self, method: str, path: str, body: dict = None):
+        payload = json.dumps(body) if body is not None else None
+        self.connection.request(method, path, body=payload, headers=self.headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        return response.status, data
+
+def login(url: str, username: str, password: str) -> str:
+    client = Client(url)
+    client.request("POST", "/auth/register", {
+        "username": username, "email": f"{username}@example.com", "password": password
+    })
+    status, data = client.request("POST", "/auth/login", {"username": username, "password": password})
+    if status != 200:
+        raise SystemExit(f"Login failed ({status}): {data[:200]}")
+    return json.loads(data)["access_token"]
+
+def run(args):
+    token = login(args.url, args.username, args.password)
+    collection = args.collection
+    
+    # Seed some rows so reads have something to return
+    seed = Client(args.url, token)
+    for key in range(args.keys):
+        seed.request("POST", "/data/set", {"collection": collection, "key": f"k{key}",
+                                            "value": {"n": key, "status": "idle"}})
+    
+    samples = {}
+    errors = {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    
+    def record(name, started, status):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with lock:
+            samples.setdefault(name, []).append(elapsed_ms)
+            if status >= 400:
+                errors[name] = errors.get(name, 0) + 1
+    
+    def worker(seed_value):
+        rng = random.Random(seed_value)
+        client = Client(args.url, token)
+        while time.monotonic() < deadline:
+            key = f"k{rng.randrange(args.keys)}"
+            started = time.perf_counter()
+            if rng.random() < args.write_ratio:
+                status, _ = client.request("POST", "/data/set", {"collection": collection, "key": key,
+                                                                 "value": {"n": rng.randrange(1000), "status": "run"}})
+                record("set", started, status)
+                continue
+            choice = rng.random()
+            if choice < 0.6:
+                status, _ = client.request("GET", f"/data/get/{collection}/{key}")
+                record("get", started, status)
+            elif choice < 0.8:
+                status, _ = client.request("GET", f"/data/list/{collection}?pageSize=50")
+                record("list", started, status)
+            else:
+                status, _ = client.request("GET", f"/data/query/{collection}?where=n>500&pageSize=50")
+                record("query", started, status)
+    
+    def probe():
+        client = Client(args.url)
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            status, _ = client.request("GET", "/")
+            record("probe /", started, status)
+            time.sleep(0.01)
+    
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.clients)]
+    threads.append(threading.Thread(target=probe))
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    
+    print(f"{args.clients} clients, {args.duration}s, write ratio {args.write_ratio}")
+    print(f"{'operation':<10} {'count':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7}")
+    for name in sorted(samples):
+        values = samples[name]
+        print(f"{name:<10} {len(values):>7} {len(values) / elapsed:>8.1f} {percentile(values, 0.50):>8.1f} "
+              f"{percentile(values, 0.95):>8.1f} {percentile(values, 0.99):>8.1f} {max(values):>8.1f} "
+              f"{errors.get(name, 0):>7}")
+    everything = [value for name, values in samples.items() if name != "probe /" for value in values]
+    print(f"{'all data':<10} {len(everything):>7} {len(everything) / elapsed:>8.1f} "
+          f"{percentile(everything, 0.50):>8.1f} {percentile(everything, 0.95):>8.1f} "
+          f"{percentile(everything, 0.99):>8.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mixed read/write latency benchmark")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--keys", type=int, default=500)
+    parser.add_argument("--collection", default="benchmark")
+    parser.add_argument("--username", default="benchmark")
+    parser.add_argument("--password", default="benchmark-password")
+    run(parser.parse_args())
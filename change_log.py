@@ -0,0 +1,104 @@
+# change_log.py
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session
+
+from models import ChangeLogDB
+
+class ChangeLog:
+    """Append-only log of document changes, numbered by a global monotonic sequence"""
+    
+    DEFAULT_PAGE_SIZE = 500
+    MAX_PAGE_SIZE = 5000
+    
+    # Entries kept by trim(); clients further behind than this must reload
+    DEFAULT_MAX_ENTRIES = 100000
+    
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.stats = {
+            "appended": 0,
+            "trimmed": 0,
+            "reads": 0,
+            "resets": 0
+        }
+    
+    def append(self, db: Session, changes: List[Tuple[str, str, str, Optional[str]]]) -> List[int]:
+        """Log (collection, key, action, owner) changes in the caller's transaction; returns their sequence numbers"""
+        if not changes:
+            return []
+        now_ms = int(time.time() * 1000)
+        rows = [{"collection": collection, "key": key, "action": action, "owner": owner, "ts": now_ms}
+                for collection, key, action, owner in changes]
+        # SQLite has one writer, so numbers become visible to readers in order
+        result = db.execute(insert(ChangeLogDB).returning(ChangeLogDB.seq, sort_by_parameter_order=True), rows)
+        seqs = [row[0] for row in result]
+        with self._lock:
+            self.stats["appended"] += len(seqs)
+        return seqs
+    
+    def since(self, db: Session, since: int, limit: int = None, collection: str = None) -> Dict[str, Any]:
+        """Changes with seq > since, oldest first, plus where to continue from"""
+        limit = min(limit or self.DEFAULT_PAGE_SIZE, self.MAX_PAGE_SIZE)
+        oldest, latest = db.query(func.min(ChangeLogDB.seq), func.max(ChangeLogDB.seq)).one()
+        
+        # The changes right after since were trimmed, or since comes from another database
+        reset = (oldest is not None and since < oldest - 1) or since > (latest or 0)
+        if reset:
+            with self._lock:
+                self.stats["resets"] += 1
+            return {"changes": [], "lastSeq": latest or 0, "hasMore": False, "reset": True}
+        
+        query = db.query(ChangeLogDB).filter(ChangeLogDB.seq > since)
+        if collection is not None:
+            query = query.filter(ChangeLogDB.collection == collection)
+        rows = query.order_by(ChangeLogDB.seq).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        with self._lock:
+            self.stats["reads"] += 1
+        
+        return {
+            "changes": [self._describe(row) for row in rows],
+            # A caught-up client continues from the newest entry, even one it may not see
+            "lastSeq": rows[-1].seq if has_more else max([since, latest or 0] + [row.seq for row in rows[-1:]]),
+            "hasMore": has_more,
+            "reset": False
+        }
+    
+    @staticmethod
+    def _describe(row: ChangeLogDB) -> Dict[str, Any]:
+        return {
+            "seq": row.seq,
+            "collection": row.collection,
+            "key": row.key,
+            "action": row.action,
+            "owner": row.owner,
+            "ts": row.ts
+        }
+    
+    def latest(self, db: Session) -> int:
+        return db.query(func.max(ChangeLogDB.seq)).scalar() or 0
+    
+    def trim(self, db: Session) -> int:
+        """Drop all but the newest max_entries entries"""
+        latest = self.latest(db)
+        deleted = db.query(ChangeLogDB).filter(
+            ChangeLogDB.seq <= latest - self.max_entries
+        ).delete(synchronize_session=False)
+        db.commit()
+        with self._lock:
+            self.stats["trimmed"] += deleted
+        return deleted
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        stats["max_entries"] = self.max_entries
+        return stats
+
+# Create global instance
+change_log = ChangeLog()
@@ -11,26 +11,29 @@ const charts = {
 
         try {
             // Fetch all collections
-            const collections = await api.fetchAllCollections();
+            this.renderAnalytics(await api.fetchAllCollections());
 
-            if (Object.keys(collections).length === 0) {
-                this.showEmptyAnalytics();
-                return;
-            }
+        } catch (error) {
+            console.error('Analytics error:', error);
+        }
+    },
 
-            // Process data for charts
-            const chartData = this.processCollectionsForChart(collections);
-            const stats = this.calculateStats(collections);
+    // Draw the chart and statistics for already fetched collections
+    renderAnalytics(collections) {
+        if (Object.keys(collections).length === 0) {
+            this.showEmptyAnalytics();
+            return;
+        }
 
-            // Create chart
-            this.createCollectionChart(chartData);
+        // Process data for charts
+        const chartData = this.processCollectionsForChart(collections);
+        const stats = this.calculateStats(collections);
 
-            // Update statistics
-            this.updateStatistics(stats);
+        // Create chart
+        this.createCollectionChart(chartData);
 
-        } catch (error) {
-            console.error('Analytics error:', error);
-        }
+        // Update statistics
+        this.updateStatistics(stats);
     },
 
     // Process collections for chart visualization
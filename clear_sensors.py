@@ -1,11 +1,9 @@
 # clear_sensors.py - Clear all sensor data
-from models import SessionLocal, DataDB
+# Deletes in small batches (see retention.py) so the server keeps running;
+# for ongoing cleanup set a policy with POST /retention/sensors instead.
+from retention import retention_manager
 
-db = SessionLocal()
-
-# Delete all sensor data
-deleted = db.query(DataDB).filter(DataDB.collection == "sensors").delete()
-db.commit()
-db.close()
+deleted = retention_manager.purge_collection("sensors")
+retention_manager.compact()
 
 print(f"✅ Deleted {deleted} sensor records!")
\ No newline at end of file
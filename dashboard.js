@@ -9,30 +9,34 @@ const dashboard = {
         try {
             console.log('📊 Loading dashboard...');
             
-            // Get all collections and count items
-            const collections = await api.fetchAllCollections();
-            this.allCollections = collections;
-            
-            const totalCollections = Object.keys(collections).length;
-            let totalItems = 0;
-            
-            Object.values(collections).forEach(items => {
-                totalItems += Object.keys(items).length;
-            });
-            
-            // Update dashboard stats
-            document.getElementById('totalUsers').textContent = '1';
-            document.getElementById('totalCollections').textContent = totalCollections;
-            document.getElementById('totalItems').textContent = totalItems;
-            
-            // Display recent data
-            this.displayRecentData(collections);
+            // Get all collections
+            this.renderDashboard(await api.fetchAllCollections());
             
         } catch (error) {
             console.error('Error loading dashboard:', error);
         }
     },
     
+    // Show stats and recent data for already fetched collections
+    renderDashboard(collections) {
+        this.allCollections = collections;
+        
+        const totalCollections = Object.keys(collections).length;
+        let totalItems = 0;
+        
+        Object.values(collections).forEach(items => {
+            totalItems += Object.keys(items).length;
+        });
+        
+        // Update dashboard stats
+        document.getElementById('totalUsers').textContent = '1';
+        document.getElementById('totalCollections').textContent = totalCollections;
+        document.getElementById('totalItems').textContent = totalItems;
+        
+        // Display recent data
+        this.displayRecentData(collections);
+    },
+    
     // Display recent data with DELETE buttons
     displayRecentData(collections) {
         const container = document.getElementById('recentDataTable');
@@ -92,7 +96,12 @@ const dashboard = {
         const container = document.getElementById('collectionsTable');
         container.innerHTML = '<div class="loading">Loading...</div>';
         
-        const collections = await api.fetchAllCollections();
+        this.renderCollectionsView(await api.fetchAllCollections());
+    },
+    
+    // Show the collections table for already fetched collections
+    renderCollectionsView(collections) {
+        const container = document.getElementById('collectionsTable');
         
         if (Object.keys(collections).length === 0) {
             container.innerHTML = '<div class="empty-state"><h3>No collections</h3><p>Create data to see collections</p></div>';
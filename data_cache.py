@@ -0,0 +1,114 @@
+# data_cache.py
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+class DataCache:
+    """Read-through LRU of decoded documents for /data/get, invalidated on every write"""
+    
+    # Rough per-entry overhead on top of the JSON size, for the memory budget
+    ENTRY_OVERHEAD = 200
+    
+    # Recently invalidated keys remembered to reject stale read-through fills
+    MAX_TRACKED_INVALIDATIONS = 4096
+    
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.bytes = 0
+        self._lock = threading.Lock()
+        
+        # A read that started before a write to its key must not cache what it read.
+        # Each invalidation gets a sequence number; fills carry the number seen when
+        # their read began.
+        self.sequence = 0
+        self.invalidated: "OrderedDict[str, int]" = OrderedDict()
+        self.invalidated_floor = 0
+        
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0,
+            "rejected_fills": 0
+        }
+    
+    def get(self, data_id: str) -> Optional[Dict[str, Any]]:
+        """Cached {"data", "owner", "id"} for a document, or None"""
+        with self._lock:
+            entry = self.entries.get(data_id)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(data_id)
+            self.stats["hits"] += 1
+            return entry
+    
+    def read_token(self) -> int:
+        """Take before reading from the database; pass to put()"""
+        with self._lock:
+            return self.sequence
+    
+    def put(self, data_id: str, entry: Dict[str, Any], size: int, token: int):
+        """Cache a document read from the database, unless it was written since token"""
+        size += self.ENTRY_OVERHEAD
+        with self._lock:
+            last_invalidated = self.invalidated.get(data_id, self.invalidated_floor)
+            if last_invalidated > token:
+                self.stats["rejected_fills"] += 1
+                return
+            if size > self.max_bytes:
+                return
+            self._remove(data_id)
+            self.entries[data_id] = dict(entry, size=size)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+    
+    def invalidate(self, data_id: str):
+        """Drop a document after it was written or deleted"""
+        with self._lock:
+            self.sequence += 1
+            self.invalidated[data_id] = self.sequence
+            self.invalidated.move_to_end(data_id)
+            while len(self.invalidated) > self.MAX_TRACKED_INVALIDATIONS:
+                _, sequence = self.invalidated.popitem(last=False)
+                self.invalidated_floor = max(self.invalidated_floor, sequence)
+            if self._remove(data_id):
+                self.stats["invalidations"] += 1
+    
+    def invalidate_collection(self, collection: str):
+        """Drop every cached document of a collection (bulk deletes, retention)"""
+        prefix = f"{collection}:"
+        with self._lock:
+            self.sequence += 1
+            # Fills that started before now may hold deleted rows of any key
+            self.invalidated_floor = self.sequence
+            for data_id in [data_id for data_id in self.entries if data_id.startswith(prefix)]:
+                self._remove(data_id)
+                self.stats["invalidations"] += 1
+    
+    def _remove(self, data_id: str) -> bool:
+        entry = self.entries.pop(data_id, None)
+        if entry is None:
+            return False
+        self.bytes -= entry["size"]
+        return True
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats.update({"size": len(self.entries), "bytes": self.bytes})
+        lookups = stats["hits"] + stats["misses"]
+        stats.update({
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hit_rate": round(stats["hits"] / lookups, 3) if lookups else 0.0
+        })
+        return stats
+
+# Create global instance
+data_cache = DataCache()
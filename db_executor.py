@@ -0,0 +1,116 @@
+# db_executor.py
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from itertools import islice
+from typing import Dict, Any, Callable, Iterable, AsyncIterator
+
+from models import SessionLocal
+
+class DBExecutor:
+    """Bounded thread pool that runs blocking SQLAlchemy work off the event loop"""
+    
+    # SQLite allows one writer at a time; a few threads are enough to overlap
+    # WAL reads with a write without piling up lock waits
+    DEFAULT_WORKERS = 4
+    
+    def __init__(self, max_workers: int = DEFAULT_WORKERS):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        self._lock = threading.Lock()
+        
+        self.stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "active": 0,
+            "max_wait_ms": 0.0,
+            "total_wait_ms": 0.0,
+            "max_run_ms": 0.0,
+            "total_run_ms": 0.0
+        }
+    
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Queue fn on the pool; usable from any thread"""
+        queued = time.perf_counter()
+        with self._lock:
+            self.stats["submitted"] += 1
+        return self.executor.submit(self._timed, queued, fn, args, kwargs)
+    
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Run fn on the pool and wait for it without blocking the event loop"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+    
+    async def run_session(self, fn: Callable, *args, **kwargs) -> Any:
+        """Run fn(db, *args) on the pool with a session that is closed afterwards"""
+        return await self.run(self._with_session, fn, args, kwargs)
+    
+    async def iterate(self, iterable: Iterable[str], chunk_size: int = 100) -> AsyncIterator[str]:
+        """Drive a blocking iterator (e.g. a streaming query) on the pool, a chunk at a time"""
+        iterator = iter(iterable)
+        try:
+            while True:
+                chunk = await self.run(lambda: list(islice(iterator, chunk_size)))
+                if not chunk:
+                    break
+                yield "".join(chunk)
+        finally:
+            close = getattr(iterator, "close", None)
+            if close:
+                # Closing runs the generator's cleanup (session close) on the pool too
+                await self.run(close)
+    
+    @staticmethod
+    def _with_session(fn: Callable, args: tuple, kwargs: dict) -> Any:
+        db = SessionLocal()
+        try:
+            return fn(db, *args, **kwargs)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+    
+    def _timed(self, queued: float, fn: Callable, args: tuple, kwargs: dict) -> Any:
+        started = time.perf_counter()
+        wait_ms = (started - queued) * 1000
+        with self._lock:
+            self.stats["active"] += 1
+            self.stats["total_wait_ms"] += wait_ms
+            self.stats["max_wait_ms"] = max(self.stats["max_wait_ms"], wait_ms)
+        
+        failed = False
+        try:
+            return fn(*args, **kwargs)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            run_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.stats["active"] -= 1
+                self.stats["failed" if failed else "completed"] += 1
+                self.stats["total_run_ms"] += run_ms
+                self.stats["max_run_ms"] = max(self.stats["max_run_ms"], run_ms)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Pool size, queue depth and wait/run latency"""
+        with self._lock:
+            stats = dict(self.stats)
+        finished = stats["completed"] + stats["failed"]
+        started = finished + stats["active"]
+        total_wait_ms = stats.pop("total_wait_ms")
+        total_run_ms = stats.pop("total_run_ms")
+        stats.update({
+            "max_workers": self.max_workers,
+            "queued": stats["submitted"] - started,
+            "avg_wait_ms": round(total_wait_ms / started, 2) if started else 0.0,
+            "max_wait_ms": round(stats["max_wait_ms"], 2),
+            "avg_run_ms": round(total_run_ms / finished, 2) if finished else 0.0,
+            "max_run_ms": round(stats["max_run_ms"], 2)
+        })
+        return stats
+
+# Create global instance
+db_executor = DBExecutor()
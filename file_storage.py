@@ -1,26 +1,61 @@
 # file_storage.py
 import os
+import time
 import uuid
 import shutil
+import asyncio
+import hashlib
+import threading
 from datetime import datetime
 from fastapi import UploadFile, HTTPException
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple, AsyncIterator
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects.sqlite import insert
 
-from models import FileDB
+from models import FileDB, BlobDB, UploadSessionDB, SessionLocal
 
 class FileStorage:
     """Manage file uploads, downloads, and metadata"""
     
-    def __init__(self):
+    # Uploads are copied a chunk at a time, so memory per upload stays at one chunk
+    CHUNK_SIZE = 1024 * 1024
+    DEFAULT_MAX_FILE_SIZE = 100 * 1024 * 1024
+    
+    # Background collection of unreferenced blobs
+    GC_INTERVAL = 60  # seconds
+    STALE_UPLOAD_SECONDS = 3600  # leftover .part files older than this are removed
+    UPLOAD_SESSION_SECONDS = 24 * 3600  # resumable uploads idle this long are abandoned
+    
+    def __init__(self, max_file_size: int = DEFAULT_MAX_FILE_SIZE):
+        self.max_file_size = max_file_size
         self.storage_dir = "alphabase_storage"
         self.users_dir = os.path.join(self.storage_dir, "users")
         self.public_dir = os.path.join(self.storage_dir, "public")
+        # Content-addressed blobs, shared by every file with the same bytes
+        self.blobs_dir = os.path.join(self.storage_dir, "blobs")
+        self.uploads_dir = os.path.join(self.blobs_dir, "tmp")
         
         # Create storage directories
         os.makedirs(self.storage_dir, exist_ok=True)
         os.makedirs(self.users_dir, exist_ok=True)
         os.makedirs(self.public_dir, exist_ok=True)
+        os.makedirs(self.uploads_dir, exist_ok=True)
+        
+        # Serializes adding references with collecting blobs, so a blob is
+        # never deleted while an upload is starting to use it
+        self._blob_lock = threading.Lock()
+        self._gc_wakeup: Optional[asyncio.Event] = None
+        self._stats_lock = threading.Lock()
+        # One request at a time may append to or finish a resumable upload
+        self._session_locks: Dict[str, asyncio.Lock] = {}
+        
+        self.stats = {
+            "uploads": 0,
+            "deduplicated": 0,
+            "bytes_saved": 0,
+            "blobs_collected": 0,
+            "bytes_collected": 0
+        }
     
     def generate_file_id(self) -> str:
         """Generate unique file ID"""
@@ -32,39 +67,165 @@ class FileStorage:
         os.makedirs(user_dir, exist_ok=True)
         return user_dir
     
+    def blob_path(self, sha256: str) -> str:
+        """Sharded location of a blob: blobs/<aa>/<bb>/<sha256>"""
+        return os.path.join(self.blobs_dir, sha256[:2], sha256[2:4], sha256)
+    
+    def is_blob_path(self, path: str) -> bool:
+        return os.path.dirname(os.path.dirname(os.path.dirname(path))) == self.blobs_dir
+    
     async def save_upload_file(self, upload_file: UploadFile, username: str, is_public: bool = False) -> Dict[str, Any]:
-        """Save uploaded file and return file info"""
+        """Stream an upload to a temporary file and return file info; add_file() stores it"""
         file_id = self.generate_file_id()
         original_filename = upload_file.filename
         file_extension = os.path.splitext(original_filename)[1]
         
-        # Determine storage location
-        if is_public:
-            storage_dir = self.public_dir
-        else:
-            storage_dir = self.get_user_storage_path(username)
-        
-        # Create unique filename
         unique_filename = f"{file_id}{file_extension}"
-        file_path = os.path.join(storage_dir, unique_filename)
+        upload_path = os.path.join(self.uploads_dir, f"{file_id}.part")
         
-        # Save file
-        file_size = 0
-        with open(file_path, "wb") as buffer:
-            content = await upload_file.read()
-            file_size = len(content)
-            buffer.write(content)
+        # Save file without blocking the event loop
+        file_size, sha256 = await asyncio.to_thread(self._copy_upload, upload_file.file, upload_path)
         
         return {
             "file_id": file_id,
             "filename": unique_filename,
             "original_filename": original_filename,
-            "file_path": file_path,
+            "upload_path": upload_path,
             "file_size": file_size,
+            "sha256": sha256,
             "mime_type": upload_file.content_type,
             "is_public": is_public
         }
     
+    def _copy_upload(self, source, upload_path: str) -> Tuple[int, str]:
+        """Copy an upload to upload_path in chunks, hashing as it goes; returns (size, sha256)"""
+        digest = hashlib.sha256()
+        file_size = 0
+        try:
+            with open(upload_path, "wb") as buffer:
+                while True:
+                    chunk = source.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    file_size += len(chunk)
+                    if file_size > self.max_file_size:
+                        raise ValueError(f"File too large. Maximum size is {self.max_file_size // (1024 * 1024)}MB.")
+                    digest.update(chunk)
+                    buffer.write(chunk)
+        except BaseException:
+            self.discard_upload(upload_path)
+            raise
+        return file_size, digest.hexdigest()
+    
+    def discard_upload(self, upload_path: str):
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
+    
+    def add_file(self, db: Session, file_record: FileDB, upload_path: str):
+        """Move an upload into its blob (or drop it if the blob exists) and commit the file record"""
+        blob_path = self.blob_path(file_record.sha256)
+        try:
+            with self._blob_lock:
+                created = not os.path.exists(blob_path)
+                if created:
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    os.replace(upload_path, blob_path)
+                
+                try:
+                    self._add_reference(db, file_record, blob_path)
+                except Exception:
+                    if created:
+                        os.remove(blob_path)
+                    raise
+        finally:
+            self.discard_upload(upload_path)
+        if created:
+            self._count(uploads=1)
+        else:
+            # Same bytes were already stored: only a new reference
+            self._count(uploads=1, deduplicated=1, bytes_saved=file_record.file_size)
+    
+    @staticmethod
+    def _add_reference(db: Session, file_record: FileDB, blob_path: str):
+        """Count one more reference to the blob and commit the file record that holds it"""
+        stmt = insert(BlobDB).values(sha256=file_record.sha256, size=file_record.file_size, refcount=1,
+                                     created_at=datetime.utcnow())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[BlobDB.sha256],
+            set_={"refcount": BlobDB.refcount + 1, "released_at": None}
+        )
+        db.execute(stmt)
+        file_record.file_path = blob_path
+        db.add(file_record)
+        db.commit()
+    
+    # -------------------------------------------------------------------------
+    # Resumable uploads
+    # -------------------------------------------------------------------------
+    
+    def session_path(self, upload_id: str) -> str:
+        return os.path.join(self.uploads_dir, f"{upload_id}.upload")
+    
+    def create_session(self, db: Session, filename: str, size: int, mime_type: Optional[str],
+                       is_public: bool, owner: str) -> Dict[str, Any]:
+        """Start a resumable upload of size bytes"""
+        if size < 0 or size > self.max_file_size:
+            raise ValueError(f"File too large. Maximum size is {self.max_file_size // (1024 * 1024)}MB.")
+        upload_id = self.generate_file_id()
+        open(self.session_path(upload_id), "wb").close()
+        db.add(UploadSessionDB(id=upload_id, owner=owner, filename=filename, mime_type=mime_type,
+                               is_public="true" if is_public else "false", size=size, created_at=datetime.utcnow()))
+        db.commit()
+        return {"upload_id": upload_id, "offset": 0, "size": size}
+    
+    def upload_offset(self, upload_id: str) -> int:
+        """Bytes received so far; everything written to disk counts"""
+        try:
+            return os.path.getsize(self.session_path(upload_id))
+        except OSError:
+            return 0
+    
+    def session_lock(self, upload_id: str) -> asyncio.Lock:
+        return self._session_locks.setdefault(upload_id, asyncio.Lock())
+    
+    async def append_upload(self, upload_id: str, chunks: AsyncIterator[bytes], offset: int, size: int) -> int:
+        """Append a request body at offset in CHUNK_SIZE writes; returns the new offset"""
+        buffer = await asyncio.to_thread(open, self.session_path(upload_id), "ab")
+        pending = bytearray()
+        try:
+            async for chunk in chunks:
+                if offset + len(pending) + len(chunk) > size:
+                    raise ValueError(f"Data goes past the declared size of {size} bytes")
+                pending += chunk
+                if len(pending) >= self.CHUNK_SIZE:
+                    await asyncio.to_thread(buffer.write, pending)
+                    offset += len(pending)
+                    pending = bytearray()
+        finally:
+            # Whatever arrived before an error or disconnect is kept, so the client resumes after it
+            if pending:
+                await asyncio.to_thread(buffer.write, pending)
+                offset += len(pending)
+            await asyncio.to_thread(buffer.close)
+        return offset
+    
+    def hash_file(self, path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as source:
+            for chunk in iter(lambda: source.read(self.CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    def remove_session(self, db: Session, upload_id: str):
+        """Forget a resumable upload and its partial data"""
+        db.query(UploadSessionDB).filter(UploadSessionDB.id == upload_id).delete(synchronize_session=False)
+        db.commit()
+        self.discard_upload(self.session_path(upload_id))
+    
+    def forget_session(self, upload_id: str):
+        """Drop the lock of a finished or cancelled upload (call from the event loop)"""
+        self._session_locks.pop(upload_id, None)
+    
     def get_file_path(self, file_id: str, db: Session) -> Optional[str]:
         """Get file path by file ID"""
         file_record = db.query(FileDB).filter(FileDB.id == file_id).first()
@@ -73,11 +234,16 @@ class FileStorage:
         return None
     
     def delete_file(self, file_id: str, db: Session) -> bool:
-        """Delete file from storage and database"""
+        """Delete a file record; its blob is released and collected in the background"""
         file_record = db.query(FileDB).filter(FileDB.id == file_id).first()
         if file_record:
-            # Delete physical file
-            if os.path.exists(file_record.file_path):
+            if self.is_blob_path(file_record.file_path):
+                db.query(BlobDB).filter(BlobDB.sha256 == file_record.sha256).update({
+                    BlobDB.refcount: BlobDB.refcount - 1,
+                    BlobDB.released_at: datetime.utcnow()
+                }, synchronize_session=False)
+            elif os.path.exists(file_record.file_path):
+                # Files stored before the blob store have their own copy
                 os.remove(file_record.file_path)
             
             # Delete database record
@@ -85,6 +251,88 @@ class FileStorage:
             db.commit()
             return True
         return False
+    
+    # -------------------------------------------------------------------------
+    # Garbage collection
+    # -------------------------------------------------------------------------
+    
+    def collect_garbage(self) -> int:
+        """Delete blobs no file refers to any more, stale partial uploads and abandoned sessions; returns blobs removed"""
+        db = SessionLocal()
+        removed = 0
+        try:
+            candidates = [row[0] for row in db.query(BlobDB.sha256).filter(BlobDB.refcount <= 0).all()]
+            for sha256 in candidates:
+                with self._blob_lock:
+                    # Re-check under the lock: an upload may have just taken a reference
+                    blob = db.query(BlobDB).filter(BlobDB.sha256 == sha256, BlobDB.refcount <= 0).first()
+                    if blob is None:
+                        continue
+                    path = self.blob_path(sha256)
+                    if os.path.exists(path):
+                        os.remove(path)
+                    db.delete(blob)
+                    db.commit()
+                removed += 1
+                self._count(blobs_collected=1, bytes_collected=blob.size or 0)
+        finally:
+            db.close()
+        
+        now = time.time()
+        expired_sessions = []
+        for name in os.listdir(self.uploads_dir):
+            path = os.path.join(self.uploads_dir, name)
+            upload_id, extension = os.path.splitext(name)
+            max_age = self.UPLOAD_SESSION_SECONDS if extension == ".upload" else self.STALE_UPLOAD_SECONDS
+            try:
+                if os.path.getmtime(path) < now - max_age:
+                    os.remove(path)
+                    if extension == ".upload":
+                        expired_sessions.append(upload_id)
+            except OSError:
+                pass
+        
+        if expired_sessions:
+            db = SessionLocal()
+            try:
+                db.query(UploadSessionDB).filter(UploadSessionDB.id.in_(expired_sessions)).delete(synchronize_session=False)
+                db.commit()
+            finally:
+                db.close()
+            # dict.pop is atomic, so the collector's thread can drop the locks too
+            for upload_id in expired_sessions:
+                self._session_locks.pop(upload_id, None)
+        return removed
+    
+    def request_gc(self):
+        """Run the collector soon instead of at the next interval (call from the event loop)"""
+        if self._gc_wakeup:
+            self._gc_wakeup.set()
+    
+    async def run_gc_forever(self, interval: float = GC_INTERVAL):
+        """Background loop: collect unreferenced blobs every interval, or when woken"""
+        self._gc_wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._gc_wakeup.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._gc_wakeup.clear()
+            try:
+                removed = await asyncio.to_thread(self.collect_garbage)
+                if removed:
+                    print(f"🧹 Collected {removed} unreferenced blobs")
+            except Exception as e:
+                print(f"❌ Blob collection failed: {e}")
+    
+    def _count(self, **amounts: int):
+        with self._stats_lock:
+            for name, amount in amounts.items():
+                self.stats[name] += amount
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return dict(self.stats)
 
 # Create global instance
 file_storage = FileStorage()
\ No newline at end of file
@@ -0,0 +1,97 @@
+# index_manager.py
+import hashlib
+from datetime import datetime
+from typing import List, Dict, Any
+from sqlalchemy.orm import Session
+
+from models import IndexDB
+from query_system import QueryCompiler
+
+class IndexManager:
+    """Manage secondary indexes on JSON fields of collections"""
+    
+    INDEX_PREFIX = "ix_data_json_"
+    
+    @staticmethod
+    def index_name(field: str) -> str:
+        """Physical index name for a field path (shared by all collections)"""
+        digest = hashlib.sha1(field.encode()).hexdigest()[:12]
+        return f"{IndexManager.INDEX_PREFIX}{digest}"
+    
+    @staticmethod
+    def _create_physical_index(db: Session, index_name: str, field: str):
+        # The expression must match QueryCompiler.field_expression exactly,
+        # otherwise SQLite won't pick the index for /data/query
+        quoted_path = QueryCompiler.path_literal(field)
+        db.connection().exec_driver_sql(
+            f"CREATE INDEX IF NOT EXISTS {index_name} "
+            f"ON data (collection, json_extract(value, {quoted_path}), id)"
+        )
+    
+    def create_index(self, db: Session, collection: str, field: str) -> Dict[str, Any]:
+        """Declare an index on a JSON field of a collection"""
+        if QueryCompiler.json_path(field) is None:
+            raise ValueError(f"Invalid field path: {field}")
+        
+        index_id = f"{collection}:{field}"
+        existing = db.query(IndexDB).filter(IndexDB.id == index_id).first()
+        if existing:
+            return self._describe(existing)
+        
+        index_name = self.index_name(field)
+        self._create_physical_index(db, index_name, field)
+        
+        index_record = IndexDB(
+            id=index_id,
+            collection=collection,
+            field=field,
+            index_name=index_name,
+            created_at=datetime.utcnow()
+        )
+        db.add(index_record)
+        db.commit()
+        print(f"🗂️  Index created: {collection}.{field} ({index_name})")
+        return self._describe(index_record)
+    
+    def drop_index(self, db: Session, collection: str, field: str) -> bool:
+        """Remove an index declaration, dropping the SQLite index when unused"""
+        index_record = db.query(IndexDB).filter(IndexDB.id == f"{collection}:{field}").first()
+        if not index_record:
+            return False
+        
+        index_name = index_record.index_name
+        db.delete(index_record)
+        db.flush()
+        
+        still_used = db.query(IndexDB).filter(IndexDB.index_name == index_name).first()
+        if not still_used:
+            db.connection().exec_driver_sql(f"DROP INDEX IF EXISTS {index_name}")
+        
+        db.commit()
+        print(f"🗑️  Index dropped: {collection}.{field}")
+        return True
+    
+    def list_indexes(self, db: Session, collection: str = None) -> List[Dict[str, Any]]:
+        """List declared indexes, optionally for one collection"""
+        query = db.query(IndexDB)
+        if collection:
+            query = query.filter(IndexDB.collection == collection)
+        return [self._describe(record) for record in query.order_by(IndexDB.id).all()]
+    
+    def sync(self, db: Session):
+        """Make sure every declared index exists in the database"""
+        for record in db.query(IndexDB).all():
+            self._create_physical_index(db, record.index_name, record.field)
+        db.commit()
+    
+    @staticmethod
+    def _describe(record: IndexDB) -> Dict[str, Any]:
+        return {
+            "collection": record.collection,
+            "field": record.field,
+            "index_name": record.index_name,
+            "created_at": record.created_at.isoformat()
+        }
+
+# Create global instance
+index_manager = IndexManager()
@@ -0,0 +1,275 @@
+# ingest_buffer.py
+import asyncio
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import List, Dict, Any
+from sqlalchemy.dialects.sqlite import insert
+
+from models import DataDB, TimeSeriesDB, SessionLocal
+from timeseries import timeseries_store
+from rollups import rollup_manager
+from websocket_manager import manager
+from db_executor import db_executor
+from data_cache import data_cache
+from change_log import change_log
+from value_codec import value_codec
+
+class IngestBuffer:
+    """Bounded write-behind queue that group-commits ingested records"""
+    
+    # What submit() does when the queue is full:
+    #   block       - wait up to block_timeout for room (backpressure on the producer)
+    #   drop_newest - discard the incoming record
+    #   drop_oldest - discard the oldest queued record to make room
+    POLICIES = ("block", "drop_newest", "drop_oldest")
+    
+    # Environment variables overriding the defaults of the global instance, with their types
+    ENVIRONMENT = {
+        "max_queue_size": ("ALPHABASE_INGEST_QUEUE_SIZE", int),
+        "batch_size": ("ALPHABASE_INGEST_BATCH_SIZE", int),
+        "flush_interval_ms": ("ALPHABASE_INGEST_FLUSH_MS", int),
+        "policy": ("ALPHABASE_INGEST_POLICY", str),
+        "block_timeout": ("ALPHABASE_INGEST_BLOCK_TIMEOUT", float)
+    }
+    
+    def __init__(self, max_queue_size: int = 10000, batch_size: int = 200,
+                 flush_interval_ms: int = 250, policy: str = "block", block_timeout: float = 1.0):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown ingest policy: {policy}")
+        # A queue size of 0 would make queue.Queue unbounded
+        for name, value in (("max_queue_size", max_queue_size), ("batch_size", batch_size)):
+            if value < 1:
+                raise ValueError(f"{name} must be at least 1")
+        if flush_interval_ms < 0 or block_timeout < 0:
+            raise ValueError("flush_interval_ms and block_timeout can't be negative")
+        
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.policy = policy
+        self.block_timeout = block_timeout
+        
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.loop = None
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        
+        self.stats = {
+            "enqueued": 0,
+            "dropped": 0,
+            "committed": 0,
+            "failed": 0,
+            "batches": 0,
+            "last_batch_size": 0,
+            "last_commit_ms": 0.0,
+            "max_commit_ms": 0.0,
+            "total_commit_ms": 0.0
+        }
+    
+    @classmethod
+    def from_environment(cls) -> "IngestBuffer":
+        """Queue size, batching and drop policy from ALPHABASE_INGEST_* variables, defaults for unset ones"""
+        settings = {}
+        for name, (variable, kind) in cls.ENVIRONMENT.items():
+            value = os.environ.get(variable)
+            if value:
+                try:
+                    settings[name] = kind(value)
+                except ValueError:
+                    raise ValueError(f"{variable} must be a number, got {value!r}")
+        return cls(**settings)
+    
+    def attach_loop(self, loop: asyncio.AbstractEventLoop):
+        """Event loop used to broadcast committed changes over WebSocket"""
+        self.loop = loop
+    
+    def start(self):
+        """Start the writer thread if it isn't running"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+            self._thread.start()
+    
+    def stop(self, timeout: float = 5.0):
+        """Flush everything still queued and stop the writer thread"""
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+    
+    def submit(self, collection: str, key: str, value: Dict[str, Any], owner: str, source: str = None) -> bool:
+        """Queue a data record for the next group commit; returns False if it was dropped"""
+        return self._enqueue({
+            "type": "data", "collection": collection, "key": key,
+            "value": value, "owner": owner, "source": source
+        })
+    
+    def submit_reading(self, device_id: str, ts: int, payload: Dict[str, Any], source: str = None) -> bool:
+        """Queue a sensor reading for the time-series store; returns False if it was dropped"""
+        return self._enqueue({
+            "type": "reading", "collection": timeseries_store.COLLECTION,
+            "device_id": device_id, "ts": ts, "payload": payload, "source": source
+        })
+    
+    def _enqueue(self, record: Dict[str, Any]) -> bool:
+        self.start()
+        try:
+            if self.policy == "block":
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            if self.policy != "drop_oldest" or not self._replace_oldest(record):
+                self._count("dropped")
+                return False
+        
+        self._count("enqueued")
+        return True
+    
+    def _replace_oldest(self, record: Dict[str, Any]) -> bool:
+        with self._lock:
+            try:
+                self.queue.get_nowait()
+                self.stats["dropped"] += 1
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(record)
+                return True
+            except queue.Full:
+                return False
+    
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.stats[name] += amount
+    
+    def _run(self):
+        while not self._stopping.is_set() or not self.queue.empty():
+            batch = self._collect_batch()
+            if batch:
+                # Share the database pool with the HTTP endpoints
+                db_executor.submit(self._write_batch, batch).result()
+    
+    def _collect_batch(self) -> List[Dict[str, Any]]:
+        """Wait for a first record, then take more until the batch is full or the interval ends"""
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _write_batch(self, batch: List[Dict[str, Any]]):
+        """Write a batch in one transaction, then broadcast the changes"""
+        # Several updates to the same key in one batch collapse to the last one
+        records = {}
+        readings = []
+        for record in batch:
+            if record["type"] == "reading":
+                readings.append(record)
+            else:
+                records[f"{record['collection']}:{record['key']}"] = record
+        
+        now = datetime.utcnow()
+        rows = [{
+            "id": data_id,
+            "collection": record["collection"],
+            "key": record["key"],
+            **value_codec.encode(record["value"]),
+            "owner": record["owner"],
+            "created_at": now,
+            "updated_at": now
+        } for data_id, record in records.items()]
+        
+        started = time.perf_counter()
+        db = SessionLocal()
+        try:
+            if rows:
+                stmt = insert(DataDB).values(rows)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[DataDB.id],
+                    set_={"value": stmt.excluded.value, "value_blob": stmt.excluded.value_blob,
+                          "codec": stmt.excluded.codec, "owner": stmt.excluded.owner,
+                          "updated_at": stmt.excluded.updated_at}
+                )
+                db.execute(stmt)
+            reading_timestamps = timeseries_store.append(db, readings)
+            
+            now_ms = int(time.time() * 1000)
+            rollup_manager.record(
+                db,
+                [(record["collection"], now_ms, record["value"]) for record in records.values()] +
+                [(record["collection"], ts, record["payload"]) for record, ts in zip(readings, reading_timestamps)]
+            )
+            changes = [(record["collection"], record["key"], record["owner"]) for record in records.values()]
+            changes += [(record["collection"], timeseries_store.key_for(record["device_id"], ts), TimeSeriesDB.OWNER)
+                        for record, ts in zip(readings, reading_timestamps)]
+            seqs = change_log.append(db, [(collection, key, "update", owner) for collection, key, owner in changes])
+            db.commit()
+        except Exception as e:
+            print(f"❌ Ingest batch failed ({len(batch)} records): {e}")
+            db.rollback()
+            self._count("failed", len(batch))
+            return
+        finally:
+            db.close()
+        
+        commit_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.stats["committed"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["last_batch_size"] = len(batch)
+            self.stats["last_commit_ms"] = commit_ms
+            self.stats["max_commit_ms"] = max(self.stats["max_commit_ms"], commit_ms)
+            self.stats["total_commit_ms"] += commit_ms
+        
+        values = [record["value"] for record in records.values()] + [record["payload"] for record in readings]
+        sources = [record["source"] for record in records.values()] + [record["source"] for record in readings]
+        for (collection, key, owner), seq, value, source in zip(changes, seqs, values, sources):
+            data_cache.invalidate(f"{collection}:{key}")
+            self._broadcast(collection, key, seq, value, owner, source)
+    
+    def _broadcast(self, collection: str, key: str, seq: int, value: Dict[str, Any], owner: str, source: str = None):
+        if not self.loop or not self.loop.is_running():
+            return
+        message = {"action": "update", "collection": collection, "key": key, "seq": seq}
+        if source:
+            message["source"] = source
+        # ConnectionManager isn't thread-safe; hand the event to the loop
+        self.loop.call_soon_threadsafe(manager.publish, message, value, owner)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Queue depth, batch size and commit latency counters"""
+        with self._lock:
+            stats = dict(self.stats)
+        total_commit_ms = stats.pop("total_commit_ms")
+        batches = stats["batches"]
+        stats.update({
+            "queue_depth": self.queue.qsize(),
+            "max_queue_size": self.max_queue_size,
+            "policy": self.policy,
+            "batch_size": self.batch_size,
+            "flush_interval_ms": int(self.flush_interval * 1000),
+            "avg_batch_size": round(stats["committed"] / batches, 1) if batches else 0,
+            "last_commit_ms": round(stats["last_commit_ms"], 2),
+            "max_commit_ms": round(stats["max_commit_ms"], 2),
+            "avg_commit_ms": round(total_commit_ms / batches, 2) if batches else 0.0
+        })
+        return stats
+
+# Create global instance
+ingest_buffer = IngestBuffer.from_environment()
@@ -1,27 +1,70 @@
 # main.py - AlphaBase v4.0 (FIXED)
-from fastapi import FastAPI, HTTPException, Depends, WebSocket, File, Form, UploadFile
+from fastapi import FastAPI, HTTPException, Depends, WebSocket, File, Form, UploadFile, Request, Query
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer
-from fastapi.responses import FileResponse
-from pydantic import BaseModel, EmailStr
-from passlib.context import CryptContext
+from fastapi.responses import FileResponse, StreamingResponse, Response, JSONResponse
+from pydantic import BaseModel, EmailStr, ValidationError
+from typing import Optional, List
+from sqlalchemy import func, inspect, text
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.schema import CreateIndex
 import jwt
+import hashlib
 from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
 import uvicorn
-import json
+import asyncio
+import time
 import os
+import calendar
+from itertools import islice
+from email.utils import formatdate, parsedate_to_datetime
 
 # Import our refactored modules
-from models import Base, engine, SessionLocal, UserDB, DataDB, FileDB
+from models import Base, engine, SessionLocal, UserDB, DataDB, FileDB, UploadSessionDB, SensorsViewDB, TimeSeriesDB
+from timeseries import timeseries_store
+from rollups import rollup_manager
+from index_manager import index_manager
 from security_rules import security_rules
-from query_system import query_parser, query_engine
+from query_system import query_parser, query_engine, query_compiler
 from file_storage import file_storage
 from websocket_manager import manager
 from mqtt_manager import mqtt_manager
+from ingest_buffer import ingest_buffer
+from retention import retention_manager
+from db_executor import db_executor
+from password_hasher import password_hasher
+from auth_cache import auth_cache
+from data_cache import data_cache
+from change_log import change_log
+from payload_codecs import payload_codecs
+from value_codec import value_codec
+
+# Lifespan
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup work lives here rather than at import: password hashing workers
+    # are spawned processes that re-import the main script
+    await asyncio.to_thread(_prepare_database)
+    # Background writers hand results back to the server's event loop
+    ingest_buffer.attach_loop(asyncio.get_running_loop())
+    retention_task = asyncio.create_task(retention_manager.run_forever())
+    blob_gc_task = asyncio.create_task(file_storage.run_gc_forever())
+    yield
+    retention_task.cancel()
+    blob_gc_task.cancel()
+    ingest_buffer.stop()
+    password_hasher.shutdown()
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered by value_codec (orjson when installed)"""
+    def render(self, content) -> bytes:
+        return value_codec.dumps_bytes(content)
 
 # FastAPI App
-app = FastAPI(title="AlphaBase", version="4.0.0")
+app = FastAPI(title="AlphaBase", version="4.0.0", lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # CORS
 app.add_middleware(
@@ -30,6 +73,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Accept-Ranges", "Content-Range", "Upload-Offset", "Upload-Length"],
 )
 
 # Security
@@ -37,26 +81,80 @@ SECRET_KEY = "alphabase-secret-key-change-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+# Streaming reads
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+STREAM_BATCH_SIZE = 500
+
+# Operations accepted by one /data/batch request, and documents by one /data/getMany
+MAX_BATCH_OPERATIONS = 500
+MAX_GET_MANY = 500
+
+# Distinguishes snapshot ETags of this server run from those of earlier runs
+SNAPSHOT_EPOCH = os.urandom(8).hex()
+
 security = HTTPBearer()
 
-# Database
-def get_db():
+def _prepare_database():
+    """Create tables, migrate older database files and sync indexes and views (once per server start)"""
+    # Create tables
+    Base.metadata.create_all(bind=engine)
+    
+    # Converting an older file to incremental auto-vacuum is a blocking rebuild, so
+    # startup only does it when asked to; otherwise free pages are released incrementally
+    if retention_manager.auto_vacuum_mode() != "incremental":
+        if retention_manager.vacuum_on_start():
+            retention_manager.enable_incremental_vacuum()
+        else:
+            print(f"⚠️  Database file can't release free pages until it is rebuilt once: "
+                  f"POST /retention/vacuum as admin, or start with {retention_manager.VACUUM_ON_START_VARIABLE}=1")
+    retention_manager.compact()
+    
+    # Add columns and indexes introduced after the tables were first created
+    with engine.begin() as conn:
+        added = set()
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspect(conn).get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                                      f"{column.type.compile(engine.dialect)}"))
+                    added.add(f"{table.name}.{column.name}")
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+        if "data.updated_at" in added:
+            # Rows written before the column existed were last written no later than created
+            conn.execute(text("UPDATE data SET updated_at = created_at"))
+    
+    # Recreate declared JSON field indexes and the sensors compatibility view
     db = SessionLocal()
     try:
-        yield db
+        index_manager.sync(db)
+        timeseries_store.ensure_schema(db)
     finally:
         db.close()
 
-# Create tables
-Base.metadata.create_all(bind=engine)
-
 # Pydantic Models
 class DataItem(BaseModel):
     collection: str
     key: str
     value: dict
 
+class BatchOperation(BaseModel):
+    op: str  # "set" or "delete"
+    collection: str
+    key: str
+    value: Optional[dict] = None
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+
+class DocumentRef(BaseModel):
+    collection: str
+    key: str
+
+class GetManyRequest(BaseModel):
+    items: List[DocumentRef]
+
 class UserRegister(BaseModel):
     username: str
     email: EmailStr
@@ -70,13 +168,21 @@ class Token(BaseModel):
     access_token: str
     token_type: str
 
-# Helper Functions
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+class IndexSpec(BaseModel):
+    field: str
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+class UploadSessionSpec(BaseModel):
+    filename: str
+    size: int
+    mime_type: Optional[str] = None
+    is_public: bool = False
 
+class RetentionSpec(BaseModel):
+    max_age_days: Optional[float] = None
+    raw_max_age_days: Optional[float] = None
+    max_rows_per_device: Optional[int] = None
+
+# Helper Functions
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -84,19 +190,182 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(credentials = Depends(security)):
+async def verify_token(credentials = Depends(security)):
+    # Known tokens are a dictionary lookup; async so hits don't need a worker thread
+    return _authenticate(credentials.credentials)
+
+def _authenticate(token: str) -> str:
+    """Username of a valid token; raises 401 otherwise"""
+    cached = auth_cache.get(token)
+    if cached:
+        return cached["claims"]["sub"]
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+        auth_cache.put(token, payload)
         return username
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
-    except jwt.JWTError:
+    except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Could not validate credentials")
 
+def _require_collection_admin(collection: str, username: str):
+    """Collection-wide settings need write access to the collection, or the admin user"""
+    if not (security_rules.validate_write(collection, username) or security_rules.is_admin(username)):
+        raise HTTPException(status_code=403, detail=f"Write access denied to collection: {collection}")
+
+def _data_model(collection: str):
+    """Table (or view) that holds a collection's rows for reads"""
+    if collection == timeseries_store.COLLECTION:
+        return SensorsViewDB
+    return DataDB
+
+def _find_data(db: Session, collection: str, key: str):
+    """Look up one row, including readings in the time-series store"""
+    data = db.query(DataDB).filter(DataDB.id == f"{collection}:{key}").first()
+    if data is None and collection == timeseries_store.COLLECTION:
+        data = timeseries_store.get(db, key)
+    return data
+
+def _parse_query(query_params: dict) -> dict:
+    try:
+        return query_parser.parse_query_params(query_params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _restrict_to_readable(sql_query, collection: str, username: str, model):
+    """Add the read rule's row condition (e.g. owner = user) to a query's WHERE clause"""
+    if sql_query is None:
+        return None
+    condition = security_rules.sql_filter(collection, "read", username, model)
+    if condition is not None:
+        sql_query = sql_query.filter(condition)
+    return sql_query
+
+def _compile_reads(db: Session, collection: str, query: dict, username: str) -> Optional[list]:
+    """SQL queries whose rows, read one after another, answer a query; None to evaluate it in Python"""
+    if collection != timeseries_store.COLLECTION or query["order_by"]:
+        model = _data_model(collection)
+        sql_query = _restrict_to_readable(query_compiler.compile(db, collection, query, model),
+                                          collection, username, model)
+        return None if sql_query is None else [sql_query]
+    
+    # Without orderBy, sensors pages walk each store on its primary key instead of
+    # sorting all of sensors_view: data rows by id, then readings by (device_id, ts)
+    readings = _restrict_to_readable(query_compiler.compile_readings(db, query), collection, username, TimeSeriesDB)
+    if readings is None:
+        return None
+    if query["start_after"] and query["start_after"]["reading"]:
+        return [readings]
+    data_rows = _restrict_to_readable(query_compiler.compile(db, collection, query, DataDB),
+                                      collection, username, DataDB)
+    return None if data_rows is None else [data_rows, readings]
+
+def _push_down_limit(sql_queries: list, collection: str, query: dict) -> list:
+    """Add a SQL LIMIT of one row past the page when it is safe to do so"""
+    page_size = query_parser.effective_page_size(query)
+    # Only when the read rule doesn't filter rows after they are fetched
+    if page_size and not security_rules.needs_row_check(collection, "read"):
+        return [sql_query.limit(page_size + 1) for sql_query in sql_queries]
+    return sql_queries
+
+def _readable_rows(sql_queries: list, collection: str, username: str):
+    """Walk queries in batches, yielding only the rows the user may read"""
+    # The caller already checked collection access and applied the rule's SQL
+    # condition; only rules that can't be expressed in SQL are checked per row
+    check_rows = security_rules.needs_row_check(collection, "read")
+    for sql_query in sql_queries:
+        for item in sql_query.yield_per(STREAM_BATCH_SIZE):
+            if not check_rows or security_rules.validate_read(collection, username, {"owner": item.owner, "id": item.id}):
+                yield item
+
+def _cursor_after(query: dict, item) -> str:
+    reading = (item.device_id, item.ts) if isinstance(item, TimeSeriesDB) else None
+    return query_parser.encode_cursor(query, value_codec.decode(item), item.id, reading)
+
+def _read_page(sql_queries: list, collection: str, username: str, query: dict):
+    """Read the rows of one page that the user may see, plus the cursor for the next page"""
+    page_size = query_parser.effective_page_size(query)
+    page = []
+    for item in _readable_rows(sql_queries, collection, username):
+        page.append(item)
+        if page_size and len(page) > page_size:
+            break
+    
+    next_cursor = None
+    if page_size and len(page) > page_size:
+        page = page[:page_size]
+        next_cursor = _cursor_after(query, page[-1])
+    return page, next_cursor
+
+def _wants_stream(request: Request, stream: bool) -> bool:
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+def _read_chunk(collection: str, username: str, query: dict, size: int) -> list:
+    """Read up to size rows the user may see, with a session that is closed before returning"""
+    chunk_db = SessionLocal()
+    try:
+        sql_queries = _compile_reads(chunk_db, collection, query, username)
+        if not security_rules.needs_row_check(collection, "read"):
+            sql_queries = [sql_query.limit(size) for sql_query in sql_queries]
+        return list(islice(_readable_rows(sql_queries, collection, username), size))
+    finally:
+        chunk_db.close()
+
+def _stream_page(collection: str, username: str, query: dict, to_row):
+    """Yield one page as NDJSON lines, read in keyset chunks of STREAM_BATCH_SIZE rows"""
+    # Each chunk runs on a short session of its own, so a slow client holds no pooled
+    # connection while it reads; the next chunk resumes after the chunk's last row
+    page_size = query_parser.effective_page_size(query)
+    count = 0
+    last = None
+    next_cursor = None
+    chunk_query = query
+    while next_cursor is None:
+        # One row past the page tells whether there is a next page
+        size = min(STREAM_BATCH_SIZE, page_size - count + 1) if page_size else STREAM_BATCH_SIZE
+        rows = _read_chunk(collection, username, chunk_query, size)
+        for item in rows:
+            if page_size and count >= page_size:
+                next_cursor = _cursor_after(query, last)
+                break
+            count += 1
+            last = item
+            yield value_codec.dumps(to_row(item)) + "\n"
+        if len(rows) < size:
+            break
+        chunk_query = dict(query, start_after=query_parser.decode_cursor(_cursor_after(query, rows[-1])))
+    yield value_codec.dumps({"done": True, "count": count, "nextCursor": next_cursor}) + "\n"
+
+def _stream_response(lines) -> StreamingResponse:
+    """NDJSON response whose lines are produced on the database pool"""
+    return StreamingResponse(db_executor.iterate(lines), media_type=NDJSON_MEDIA_TYPE)
+
+def _stream_results(results: list, next_cursor: str = None):
+    """Yield already evaluated results as NDJSON lines"""
+    for result in results:
+        yield value_codec.dumps(result) + "\n"
+    yield value_codec.dumps({"done": True, "count": len(results), "nextCursor": next_cursor}) + "\n"
+
+def _json_response(result, headers: dict = None):
+    """Render a data read directly, skipping FastAPI's per-value jsonable_encoder walk"""
+    if isinstance(result, Response):
+        return result
+    return FastJSONResponse(result, headers=headers)
+
+def _list_item(item: DataDB) -> dict:
+    return {"key": item.key, "data": value_codec.decode(item)}
+
+def _query_result(item: DataDB) -> dict:
+    return {
+        "key": item.key,
+        "data": value_codec.decode(item),
+        "owner": item.owner,
+        "created_at": item.created_at.isoformat()
+    }
+
 # =============================================================================
 # API ENDPOINTS
 # =============================================================================
@@ -115,36 +384,46 @@ async def root():
     }
 
 # Authentication Endpoints
-@app.post("/auth/register", response_model=Token)
-async def register(user: UserRegister, db: Session = Depends(get_db)):
+def _check_new_user(db: Session, user: UserRegister):
     if db.query(UserDB).filter(UserDB.username == user.username).first():
         raise HTTPException(status_code=400, detail="Username already exists")
     if db.query(UserDB).filter(UserDB.email == user.email).first():
         raise HTTPException(status_code=400, detail="Email already registered")
-    
+
+def _add_user(db: Session, user: UserRegister, hashed_password: str):
+    _check_new_user(db, user)
     new_user = UserDB(
         username=user.username,
         email=user.email,
-        password=hash_password(user.password),
+        password=hashed_password,
         created_at=datetime.utcnow()
     )
     db.add(new_user)
     db.commit()
-    
+
+@app.post("/auth/register", response_model=Token)
+async def register(user: UserRegister):
+    # Check first so duplicates don't cost a hash; checked again when inserting
+    await db_executor.run_session(_check_new_user, user)
+    hashed_password = await password_hasher.hash(user.password)
+    await db_executor.run_session(_add_user, user, hashed_password)
+    auth_cache.invalidate_user(user.username)
     access_token = create_access_token(data={"sub": user.username})
     return {"access_token": access_token, "token_type": "bearer"}
 
+def _password_hash(db: Session, username: str) -> Optional[str]:
+    db_user = db.query(UserDB).filter(UserDB.username == username).first()
+    return db_user.password if db_user else None
+
 @app.post("/auth/login", response_model=Token)
-async def login(user: UserLogin, db: Session = Depends(get_db)):
-    db_user = db.query(UserDB).filter(UserDB.username == user.username).first()
-    if not db_user or not verify_password(user.password, db_user.password):
+async def login(user: UserLogin):
+    hashed_password = await db_executor.run_session(_password_hash, user.username)
+    if not hashed_password or not await password_hasher.verify(user.password, hashed_password):
         raise HTTPException(status_code=401, detail="Invalid username or password")
-    
     access_token = create_access_token(data={"sub": user.username})
     return {"access_token": access_token, "token_type": "bearer"}
 
-@app.get("/auth/me")
-async def get_current_user(username: str = Depends(verify_token), db: Session = Depends(get_db)):
+def _current_user(db: Session, username: str):
     user = db.query(UserDB).filter(UserDB.username == username).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -154,125 +433,399 @@ async def get_current_user(username: str = Depends(verify_token), db: Session =
         "created_at": user.created_at.isoformat()
     }
 
+@app.get("/auth/me")
+async def get_current_user(username: str = Depends(verify_token), credentials = Depends(security)):
+    user = auth_cache.get_user(credentials.credentials)
+    if user:
+        return user
+    user = await db_executor.run_session(_current_user, username)
+    auth_cache.set_user(credentials.credentials, user)
+    return user
+
 # Data Endpoints
-@app.post("/data/set")
-async def set_data(item: DataItem, username: str = Depends(verify_token), db: Session = Depends(get_db)):
+def _set_data(db: Session, item: DataItem, username: str):
     if not security_rules.validate_write(item.collection, username):
         raise HTTPException(status_code=403, detail=f"Write access denied to collection: {item.collection}")
     
     data_id = f"{item.collection}:{item.key}"
     existing_data = db.query(DataDB).filter(DataDB.id == data_id).first()
+    columns = value_codec.encode(item.value)
     
     if existing_data:
         resource_data = {"owner": existing_data.owner, "id": existing_data.id}
         if not security_rules.validate_write(item.collection, username, resource_data):
             raise HTTPException(status_code=403, detail="Not authorized to update this data")
-        existing_data.value = json.dumps(item.value)
+        for name, column_value in columns.items():
+            setattr(existing_data, name, column_value)
         existing_data.owner = username
+        existing_data.updated_at = datetime.utcnow()
     else:
+        now = datetime.utcnow()
         new_data = DataDB(
             id=data_id,
             collection=item.collection,
             key=item.key,
-            value=json.dumps(item.value),
+            **columns,
             owner=username,
-            created_at=datetime.utcnow()
+            created_at=now,
+            updated_at=now
         )
         db.add(new_data)
     
+    rollup_manager.record(db, [(item.collection, int(time.time() * 1000), item.value)])
+    seq, = change_log.append(db, [(item.collection, item.key, "update", username)])
+    db.commit()
+    return seq
+
+async def _read_data_item(request: Request) -> DataItem:
+    """Decode a /data/set body sent as JSON, MessagePack or CBOR (by Content-Type)"""
+    try:
+        codec = payload_codecs.codec_for_content_type(request.headers.get("content-type"))
+    except ValueError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    try:
+        document = payload_codecs.decode_document(await request.body(), codec)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        return DataItem.model_validate(document)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+# The body is read by _read_data_item (several encodings), so FastAPI can't infer it
+_DATA_ITEM_BODY = {"requestBody": {"required": True, "content": {
+    media_type: {"schema": DataItem.model_json_schema()}
+    for media_type in ("application/json", "application/msgpack", "application/cbor")
+}}}
+
+@app.post("/data/set", openapi_extra=_DATA_ITEM_BODY)
+async def set_data(request: Request, username: str = Depends(verify_token)):
+    item = await _read_data_item(request)
+    seq = await db_executor.run_session(_set_data, item, username)
+    data_cache.invalidate(f"{item.collection}:{item.key}")
+    manager.publish({"action": "update", "collection": item.collection, "key": item.key, "seq": seq},
+                   item.value, username)
+    return {"success": True, "collection": item.collection, "key": item.key, "seq": seq,
+            "message": "Data stored successfully"}
+
+def _cache_entry(data, token: int) -> dict:
+    """Decode a row into a hot-key cache entry and cache it"""
+    entry = {"data": value_codec.decode(data), "owner": data.owner, "id": data.id}
+    data_cache.put(data.id, entry, value_codec.stored_size(data), token)
+    return entry
+
+def _load_data(db: Session, collection: str, key: str, token: int) -> Optional[dict]:
+    """Read and decode one document, filling the hot-key cache"""
+    data = _find_data(db, collection, key)
+    if not data:
+        return None
+    return _cache_entry(data, token)
+
+def _load_many(db: Session, data_ids: List[str], token: int) -> dict:
+    """Read and decode several documents with one IN query, filling the hot-key cache"""
+    found = {data.id: _cache_entry(data, token)
+             for data in db.query(DataDB).filter(DataDB.id.in_(data_ids)).all()}
+    
+    # Readings in the time-series store are found by their (device, ts) primary key
+    prefix = f"{timeseries_store.COLLECTION}:"
+    for data_id in data_ids:
+        if data_id not in found and data_id.startswith(prefix):
+            reading = timeseries_store.get(db, data_id[len(prefix):])
+            if reading:
+                found[data_id] = _cache_entry(reading, token)
+    return found
+
+def _apply_batch(db: Session, operations: List[BatchOperation], username: str) -> List[dict]:
+    """Check and apply set/delete operations in one transaction; returns one change per operation"""
+    # Collection-level rules once per collection
+    for collection in {operation.collection for operation in operations}:
+        if not security_rules.validate_write(collection, username):
+            raise HTTPException(status_code=403, detail=f"Write access denied to collection: {collection}")
+    
+    # batch_write rejects batches that touch a document twice
+    final = {f"{operation.collection}:{operation.key}": operation for operation in operations}
+    
+    # One SELECT for the documents that already exist
+    existing = {
+        row.id: row for row in db.query(DataDB.id, DataDB.owner).filter(DataDB.id.in_(list(final))).all()
+    }
+    # Sensors readings to delete live in the time-series store, as in _find_data
+    prefix = f"{timeseries_store.COLLECTION}:"
+    readings = {}
+    for data_id, operation in final.items():
+        if operation.op == "delete" and data_id not in existing and data_id.startswith(prefix):
+            reading = timeseries_store.get(db, operation.key)
+            if reading:
+                readings[data_id] = reading
+                existing[data_id] = reading
+    for data_id, operation in final.items():
+        row = existing.get(data_id)
+        if row is None:
+            if operation.op == "delete":
+                raise HTTPException(status_code=404, detail=f"Data not found: {data_id}")
+            continue
+        if not security_rules.validate_write(operation.collection, username, {"owner": row.owner, "id": row.id}):
+            raise HTTPException(status_code=403, detail=f"Not authorized to modify {data_id}")
+    
+    now = datetime.utcnow()
+    rows = [{
+        "id": data_id,
+        "collection": operation.collection,
+        "key": operation.key,
+        **value_codec.encode(operation.value),
+        "owner": username,
+        "created_at": now,
+        "updated_at": now
+    } for data_id, operation in final.items() if operation.op == "set"]
+    deleted_ids = [data_id for data_id, operation in final.items()
+                   if operation.op == "delete" and data_id not in readings]
+    
+    if rows:
+        stmt = insert(DataDB).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[DataDB.id],
+            set_={"value": stmt.excluded.value, "value_blob": stmt.excluded.value_blob,
+                  "codec": stmt.excluded.codec, "owner": stmt.excluded.owner,
+                  "updated_at": stmt.excluded.updated_at}
+        )
+        db.execute(stmt)
+    if deleted_ids:
+        db.query(DataDB).filter(DataDB.id.in_(deleted_ids)).delete(synchronize_session=False)
+    for reading in readings.values():
+        db.delete(reading)
+    
+    now_ms = int(time.time() * 1000)
+    rollup_manager.record(db, [(operation.collection, now_ms, operation.value)
+                               for operation in final.values() if operation.op == "set"])
+    changes = [{
+        "collection": operation.collection,
+        "key": operation.key,
+        "action": "update" if operation.op == "set" else "delete"
+    } for operation in final.values()]
+    seqs = change_log.append(db, [(
+        change["collection"], change["key"], change["action"],
+        username if change["action"] == "update" else existing[data_id].owner
+    ) for data_id, change in zip(final, changes)])
     db.commit()
-    await manager.broadcast(json.dumps({"action": "update", "collection": item.collection, "key": item.key}))
-    return {"success": True, "collection": item.collection, "key": item.key, "message": "Data stored successfully"}
+    
+    for change, seq in zip(changes, seqs):
+        change["seq"] = seq
+    return changes
+
+@app.post("/data/batch")
+async def batch_write(batch: BatchRequest, username: str = Depends(verify_token)):
+    """Apply many set/delete operations atomically, with one combined change event"""
+    operations = batch.operations
+    if not operations:
+        raise HTTPException(status_code=400, detail="No operations")
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_OPERATIONS} operations per batch")
+    for operation in operations:
+        if operation.op not in ("set", "delete"):
+            raise HTTPException(status_code=400, detail=f"Unknown operation: {operation.op}")
+        if operation.op == "set" and operation.value is None:
+            raise HTTPException(status_code=400, detail=f"Missing value for {operation.collection}:{operation.key}")
+    # Each document is checked against its stored state, so it may appear only once
+    seen = set()
+    for operation in operations:
+        data_id = f"{operation.collection}:{operation.key}"
+        if data_id in seen:
+            raise HTTPException(status_code=400, detail=f"{data_id} appears more than once in the batch")
+        seen.add(data_id)
+    
+    changes = await db_executor.run_session(_apply_batch, operations, username)
+    for change in changes:
+        data_cache.invalidate(f"{change['collection']}:{change['key']}")
+    manager.publish_changes(changes)
+    return {"success": True, "count": len(changes), "results": changes}
 
 @app.get("/data/get/{collection}/{key}")
-async def get_data(collection: str, key: str, username: str = Depends(verify_token), db: Session = Depends(get_db)):
-    if not security_rules.validate_read(collection, username):
+async def get_data(collection: str, key: str, username: str = Depends(verify_token)):
+    if not security_rules.validate_collection_read(collection, username):
         raise HTTPException(status_code=403, detail=f"Read access denied to collection: {collection}")
     
-    data_id = f"{collection}:{key}"
-    data = db.query(DataDB).filter(DataDB.id == data_id).first()
+    data = data_cache.get(f"{collection}:{key}")
+    if data is None:
+        data = await db_executor.run_session(_load_data, collection, key, data_cache.read_token())
     if not data:
         raise HTTPException(status_code=404, detail="Data not found")
     
-    resource_data = {"owner": data.owner, "id": data.id}
+    resource_data = {"owner": data["owner"], "id": data["id"]}
     if not security_rules.validate_read(collection, username, resource_data):
         raise HTTPException(status_code=403, detail="Not authorized to read this data")
     
-    return {
+    return _json_response({
         "success": True,
         "collection": collection,
         "key": key,
-        "data": json.loads(data.value),
-        "owner": data.owner
-    }
+        "data": data["data"],
+        "owner": data["owner"]
+    })
 
-@app.get("/data/list/{collection}")
-async def list_collection(collection: str, username: str = Depends(verify_token), db: Session = Depends(get_db)):
-    if not security_rules.validate_read(collection, username):
-        raise HTTPException(status_code=403, detail=f"Read access denied to collection: {collection}")
+@app.post("/data/getMany")
+async def get_many(request: GetManyRequest, username: str = Depends(verify_token)):
+    """Read many documents, across collections, in one round trip"""
+    refs = list({f"{item.collection}:{item.key}": item for item in request.items}.items())
+    if not refs:
+        raise HTTPException(status_code=400, detail="No items")
+    if len(refs) > MAX_GET_MANY:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_GET_MANY} items per request")
+    for collection in {item.collection for _, item in refs}:
+        if not security_rules.validate_collection_read(collection, username):
+            raise HTTPException(status_code=403, detail=f"Read access denied to collection: {collection}")
+    
+    entries = {}
+    misses = []
+    for data_id, _ in refs:
+        entry = data_cache.get(data_id)
+        if entry is None:
+            misses.append(data_id)
+        else:
+            entries[data_id] = entry
+    if misses:
+        entries.update(await db_executor.run_session(_load_many, misses, data_cache.read_token()))
     
-    data_items = db.query(DataDB).filter(DataDB.collection == collection).all()
-    filtered_items = {}
-    for item in data_items:
-        resource_data = {"owner": item.owner, "id": item.id}
-        if security_rules.validate_read(collection, username, resource_data):
-            filtered_items[item.key] = json.loads(item.value)
+    items, missing, denied = [], [], []
+    for data_id, item in refs:
+        ref = {"collection": item.collection, "key": item.key}
+        entry = entries.get(data_id)
+        if entry is None:
+            missing.append(ref)
+        elif not security_rules.validate_read(item.collection, username, {"owner": entry["owner"], "id": entry["id"]}):
+            denied.append(ref)
+        else:
+            items.append({**ref, "data": entry["data"], "owner": entry["owner"]})
     
-    return {"success": True, "collection": collection, "count": len(filtered_items), "items": filtered_items}
+    return _json_response({"success": True, "count": len(items), "items": items, "missing": missing,
+                           "denied": denied})
 
-@app.get("/data/query/{collection}")
-async def query_data(collection: str, where: str = None, orderBy: str = None, limit: int = None, 
-                    startAfter: str = None, username: str = Depends(verify_token), db: Session = Depends(get_db)):
-    if not security_rules.validate_read(collection, username):
+def _list_collection(db: Session, collection: str, pageSize: int, startAfter: str, streaming: bool, username: str):
+    if not security_rules.validate_collection_read(collection, username):
         raise HTTPException(status_code=403, detail=f"Read access denied to collection: {collection}")
     
-    data_items = db.query(DataDB).filter(DataDB.collection == collection).all()
-    query_data = []
-    for item in data_items:
-        resource_data = {"owner": item.owner, "id": item.id}
-        if security_rules.validate_read(collection, username, resource_data):
-            query_data.append({
-                "key": item.key,
-                "data": json.loads(item.value),
-                "owner": item.owner,
-                "created_at": item.created_at.isoformat()
-            })
+    query_params = {}
+    if pageSize: query_params["pageSize"] = pageSize
+    if startAfter: query_params["startAfter"] = startAfter
+    query = _parse_query(query_params)
+    
+    sql_queries = _compile_reads(db, collection, query, username)
+    
+    if streaming:
+        return _stream_response(_stream_page(collection, username, query, _list_item))
+    
+    next_cursor = None
+    if pageSize or startAfter:
+        sql_queries = _push_down_limit(sql_queries, collection, query)
+        page, next_cursor = _read_page(sql_queries, collection, username, query)
+        filtered_items = {item.key: value_codec.decode(item) for item in page}
+    else:
+        filtered_items = {item.key: value_codec.decode(item)
+                          for item in _readable_rows(sql_queries, collection, username)}
+    
+    return {"success": True, "collection": collection, "count": len(filtered_items), "items": filtered_items,
+            "nextCursor": next_cursor}
+
+@app.get("/data/list/{collection}")
+async def list_collection(request: Request, collection: str, pageSize: int = None, startAfter: str = None,
+                          stream: bool = False, username: str = Depends(verify_token)):
+    return _json_response(await db_executor.run_session(_list_collection, collection, pageSize, startAfter,
+                                                        _wants_stream(request, stream), username))
+
+def _query_data(db: Session, collection: str, where: str, orderBy: str, orderDirection: str, limit: int,
+                startAfter: str, pageSize: int, explain: bool, streaming: bool, username: str):
+    if not security_rules.validate_collection_read(collection, username):
+        raise HTTPException(status_code=403, detail=f"Read access denied to collection: {collection}")
     
     query_params = {}
     if where: query_params["where"] = where
     if orderBy: query_params["orderBy"] = orderBy
+    if orderDirection: query_params["orderDirection"] = orderDirection
     if limit: query_params["limit"] = limit
+    if pageSize: query_params["pageSize"] = pageSize
     if startAfter: query_params["startAfter"] = startAfter
     
-    query = query_parser.parse_query_params(query_params)
-    filtered_data = query_engine.apply_where(query_data, query["where"])
-    if query["order_by"]:
-        filtered_data = query_engine.apply_order_by(filtered_data, query["order_by"])
-    if query["limit"]:
-        filtered_data = query_engine.apply_limit(filtered_data, query["limit"])
+    query = _parse_query(query_params)
+    page_size = query_parser.effective_page_size(query)
+    model = _data_model(collection)
+    sql_queries = _compile_reads(db, collection, query, username)
+    
+    if sql_queries is not None:
+        if streaming:
+            return _stream_response(_stream_page(collection, username, query, _query_result))
+        sql_queries = _push_down_limit(sql_queries, collection, query)
+        page, next_cursor = _read_page(sql_queries, collection, username, query)
+        filtered_data = [_query_result(item) for item in page]
+    else:
+        # Fallback: evaluate the query in Python
+        data_items = _restrict_to_readable(db.query(model).filter(model.collection == collection),
+                                           collection, username, model)
+        query_results = [_query_result(item) for item in _readable_rows([data_items], collection, username)]
+        
+        filtered_data = query_engine.apply_where(query_results, query["where"])
+        filtered_data = query_engine.apply_order_by(filtered_data, query["order_by"], query["order_direction"])
+        filtered_data = query_engine.apply_start_after(filtered_data, query["start_after"], collection,
+                                                       query["order_by"], query["order_direction"])
+        
+        next_cursor = None
+        if page_size and len(filtered_data) > page_size:
+            filtered_data = query_engine.apply_limit(filtered_data, page_size)
+            last = filtered_data[-1]
+            next_cursor = query_parser.encode_cursor(query, last["data"], f"{collection}:{last['key']}")
+        
+        if streaming:
+            return _stream_response(_stream_results(filtered_data, next_cursor))
     
     items = {item["key"]: item["data"] for item in filtered_data}
-    return {
+    response = {
         "success": True,
         "collection": collection,
         "count": len(filtered_data),
         "query": query,
         "items": items,
-        "results": filtered_data
+        "results": filtered_data,
+        "nextCursor": next_cursor
     }
+    if explain:
+        plans = [query_compiler.explain(db, sql_query, query) for sql_query in sql_queries or [None]]
+        response["plan"] = plans[0] if len(plans) == 1 else {"strategy": "sql", "parts": plans}
+    return response
 
-@app.get("/data/collections")
-async def list_collections(username: str = Depends(verify_token), db: Session = Depends(get_db)):
-    """List all collections accessible to the current user"""
+@app.get("/data/query/{collection}")
+async def query_data(request: Request, collection: str, where: str = None, orderBy: str = None,
+                    orderDirection: str = None, limit: int = None, startAfter: str = None, pageSize: int = None,
+                    explain: bool = False, stream: bool = False, username: str = Depends(verify_token)):
+    return _json_response(await db_executor.run_session(_query_data, collection, where, orderBy, orderDirection,
+                                                        limit, startAfter, pageSize, explain,
+                                                        _wants_stream(request, stream), username))
+
+@app.get("/data/aggregate/{collection}")
+async def aggregate_data(collection: str, field: str, device: str = None, start: int = Query(None, alias="from"),
+                         end: int = Query(None, alias="to"), interval: int = None, maxPoints: int = None,
+                         username: str = Depends(verify_token)):
+    """Downsampled min/max/avg/count/last of a numeric field, read from the coarsest usable rollup"""
+    if not security_rules.validate_collection_read(collection, username):
+        raise HTTPException(status_code=403, detail=f"Read access denied to collection: {collection}")
+    # Rollups combine every document of the collection, so a per-document read rule
+    # (e.g. owner-only) can't be applied to them
+    if security_rules.depends_on_resource(collection, "read") and not security_rules.is_admin(username):
+        raise HTTPException(status_code=403, detail=f"Aggregates of {collection} include documents you can't read")
+    
+    result = await db_executor.run_session(rollup_manager.aggregate, collection, field, device, start, end,
+                                           interval, maxPoints)
+    return {"success": True, "collection": collection, "count": len(result["points"]), **result}
+
+def _list_collections(db: Session, username: str):
     try:
         # Get all unique collections from the database
         data_items = db.query(DataDB.collection).distinct().all()
+        collection_names = {item[0] for item in data_items}
+        if timeseries_store.has_readings(db):
+            collection_names.add(timeseries_store.COLLECTION)
         
         # Filter collections based on read permissions
         collections = []
-        for item in data_items:
-            collection = item[0]
-            if security_rules.validate_read(collection, username):
+        for collection in collection_names:
+            if security_rules.validate_collection_read(collection, username):
                 collections.append(collection)
         
         return {
@@ -281,16 +834,107 @@ async def list_collections(username: str = Depends(verify_token), db: Session =
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/data/collections")
+async def list_collections(username: str = Depends(verify_token)):
+    """List all collections accessible to the current user"""
+    return await db_executor.run_session(_list_collections, username)
     
-@app.delete("/data/delete/{collection}/{key}")
-async def delete_data(collection: str, key: str, username: str = Depends(verify_token), db: Session = Depends(get_db)):
+def _read_snapshot(db: Session, username: str, summary: bool) -> dict:
+    """Items (or document counts) of every collection the user may read"""
+    collection_names = {item[0] for item in db.query(DataDB.collection).distinct().all()}
+    if timeseries_store.has_readings(db):
+        collection_names.add(timeseries_store.COLLECTION)
+    
+    collections = {}
+    for collection in sorted(collection_names):
+        if not security_rules.validate_collection_read(collection, username):
+            continue
+        model = _data_model(collection)
+        sql_query = _restrict_to_readable(db.query(model).filter(model.collection == collection),
+                                          collection, username, model)
+        if not summary:
+            collections[collection] = {item.key: value_codec.decode(item)
+                                       for item in _readable_rows([sql_query], collection, username)}
+        elif security_rules.needs_row_check(collection, "read"):
+            collections[collection] = sum(1 for _ in _readable_rows([sql_query], collection, username))
+        else:
+            collections[collection] = sql_query.with_entities(func.count()).scalar()
+    return collections
+
+def _snapshot_etag(username: str, summary: bool, generation: int) -> str:
+    """Validator for a snapshot: changes with any data write, rule change or server restart"""
+    # Every data write path invalidates the hot-key cache, so its sequence is a write generation
+    tag = f"{SNAPSHOT_EPOCH}:{generation}:{security_rules.version}:{username}:{int(summary)}"
+    return '"' + hashlib.sha256(tag.encode()).hexdigest()[:32] + '"'
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
+@app.get("/data/snapshot")
+async def data_snapshot(request: Request, summary: bool = False,
+                        username: str = Depends(verify_token)):
+    """Every readable collection in one response; re-polling an unchanged snapshot costs a 304"""
+    # Taken before reading, so a write racing the read only makes the next poll miss
+    etag = _snapshot_etag(username, summary, data_cache.read_token())
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    
+    collections = await db_executor.run_session(_read_snapshot, username, summary)
+    return _json_response({"success": True, "summary": summary, "count": len(collections),
+                           "collections": collections}, headers)
 
+def _read_changes(db: Session, since: int, limit: int, collection: Optional[str], values: bool,
+                  token: int, username: str) -> dict:
+    """A page of the change log, reduced to the latest change per document the user may see"""
+    if collection is not None and not security_rules.validate_collection_read(collection, username):
+        raise HTTPException(status_code=403, detail=f"Read access denied to collection: {collection}")
+    
+    page = change_log.since(db, since, limit, collection)
+    readable = {}
+    latest = {}
+    for change in page["changes"]:
+        name = change["collection"]
+        if name not in readable:
+            readable[name] = security_rules.validate_collection_read(name, username)
+        data_id = f"{name}:{change['key']}"
+        if readable[name] and security_rules.validate_read(name, username, {"owner": change.pop("owner"), "id": data_id}):
+            # Later changes to a document replace earlier ones
+            latest.pop(data_id, None)
+            latest[data_id] = change
+    
+    if values:
+        updated = [data_id for data_id, change in latest.items() if change["action"] == "update"]
+        entries = _load_many(db, updated, token) if updated else {}
+        for data_id, change in latest.items():
+            entry = entries.get(data_id)
+            # Deleted again after this page, or no longer readable
+            if entry and security_rules.validate_read(change["collection"], username,
+                                                      {"owner": entry["owner"], "id": entry["id"]}):
+                change["data"] = entry["data"]
     
+    changes = list(latest.values())
+    return {"success": True, "since": since, "lastSeq": page["lastSeq"], "hasMore": page["hasMore"],
+            "reset": page["reset"], "count": len(changes), "changes": changes}
+
+@app.get("/data/changes")
+async def list_changes(since: int = 0, limit: int = None, collection: str = None, values: bool = False,
+                       username: str = Depends(verify_token)):
+    """Changes after sequence number since; continue from lastSeq, and reload everything on reset"""
+    if since < 0:
+        raise HTTPException(status_code=400, detail="since must not be negative")
+    return _json_response(await db_executor.run_session(_read_changes, since, limit, collection, values,
+                                                        data_cache.read_token(), username))
+
+def _delete_data(db: Session, collection: str, key: str, username: str):
     if not security_rules.validate_write(collection, username):
         raise HTTPException(status_code=403, detail=f"Write access denied to collection: {collection}")
     
-    data_id = f"{collection}:{key}"
-    data = db.query(DataDB).filter(DataDB.id == data_id).first()
+    data = _find_data(db, collection, key)
     if not data:
         raise HTTPException(status_code=404, detail="Data not found")
     
@@ -299,65 +943,231 @@ async def delete_data(collection: str, key: str, username: str = Depends(verify_
         raise HTTPException(status_code=403, detail="Not authorized to delete this data")
     
     db.delete(data)
+    seq, = change_log.append(db, [(collection, key, "delete", data.owner)])
     db.commit()
-    await manager.broadcast(json.dumps({"action": "delete", "collection": collection, "key": key}))
-    return {"success": True, "message": "Data deleted successfully"}
+    return seq
+
+@app.delete("/data/delete/{collection}/{key}")
+async def delete_data(collection: str, key: str, username: str = Depends(verify_token)):
+    seq = await db_executor.run_session(_delete_data, collection, key, username)
+    data_cache.invalidate(f"{collection}:{key}")
+    manager.publish({"action": "delete", "collection": collection, "key": key, "seq": seq})
+    return {"success": True, "seq": seq, "message": "Data deleted successfully"}
+
+# Time-series Endpoints
+def _read_timeseries(db: Session, device_id: str, start: int, end: int, limit: int, username: str):
+    collection = timeseries_store.COLLECTION
+    if not security_rules.validate_collection_read(collection, username):
+        raise HTTPException(status_code=403, detail=f"Read access denied to collection: {collection}")
+    
+    readings = timeseries_store.read_range(db, device_id, start, end, limit)
+    check_rows = security_rules.depends_on_resource(collection, "read")
+    points = []
+    for reading in readings:
+        resource_data = {"owner": reading.owner, "id": reading.id}
+        if not check_rows or security_rules.validate_read(collection, username, resource_data):
+            points.append({"ts": reading.ts, **value_codec.loads(reading.payload)})
+    
+    return {"success": True, "device_id": device_id, "from": start, "to": end, "count": len(points), "points": points}
+
+@app.get("/timeseries/{device_id}")
+async def read_timeseries(device_id: str, start: int = Query(None, alias="from"), end: int = Query(None, alias="to"),
+                          limit: int = None, username: str = Depends(verify_token)):
+    """Sensor readings of one device between from and to (ms since epoch, inclusive)"""
+    return await db_executor.run_session(_read_timeseries, device_id, start, end, limit, username)
 
 # File Storage Endpoints
+
 @app.post("/storage/upload")
 async def upload_file(file: UploadFile = File(...), is_public: str = Form("false"), 
-                     username: str = Depends(verify_token), db: Session = Depends(get_db)):
-    max_size = 10 * 1024 * 1024
-    file.file.seek(0, 2)
-    file_size = file.file.tell()
-    file.file.seek(0)
-    
-    if file_size > max_size:
-        raise HTTPException(status_code=400, detail="File too large. Maximum size is 10MB.")
-    
-    file_info = await file_storage.save_upload_file(file, username, is_public.lower() == "true")
+                     username: str = Depends(verify_token)):
+    # The size limit is enforced while the file is copied
+    try:
+        file_info = await file_storage.save_upload_file(file, username, is_public.lower() == "true")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     file_record = FileDB(
         id=file_info["file_id"],
         filename=file_info["filename"],
         original_filename=file_info["original_filename"],
-        file_path=file_info["file_path"],
         file_size=file_info["file_size"],
+        sha256=file_info["sha256"],
         mime_type=file_info["mime_type"],
         owner=username,
         is_public=is_public,
         created_at=datetime.utcnow()
     )
-    db.add(file_record)
-    db.commit()
+    # Stored as a reference to the blob with the same content
+    await db_executor.run_session(file_storage.add_file, file_record, file_info["upload_path"])
     
     return {
         "success": True,
         "file_id": file_info["file_id"],
         "filename": file_info["original_filename"],
         "file_size": file_info["file_size"],
+        "sha256": file_info["sha256"],
         "mime_type": file_info["mime_type"],
         "is_public": file_info["is_public"],
         "download_url": f"/storage/download/{file_info['file_id']}",
         "message": "File uploaded successfully"
     }
 
-@app.get("/storage/download/{file_id}")
-async def download_file(file_id: str, username: str = Depends(verify_token), db: Session = Depends(get_db)):
+def _find_file(db: Session, file_id: str) -> Optional[FileDB]:
     file_record = db.query(FileDB).filter(FileDB.id == file_id).first()
+    if file_record:
+        db.expunge(file_record)
+    return file_record
+
+def _not_modified(request: Request, etag: Optional[str], last_modified: datetime) -> bool:
+    """Conditional GET: If-None-Match wins over If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return etag is not None and _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return False
+    return last_modified.replace(microsecond=0) <= since
+
+@app.get("/storage/download/{file_id}")
+async def download_file(request: Request, file_id: str, username: str = Depends(verify_token)):
+    """Download a file; supports Range/If-Range (206) and conditional requests (304)"""
+    file_record = await db_executor.run_session(_find_file, file_id)
     if not file_record:
         raise HTTPException(status_code=404, detail="File not found")
     if file_record.is_public != "true" and file_record.owner != username:
         raise HTTPException(status_code=403, detail="Not authorized to access this file")
     if not os.path.exists(file_record.file_path):
         raise HTTPException(status_code=404, detail="File not found on server")
+    
+    # Files are immutable once stored, so the content hash is a strong validator
+    # and If-Range resumes stay valid across restarts
+    etag = f'"{file_record.sha256}"' if file_record.sha256 else None
+    headers = {
+        "Last-Modified": formatdate(calendar.timegm(file_record.created_at.utctimetuple()), usegmt=True),
+        "Cache-Control": "private, no-cache",
+        "Accept-Ranges": "bytes"
+    }
+    if etag:
+        headers["ETag"] = etag
+    if _not_modified(request, etag, file_record.created_at):
+        return Response(status_code=304, headers=headers)
+    
+    # FileResponse answers Range requests with 206, and If-Range against these validators
     return FileResponse(
         path=file_record.file_path,
         filename=file_record.original_filename,
-        media_type=file_record.mime_type
+        media_type=file_record.mime_type,
+        headers=headers
     )
 
-@app.get("/storage/files")
-async def list_files(username: str = Depends(verify_token), db: Session = Depends(get_db)):
+# Resumable uploads: create a session, PATCH bytes at Upload-Offset, then complete
+def _find_upload_session(db: Session, upload_id: str, username: str) -> UploadSessionDB:
+    upload = db.query(UploadSessionDB).filter(UploadSessionDB.id == upload_id).first()
+    if not upload:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    if upload.owner != username:
+        raise HTTPException(status_code=403, detail="Not authorized to access this upload")
+    db.expunge(upload)
+    return upload
+
+def _upload_status(upload: UploadSessionDB, offset: int) -> JSONResponse:
+    return JSONResponse(
+        {"success": True, "upload_id": upload.id, "offset": offset, "size": upload.size,
+         "complete": offset == upload.size},
+        headers={"Upload-Offset": str(offset), "Upload-Length": str(upload.size)}
+    )
+
+@app.post("/storage/uploads")
+async def create_upload_session(spec: UploadSessionSpec, username: str = Depends(verify_token)):
+    """Start a resumable upload of spec.size bytes"""
+    try:
+        session = await db_executor.run_session(file_storage.create_session, spec.filename, spec.size,
+                                                spec.mime_type, spec.is_public, username)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, **session, "upload_url": f"/storage/uploads/{session['upload_id']}"}
+
+@app.get("/storage/uploads/{upload_id}")
+async def get_upload_session(upload_id: str, username: str = Depends(verify_token)):
+    """Bytes received so far; a client resumes with a PATCH at this offset"""
+    upload = await db_executor.run_session(_find_upload_session, upload_id, username)
+    return _upload_status(upload, file_storage.upload_offset(upload_id))
+
+@app.patch("/storage/uploads/{upload_id}")
+async def append_upload(request: Request, upload_id: str, username: str = Depends(verify_token)):
+    """Append the request body at the offset given in the Upload-Offset header"""
+    upload = await db_executor.run_session(_find_upload_session, upload_id, username)
+    try:
+        offset = int(request.headers["upload-offset"])
+    except (KeyError, ValueError):
+        raise HTTPException(status_code=400, detail="Upload-Offset header required")
+    
+    async with file_storage.session_lock(upload_id):
+        current = file_storage.upload_offset(upload_id)
+        if offset != current:
+            # The client's view is stale (e.g. a lost response); it resumes from current
+            raise HTTPException(status_code=409, detail=f"Upload is at offset {current}",
+                                headers={"Upload-Offset": str(current)})
+        try:
+            current = await file_storage.append_upload(upload_id, request.stream(), current, upload.size)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return _upload_status(upload, current)
+
+def _finish_upload(db: Session, upload_id: str, file_record: FileDB):
+    db.query(UploadSessionDB).filter(UploadSessionDB.id == upload_id).delete(synchronize_session=False)
+    # Commits the session removal together with the new file record
+    file_storage.add_file(db, file_record, file_storage.session_path(upload_id))
+
+@app.post("/storage/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, username: str = Depends(verify_token)):
+    """Store a fully received upload as a file"""
+    upload = await db_executor.run_session(_find_upload_session, upload_id, username)
+    async with file_storage.session_lock(upload_id):
+        offset = file_storage.upload_offset(upload_id)
+        if offset != upload.size:
+            raise HTTPException(status_code=409, detail=f"Upload is incomplete: {offset} of {upload.size} bytes",
+                                headers={"Upload-Offset": str(offset)})
+        sha256 = await asyncio.to_thread(file_storage.hash_file, file_storage.session_path(upload_id))
+        file_record = FileDB(
+            id=file_storage.generate_file_id(),
+            filename=upload.filename,
+            original_filename=upload.filename,
+            file_size=upload.size,
+            sha256=sha256,
+            mime_type=upload.mime_type,
+            owner=username,
+            is_public=upload.is_public,
+            created_at=datetime.utcnow()
+        )
+        await db_executor.run_session(_finish_upload, upload_id, file_record)
+    file_storage.forget_session(upload_id)
+    
+    return {
+        "success": True,
+        "file_id": file_record.id,
+        "filename": file_record.original_filename,
+        "file_size": file_record.file_size,
+        "sha256": sha256,
+        "mime_type": file_record.mime_type,
+        "is_public": upload.is_public == "true",
+        "download_url": f"/storage/download/{file_record.id}",
+        "message": "File uploaded successfully"
+    }
+
+@app.delete("/storage/uploads/{upload_id}")
+async def abort_upload(upload_id: str, username: str = Depends(verify_token)):
+    await db_executor.run_session(_find_upload_session, upload_id, username)
+    async with file_storage.session_lock(upload_id):
+        await db_executor.run_session(file_storage.remove_session, upload_id)
+    file_storage.forget_session(upload_id)
+    return {"success": True, "message": "Upload cancelled"}
+
+def _list_files(db: Session, username: str):
     files = db.query(FileDB).filter(FileDB.owner == username).all()
     file_list = []
     for file in files:
@@ -365,6 +1175,7 @@ async def list_files(username: str = Depends(verify_token), db: Session = Depend
             "file_id": file.id,
             "filename": file.original_filename,
             "file_size": file.file_size,
+            "sha256": file.sha256,
             "mime_type": file.mime_type,
             "is_public": file.is_public == "true",
             "created_at": file.created_at.isoformat(),
@@ -372,8 +1183,11 @@ async def list_files(username: str = Depends(verify_token), db: Session = Depend
         })
     return {"success": True, "files": file_list, "count": len(file_list)}
 
-@app.delete("/storage/delete/{file_id}")
-async def delete_file(file_id: str, username: str = Depends(verify_token), db: Session = Depends(get_db)):
+@app.get("/storage/files")
+async def list_files(username: str = Depends(verify_token)):
+    return await db_executor.run_session(_list_files, username)
+
+def _delete_file(db: Session, file_id: str, username: str):
     file_record = db.query(FileDB).filter(FileDB.id == file_id).first()
     if not file_record:
         raise HTTPException(status_code=404, detail="File not found")
@@ -384,6 +1198,12 @@ async def delete_file(file_id: str, username: str = Depends(verify_token), db: S
     else:
         raise HTTPException(status_code=500, detail="Failed to delete file")
 
+@app.delete("/storage/delete/{file_id}")
+async def delete_file(file_id: str, username: str = Depends(verify_token)):
+    result = await db_executor.run_session(_delete_file, file_id, username)
+    file_storage.request_gc()
+    return result
+
 # Security Rules Endpoints
 @app.get("/security/rules")
 async def get_security_rules(username: str = Depends(verify_token)):
@@ -391,28 +1211,122 @@ async def get_security_rules(username: str = Depends(verify_token)):
 
 @app.post("/security/rules/{collection}")
 async def update_security_rule(collection: str, rules: dict, username: str = Depends(verify_token)):
-    if collection not in security_rules.rules:
-        security_rules.rules[collection] = {}
-    if "read" in rules:
-        security_rules.rules[collection]["read"] = rules["read"]
-    if "write" in rules:
-        security_rules.rules[collection]["write"] = rules["write"]
-    return {"success": True, "message": f"Rules updated for {collection}"}
+    try:
+        # Compile both before installing either, so a bad rule changes nothing
+        for action in ("read", "write"):
+            if action in rules:
+                security_rules.compile_rule(rules[action])
+        for action in ("read", "write"):
+            if action in rules:
+                security_rules.set_rule(collection, action, rules[action])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "message": f"Rules updated for {collection}", "version": security_rules.version}
+
+# Index Endpoints
+@app.get("/indexes")
+async def list_indexes(username: str = Depends(verify_token)):
+    indexes = await db_executor.run_session(index_manager.list_indexes)
+    return {"success": True, "indexes": indexes, "count": len(indexes)}
+
+@app.get("/indexes/{collection}")
+async def list_collection_indexes(collection: str, username: str = Depends(verify_token)):
+    indexes = await db_executor.run_session(index_manager.list_indexes, collection)
+    return {"success": True, "collection": collection, "indexes": indexes, "count": len(indexes)}
+
+@app.post("/indexes/{collection}")
+async def create_index(collection: str, spec: IndexSpec, username: str = Depends(verify_token)):
+    # Indexes cover the whole data table, so every collection's writes pay for them
+    if not security_rules.is_admin(username):
+        raise HTTPException(status_code=403, detail="Only the admin user can manage indexes")
+    try:
+        index_info = await db_executor.run_session(index_manager.create_index, collection, spec.field)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "index": index_info, "message": f"Index created on {collection}.{spec.field}"}
+
+@app.delete("/indexes/{collection}/{field}")
+async def drop_index(collection: str, field: str, username: str = Depends(verify_token)):
+    if not security_rules.is_admin(username):
+        raise HTTPException(status_code=403, detail="Only the admin user can manage indexes")
+    if not await db_executor.run_session(index_manager.drop_index, collection, field):
+        raise HTTPException(status_code=404, detail="Index not found")
+    return {"success": True, "message": f"Index dropped on {collection}.{field}"}
+
+# Retention Endpoints
+@app.get("/retention")
+async def list_retention_policies(username: str = Depends(verify_token)):
+    policies = await db_executor.run_session(retention_manager.list_policies)
+    return {"success": True, "policies": policies, "stats": retention_manager.get_stats()}
+
+@app.post("/retention/run")
+async def run_retention(username: str = Depends(verify_token)):
+    # Runs every collection's policy, so it isn't scoped to one collection's write rule
+    if not security_rules.is_admin(username):
+        raise HTTPException(status_code=403, detail="Only the admin user can run retention")
+    deleted = await asyncio.to_thread(retention_manager.enforce_all)
+    return {"success": True, "deleted": deleted}
+
+@app.post("/retention/vacuum")
+async def vacuum_database(username: str = Depends(verify_token)):
+    """Rebuild the database file once so retention can give free pages back to the OS"""
+    # VACUUM blocks every reader and writer until the file is rewritten
+    if not security_rules.is_admin(username):
+        raise HTTPException(status_code=403, detail="Only the admin user can rebuild the database")
+    rebuilt = await asyncio.to_thread(retention_manager.enable_incremental_vacuum)
+    return {"success": True, "rebuilt": rebuilt, "auto_vacuum": retention_manager.auto_vacuum_mode()}
+
+@app.post("/retention/{collection}")
+async def set_retention_policy(collection: str, spec: RetentionSpec, username: str = Depends(verify_token)):
+    _require_collection_admin(collection, username)
+    try:
+        policy = await db_executor.run_session(retention_manager.set_policy, collection, spec.max_age_days,
+                                               spec.raw_max_age_days, spec.max_rows_per_device)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "policy": policy, "message": f"Retention policy set for {collection}"}
+
+@app.delete("/retention/{collection}")
+async def remove_retention_policy(collection: str, username: str = Depends(verify_token)):
+    _require_collection_admin(collection, username)
+    if not await db_executor.run_session(retention_manager.remove_policy, collection):
+        raise HTTPException(status_code=404, detail="Retention policy not found")
+    return {"success": True, "message": f"Retention policy removed for {collection}"}
 
 # System Endpoints
 @app.get("/system/status")
 async def system_status(username: str = Depends(verify_token)):
     return {
         "websocket_clients": len(manager.active_connections),
+        "websocket": manager.get_stats(),
         "mqtt_connected": mqtt_manager.client.is_connected(),
+        "indexes": await db_executor.run_session(index_manager.list_indexes),
+        "mqtt_ingest": ingest_buffer.get_stats(),
+        "retention": retention_manager.get_stats(),
+        "db_executor": db_executor.get_stats(),
+        "password_hasher": password_hasher.get_stats(),
+        "auth_cache": auth_cache.get_stats(),
+        "data_cache": data_cache.get_stats(),
+        "change_log": change_log.get_stats(),
+        "storage": file_storage.get_stats(),
+        "payload_codecs": payload_codecs.get_stats(),
+        "value_codec": value_codec.get_stats(),
         "timestamp": datetime.now().isoformat(),
         "version": "4.0.0"
     }
 
 # WebSocket
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.websocket_endpoint(websocket)
+async def websocket_endpoint(websocket: WebSocket, token: str = None):
+    # A token is optional; it is what lets subscriptions receive document values
+    username = None
+    if token:
+        try:
+            username = _authenticate(token)
+        except HTTPException:
+            await websocket.close(code=1008)
+            return
+    await manager.websocket_endpoint(websocket, username)
 
 # Main
 if __name__ == "__main__":
@@ -1,14 +1,28 @@
 # models.py
-from sqlalchemy import create_engine, Column, String, Text, DateTime, Integer
+from sqlalchemy import create_engine, event, Column, String, Text, DateTime, Integer, BigInteger, Float, Index, LargeBinary, text, cast, literal
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 
 # Database Setup
 SQLALCHEMY_DATABASE_URL = "sqlite:///./alphabase.db"
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # Must come before anything creates the database file (including the WAL
+    # switch); an existing file is converted by RetentionManager.enable_incremental_vacuum
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL lets readers run while the retention task deletes in small batches
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
+# Views are created by hand, so they live outside Base.metadata.create_all()
+ViewBase = declarative_base()
 
 class UserDB(Base):
     __tablename__ = "users"
@@ -22,9 +36,25 @@ class DataDB(Base):
     id = Column(String, primary_key=True)
     collection = Column(String, index=True)
     key = Column(String)
-    value = Column(Text)
+    value = Column(Text)  # JSON text; NULL when the value is stored in value_blob
+    value_blob = Column(LargeBinary)  # compressed JSON or a binary encoding, see value_codec
+    codec = Column(String)  # "json", "zlib", "msgpack"...; NULL for rows written before codecs
     owner = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Set by every write (upserts included); retention ages documents by it.
+    # Not an onupdate: re-encoding a value (value_codec.migrate) isn't a write.
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Keyset pagination walks a collection in id order
+        Index("ix_data_collection_id", "collection", "id"),
+        # Owner-scoped rules become "owner IS ?" filters; id keeps the page order
+        Index("ix_data_collection_owner", "collection", "owner", "id"),
+        # Finds the (few) rows of a collection that JSON1 queries can't read
+        Index("ix_data_binary", "collection", sqlite_where=text("value_blob IS NOT NULL")),
+        # Retention deletes documents not written since a cutoff
+        Index("ix_data_collection_updated", "collection", "updated_at"),
+    )
 
 class FileDB(Base):
     __tablename__ = "files"
@@ -33,7 +63,143 @@ class FileDB(Base):
     original_filename = Column(String)
     file_path = Column(String)
     file_size = Column(Integer)
+    sha256 = Column(String)  # hex digest, computed while the upload is written
     mime_type = Column(String)
     owner = Column(String)
     is_public = Column(String, default="false")
-    created_at = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class BlobDB(Base):
+    __tablename__ = "blobs"
+    sha256 = Column(String, primary_key=True)  # content address; the file lives under blobs/<aa>/<bb>/
+    size = Column(Integer)
+    refcount = Column(Integer, default=0)  # files rows pointing at this blob
+    created_at = Column(DateTime, default=datetime.utcnow)
+    released_at = Column(DateTime)  # when refcount dropped to 0; collected in the background
+
+class UploadSessionDB(Base):
+    __tablename__ = "upload_sessions"
+    id = Column(String, primary_key=True)
+    owner = Column(String, index=True)
+    filename = Column(String)
+    mime_type = Column(String)
+    is_public = Column(String, default="false")
+    size = Column(Integer)  # declared total; bytes received so far is the size of the partial file
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class IndexDB(Base):
+    __tablename__ = "indexes"
+    id = Column(String, primary_key=True)
+    collection = Column(String, index=True)
+    field = Column(String)
+    index_name = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class TimeSeriesDB(Base):
+    __tablename__ = "timeseries"
+    device_id = Column(String, primary_key=True)
+    ts = Column(BigInteger, primary_key=True)  # milliseconds since epoch
+    temperature = Column(Float)
+    humidity = Column(Float)
+    rssi = Column(Float)
+    uptime = Column(Float)
+    payload = Column(Text)
+    
+    # Rows are stored clustered on (device_id, ts), so a time range is one b-tree range
+    __table_args__ = {"sqlite_with_rowid": False}
+    
+    # Payload fields copied into the typed columns above
+    typed_fields = ("temperature", "humidity", "rssi", "uptime")
+    
+    # The same attributes as a DataDB row of the "sensors" collection
+    OWNER = "mqtt_bridge"
+    collection = "sensors"
+    value_blob = None
+    codec = "json"
+    
+    @property
+    def key(self) -> str:
+        return f"{self.device_id}_{self.ts}"
+    
+    # owner and id also work in SQL, so read rules can filter readings like data rows
+    @hybrid_property
+    def owner(self) -> str:
+        return self.OWNER
+    
+    @owner.expression
+    def owner(cls):
+        return literal(cls.OWNER)
+    
+    @hybrid_property
+    def id(self) -> str:
+        return f"{self.collection}:{self.key}"
+    
+    @id.expression
+    def id(cls):
+        return literal(f"{cls.collection}:") + cls.device_id + "_" + cast(cls.ts, String)
+    
+    @property
+    def value(self) -> str:
+        return self.payload
+    
+    @property
+    def created_at(self) -> datetime:
+        return datetime.utcfromtimestamp(self.ts / 1000)
+
+class RollupDB(Base):
+    __tablename__ = "rollups"
+    collection = Column(String, primary_key=True)
+    field = Column(String, primary_key=True)
+    resolution = Column(String, primary_key=True)  # "1m", "1h" or "1d"
+    series = Column(String, primary_key=True)  # device_id, or "*" for the whole collection
+    bucket_start = Column(BigInteger, primary_key=True)  # ms since epoch
+    min = Column(Float)
+    max = Column(Float)
+    sum = Column(Float)
+    count = Column(Integer)
+    last = Column(Float)
+    last_ts = Column(BigInteger)
+    
+    __table_args__ = {"sqlite_with_rowid": False}
+
+class RetentionPolicyDB(Base):
+    __tablename__ = "retention_policies"
+    collection = Column(String, primary_key=True)
+    max_age_days = Column(Float)  # raw rows and rollups
+    raw_max_age_days = Column(Float)  # raw rows only; rollups are kept
+    max_rows_per_device = Column(Integer)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class ChangeLogDB(Base):
+    __tablename__ = "changes"
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    collection = Column(String)
+    key = Column(String)
+    action = Column(String)  # "update" or "delete"
+    owner = Column(String)  # owner of the document when it changed, for read rules
+    ts = Column(BigInteger)  # ms since epoch
+    
+    __table_args__ = (
+        Index("ix_changes_collection_seq", "collection", "seq"),
+        # AUTOINCREMENT: sequence numbers are never reused, even after the log is trimmed
+        {"sqlite_autoincrement": True},
+    )
+
+class SensorsViewDB(ViewBase):
+    """Read-only view of the sensors collection: legacy data rows plus time-series readings"""
+    __tablename__ = "sensors_view"
+    id = Column(String, primary_key=True)
+    collection = Column(String)
+    key = Column(String)
+    value = Column(Text)
+    value_blob = Column(LargeBinary)
+    codec = Column(String)
+    owner = Column(String)
+    created_at = Column(DateTime)
+    # Typed reading columns (json_extract of the same fields for data rows)
+    temperature = Column(Float)
+    humidity = Column(Float)
+    rssi = Column(Float)
+    uptime = Column(Float)
+    
+    typed_fields = TimeSeriesDB.typed_fields
\ No newline at end of file
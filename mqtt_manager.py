@@ -1,18 +1,19 @@
 # mqtt_manager.py
 import paho.mqtt.client as mqtt
-import json
 import time
 import threading
-import asyncio
-from datetime import datetime
-from sqlalchemy.orm import Session
 
-from models import DataDB, SessionLocal
-from websocket_manager import manager
+from ingest_buffer import ingest_buffer
+from payload_codecs import payload_codecs
 
 class MQTTManager:
+    # Payload codec per topic filter ("json", "msgpack", "cbor"); other topics are sniffed
+    TOPIC_CODECS = {}
+    
     def __init__(self):
         self.client = mqtt.Client()
+        for topic_filter, codec in self.TOPIC_CODECS.items():
+            payload_codecs.set_topic_codec(topic_filter, codec)
         self.setup_callbacks()
         
     def setup_callbacks(self):
@@ -37,80 +38,45 @@ class MQTTManager:
         try:
             print(f"📨 MQTT -> AlphaBase: {msg.topic}")
             
-            payload = json.loads(msg.payload.decode())
+            codec = payload_codecs.codec_for_topic(msg.topic)
+            payload = payload_codecs.decode_document(msg.payload, codec)
             print(f"   Data: {payload}")
             
             # Store directly in AlphaBase database
             self.store_mqtt_data(msg.topic, payload)
             
-        except json.JSONDecodeError as e:
-            print(f"❌ Failed to parse JSON: {e}")
+        except ValueError as e:
+            print(f"❌ Failed to parse payload: {e}")
         except Exception as e:
             print(f"❌ MQTT processing error: {e}")
     
     def store_mqtt_data(self, topic, payload):
-        db = SessionLocal()
-        try:
-            if "sensors" in topic:
-                collection = "sensors"
-                device_id = payload.get("device_id", "unknown")
-                key = f"{device_id}_{int(time.time())}"
-                
-            elif "status" in topic:
-                collection = "devices" 
-                device_id = payload.get("device_id", "unknown")
-                key = device_id
-                
+        if "sensors" in topic:
+            # Readings go to the time-series store, keyed by receive time in ms
+            device_id = payload.get("device_id", "unknown")
+            ts = int(time.time() * 1000)
+            if ingest_buffer.submit_reading(device_id, ts, payload, source="mqtt"):
+                print(f"📥 MQTT reading queued: sensors/{device_id}@{ts}")
             else:
-                # For commands or other topics, just log them
-                print(f"💡 MQTT Command/Other: {topic} - {payload}")
-                return
-                
-            # Create data ID
-            data_id = f"{collection}:{key}"
-            
-            # Check if exists
-            existing = db.query(DataDB).filter(DataDB.id == data_id).first()
-            
-            if existing:
-                existing.value = json.dumps(payload)
-                existing.owner = "mqtt_bridge"
-            else:
-                new_data = DataDB(
-                    id=data_id,
-                    collection=collection,
-                    key=key,
-                    value=json.dumps(payload),
-                    owner="mqtt_bridge",  # Special owner for MQTT data
-                    created_at=datetime.utcnow()
-                )
-                db.add(new_data)
-            
-            db.commit()
-            
-            # Broadcast real-time update via WebSocket (FIXED)
-            try:
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    asyncio.run_coroutine_threadsafe(
-                        manager.broadcast(json.dumps({
-                            "action": "update",
-                            "collection": collection,
-                            "key": key,
-                            "source": "mqtt"
-                        })),
-                        loop
-                    )
-            except Exception as e:
-                print(f"⚠️  Could not broadcast via WebSocket: {e}")
+                print(f"⚠️  MQTT ingest queue full, dropped reading: sensors/{device_id}")
+            return
             
-            print(f"✅ MQTT data stored: {collection}/{key}")
+        elif "status" in topic:
+            collection = "devices" 
+            device_id = payload.get("device_id", "unknown")
+            key = device_id
             
-        except Exception as e:
-            print(f"❌ Database error: {e}")
-            db.rollback()
-        finally:
-            db.close()
+        else:
+            # For commands or other topics, just log them
+            print(f"💡 MQTT Command/Other: {topic} - {payload}")
+            return
+        
+        # Queue for the next group commit instead of committing on paho's
+        # network thread; the writer broadcasts once the batch is stored
+        if ingest_buffer.submit(collection, key, payload, owner="mqtt_bridge", source="mqtt"):
+            print(f"📥 MQTT data queued: {collection}/{key}")
+        else:
+            print(f"⚠️  MQTT ingest queue full, dropped: {collection}/{key}")
     
     def start(self):
         def run_mqtt():
@@ -123,6 +89,8 @@ class MQTTManager:
                 print(f"❌ MQTT connection failed: {e}")
                 print("💡 Make sure Mosquitto is running: mosquitto -c mosquitto.conf -v")
         
+        ingest_buffer.start()
+        
         # Start MQTT in background thread
         mqtt_thread = threading.Thread(target=run_mqtt)
         mqtt_thread.daemon = True
@@ -0,0 +1,140 @@
+# password_hasher.py
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, Optional
+
+from password_worker import init_worker, hash_password, verify_password
+
+class PasswordHasher:
+    """Argon2 hashing and verification in a process pool, so logins never hold the event loop"""
+    
+    # Environment variables overriding the defaults of the global instance
+    ENVIRONMENT = {
+        "max_workers": "ALPHABASE_HASH_WORKERS",
+        "time_cost": "ALPHABASE_ARGON2_TIME_COST",
+        "memory_cost": "ALPHABASE_ARGON2_MEMORY_COST",
+        "parallelism": "ALPHABASE_ARGON2_PARALLELISM"
+    }
+    
+    # Defaults match passlib's argon2 settings, so existing hashes keep verifying at the same cost
+    def __init__(self, max_workers: int = 2, time_cost: int = 3, memory_cost: int = 65536, parallelism: int = 4):
+        self.max_workers = max_workers
+        self.time_cost = time_cost
+        self.memory_cost = memory_cost
+        self.parallelism = parallelism
+        
+        for name in ("max_workers", "time_cost", "memory_cost", "parallelism"):
+            if getattr(self, name) < 1:
+                raise ValueError(f"{name} must be at least 1")
+        
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        
+        self.stats = {
+            "hashed": 0,
+            "verified": 0,
+            "failed_verifications": 0,
+            "in_flight": 0,
+            "max_in_flight": 0,
+            "max_latency_ms": 0.0,
+            "total_latency_ms": 0.0,
+            "total_worker_ms": 0.0
+        }
+    
+    @classmethod
+    def from_environment(cls) -> "PasswordHasher":
+        """Pool size and argon2 cost from ALPHABASE_* variables, defaults for unset ones"""
+        settings = {}
+        for name, variable in cls.ENVIRONMENT.items():
+            value = os.environ.get(variable)
+            if value:
+                try:
+                    settings[name] = int(value)
+                except ValueError:
+                    raise ValueError(f"{variable} must be an integer, got {value!r}")
+        return cls(**settings)
+    
+    def _get_pool(self) -> ProcessPoolExecutor:
+        """Start the worker processes on first use"""
+        with self._lock:
+            if self._pool is None:
+                # spawn: workers don't inherit the server's threads or database connections.
+                # They only import password_worker (and the main script, whose startup
+                # work runs in the lifespan, not at import).
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_worker,
+                    initargs=(self.time_cost, self.memory_cost, self.parallelism)
+                )
+            return self._pool
+    
+    async def hash(self, password: str) -> str:
+        """Hash a password with the configured argon2 cost"""
+        hashed, _ = await self._run(hash_password, password)
+        self._count("hashed")
+        return hashed
+    
+    async def verify(self, password: str, hashed: str) -> bool:
+        """Check a password against a stored hash"""
+        valid, _ = await self._run(verify_password, password, hashed)
+        self._count("verified")
+        if not valid:
+            self._count("failed_verifications")
+        return valid
+    
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self.stats["in_flight"] += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+        started = time.perf_counter()
+        try:
+            result, worker_ms = await loop.run_in_executor(self._get_pool(), fn, *args)
+        finally:
+            with self._lock:
+                self.stats["in_flight"] -= 1
+        
+        latency_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.stats["total_latency_ms"] += latency_ms
+            self.stats["max_latency_ms"] = max(self.stats["max_latency_ms"], latency_ms)
+            self.stats["total_worker_ms"] += worker_ms
+        return result, worker_ms
+    
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+    
+    def shutdown(self):
+        """Stop the worker processes; the next call starts a new pool"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.shutdown(wait=True)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Queue depth, latency (including queueing) and time spent hashing"""
+        with self._lock:
+            stats = dict(self.stats)
+        calls = stats["hashed"] + stats["verified"]
+        total_latency_ms = stats.pop("total_latency_ms")
+        total_worker_ms = stats.pop("total_worker_ms")
+        stats.update({
+            "max_workers": self.max_workers,
+            "argon2": {"time_cost": self.time_cost, "memory_cost": self.memory_cost, "parallelism": self.parallelism},
+            # Calls waiting for a free worker process
+            "queue_depth": max(0, stats["in_flight"] - self.max_workers),
+            "avg_latency_ms": round(total_latency_ms / calls, 2) if calls else 0.0,
+            "max_latency_ms": round(stats["max_latency_ms"], 2),
+            "avg_hash_ms": round(total_worker_ms / calls, 2) if calls else 0.0,
+            "avg_queue_wait_ms": round((total_latency_ms - total_worker_ms) / calls, 2) if calls else 0.0
+        })
+        return stats
+
+# Create global instance
+password_hasher = PasswordHasher.from_environment()
@@ -0,0 +1,38 @@
+# password_worker.py - Code run inside the password hashing processes
+#
+# Worker processes are started with "spawn" and import this module by name, so it
+# must only import the hashing library: nothing from the server, its database or
+# its background tasks.
+import time
+from typing import Optional, Tuple
+from passlib.context import CryptContext
+
+# Context of the current worker process, built once by init_worker
+_worker_context: Optional[CryptContext] = None
+
+def make_context(time_cost: int, memory_cost: int, parallelism: int) -> CryptContext:
+    return CryptContext(
+        schemes=["argon2"],
+        deprecated="auto",
+        argon2__rounds=time_cost,
+        argon2__memory_cost=memory_cost,
+        argon2__parallelism=parallelism
+    )
+
+def init_worker(time_cost: int, memory_cost: int, parallelism: int):
+    global _worker_context
+    _worker_context = make_context(time_cost, memory_cost, parallelism)
+
+def hash_password(password: str) -> Tuple[str, float]:
+    started = time.perf_counter()
+    hashed = _worker_context.hash(password)
+    return hashed, (time.perf_counter() - started) * 1000
+
+def verify_password(password: str, hashed: str) -> Tuple[bool, float]:
+    started = time.perf_counter()
+    try:
+        valid = _worker_context.verify(password, hashed)
+    except (ValueError, TypeError):
+        # Malformed or unknown stored hash
+        valid = False
+    return valid, (time.perf_counter() - started) * 1000
@@ -0,0 +1,154 @@
+# payload_codecs.py
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+
+from value_codec import value_codec
+
+# Binary codecs are optional; without them only JSON payloads are accepted
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    from paho.mqtt.client import topic_matches_sub
+except ImportError:
+    topic_matches_sub = None
+
+class PayloadCodecs:
+    """One decode layer for ingested payloads (JSON, MessagePack, CBOR), shared by HTTP and MQTT"""
+    
+    CODECS = ("json", "msgpack", "cbor")
+    
+    CONTENT_TYPES = {
+        "application/json": "json",
+        "application/msgpack": "msgpack",
+        "application/x-msgpack": "msgpack",
+        "application/vnd.msgpack": "msgpack",
+        "application/cbor": "cbor"
+    }
+    
+    def __init__(self):
+        # (MQTT topic filter, codec); the first match wins, unmatched topics use "auto"
+        self.topic_codecs: List[Tuple[str, str]] = []
+        self._lock = threading.Lock()
+        self.stats = {codec: {"decoded": 0, "failed": 0, "bytes": 0} for codec in self.CODECS}
+    
+    def available(self) -> List[str]:
+        return [codec for codec in self.CODECS if self._module(codec) is not None or codec == "json"]
+    
+    @staticmethod
+    def _module(codec: str):
+        return {"msgpack": msgpack, "cbor": cbor2}.get(codec)
+    
+    def codec_for_content_type(self, content_type: Optional[str]) -> str:
+        """Codec for an HTTP Content-Type; missing means JSON"""
+        media_type = (content_type or "application/json").split(";")[0].strip().lower()
+        codec = self.CONTENT_TYPES.get(media_type)
+        if codec is None:
+            raise ValueError(f"Unsupported content type: {media_type}")
+        return codec
+    
+    def set_topic_codec(self, topic_filter: str, codec: str):
+        """Decode messages on topics matching topic_filter (MQTT wildcards allowed) with codec"""
+        if codec not in self.CODECS + ("auto",):
+            raise ValueError(f"Unknown payload codec: {codec}")
+        with self._lock:
+            self.topic_codecs = [(existing, name) for existing, name in self.topic_codecs if existing != topic_filter]
+            self.topic_codecs.append((topic_filter, codec))
+    
+    def codec_for_topic(self, topic: str) -> str:
+        with self._lock:
+            rules = list(self.topic_codecs)
+        for topic_filter, codec in rules:
+            if topic_filter == topic or (topic_matches_sub and topic_matches_sub(topic_filter, topic)):
+                return codec
+        return "auto"
+    
+    @staticmethod
+    def sniff(data: bytes) -> str:
+        """Codec of a payload whose top level is a map; the first bytes differ per format"""
+        first = data.lstrip()[:1]
+        if not first or first in (b"{", b"["):
+            return "json"
+        byte = first[0]
+        if 0x80 <= byte <= 0x8f or byte in (0xde, 0xdf):
+            return "msgpack"
+        if 0xa0 <= byte <= 0xbb or byte == 0xbf:
+            return "cbor"
+        return "json"
+    
+    def decode(self, data: bytes, codec: str = "auto") -> Any:
+        """Decode a payload; raises ValueError if it is malformed or the codec isn't installed"""
+        if codec == "auto":
+            codec = self.sniff(data)
+        if codec not in self.CODECS:
+            raise ValueError(f"Unknown payload codec: {codec}")
+        if codec == "msgpack" and msgpack is None:
+            raise ValueError("MessagePack support needs the msgpack package")
+        if codec == "cbor" and cbor2 is None:
+            raise ValueError("CBOR support needs the cbor2 package")
+        try:
+            if codec == "json":
+                value = value_codec.loads(data)
+            elif codec == "msgpack":
+                value = msgpack.unpackb(data, raw=False)
+            else:
+                value = cbor2.loads(data)
+        except Exception as e:
+            # Each library has its own error types for malformed input
+            self._count(codec, "failed")
+            raise ValueError(f"Malformed {codec} payload: {str(e) or type(e).__name__}")
+        self._count(codec, "decoded", len(data))
+        return value
+    
+    def decode_document(self, data: bytes, codec: str = "auto") -> Dict[str, Any]:
+        """Decode a payload that must be an object (map)"""
+        if codec == "auto":
+            codec = self.sniff(data)
+        value = self.decode(data, codec)
+        if not isinstance(value, dict):
+            raise ValueError("Payload must be an object")
+        if codec != "json":
+            # Documents are stored as JSON; binary formats can also carry bytes, dates, tags...
+            self._check_json_types(value)
+        return value
+    
+    # Types a decoded document may hold and still be stored as JSON
+    _SCALAR_TYPES = frozenset((str, int, float, bool, type(None)))
+    
+    @classmethod
+    def _check_json_types(cls, value: Any):
+        scalars = cls._SCALAR_TYPES
+        items = value.items() if type(value) is dict else enumerate(value)
+        for key, item in items:
+            if type(key) not in scalars:
+                raise ValueError(f"Unsupported map key type: {type(key).__name__}")
+            kind = type(item)
+            if kind in scalars:
+                continue
+            if kind is dict or kind is list:
+                cls._check_json_types(item)
+            else:
+                raise ValueError(f"Unsupported value type: {kind.__name__}")
+    
+    def _count(self, codec: str, name: str, size: int = 0):
+        with self._lock:
+            stats = self.stats.get(codec)
+            if stats is not None:
+                stats[name] += 1
+                stats["bytes"] += size
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {codec: dict(counts) for codec, counts in self.stats.items()}
+            topic_codecs = [{"topic": topic_filter, "codec": codec} for topic_filter, codec in self.topic_codecs]
+        return {"available": self.available(), "topics": topic_codecs, "codecs": stats}
+
+# Create global instance
+payload_codecs = PayloadCodecs()
@@ -1,11 +1,19 @@
 # query_system.py
 import operator
-import json
+import base64
+import heapq
 from typing import List, Dict, Any, Optional
+from sqlalchemy import func, literal_column, tuple_, and_, or_
+from sqlalchemy.orm import Session, Query
+
+from models import DataDB, TimeSeriesDB
+from value_codec import value_codec
 
 class QueryParser:
     """Parse query parameters into query objects"""
     
+    MAX_PAGE_SIZE = 1000
+    
     @staticmethod
     def parse_where_condition(condition: str) -> Dict[str, Any]:
         """Parse a where condition like 'temperature>25' or 'name==John'"""
@@ -47,11 +55,13 @@ class QueryParser:
     @staticmethod
     def parse_query_params(params: Dict[str, str]) -> Dict[str, Any]:
         """Parse all query parameters into a query object"""
+        direction = None
         query = {
             "where": [],
             "order_by": None,
             "order_direction": "asc",
             "limit": None,
+            "page_size": None,
             "start_after": None
         }
         
@@ -65,7 +75,17 @@ class QueryParser:
                         query["where"].append(QueryParser.parse_where_condition(condition))
             
             elif key == "orderBy":
-                query["order_by"] = value
+                # "-field" sorts descending
+                if value.startswith("-"):
+                    query["order_by"] = value[1:]
+                    query["order_direction"] = "desc"
+                else:
+                    query["order_by"] = value
+            
+            elif key == "orderDirection":
+                if value not in ("asc", "desc"):
+                    raise ValueError("orderDirection must be 'asc' or 'desc'")
+                direction = value
             
             elif key == "limit":
                 try:
@@ -73,10 +93,61 @@ class QueryParser:
                 except:
                     query["limit"] = None
             
+            elif key == "pageSize":
+                try:
+                    query["page_size"] = min(int(value), QueryParser.MAX_PAGE_SIZE)
+                except:
+                    query["page_size"] = None
+            
             elif key == "startAfter":
-                query["start_after"] = value
+                query["start_after"] = QueryParser.decode_cursor(value)
+        
+        if direction:
+            query["order_direction"] = direction
+        if not query["order_by"]:
+            query["order_direction"] = "asc"
+        
+        cursor = query["start_after"]
+        if cursor and (cursor["order_by"], cursor["order_direction"]) != (query["order_by"], query["order_direction"]):
+            raise ValueError("Cursor was created for a different orderBy")
         
         return query
+    
+    @staticmethod
+    def effective_page_size(query: Dict[str, Any]) -> Optional[int]:
+        """Rows per page: the smaller of limit and pageSize"""
+        sizes = [size for size in (query["limit"], query["page_size"]) if size]
+        return min(sizes) if sizes else None
+    
+    @staticmethod
+    def encode_cursor(query: Dict[str, Any], data: Dict, data_id: str, reading: tuple = None) -> str:
+        """Build an opaque cursor pointing just after a row (reading: its (device_id, ts) key)"""
+        value = None
+        if query["order_by"]:
+            value = QueryEngine._get_nested_value(data, query["order_by"])
+            if isinstance(value, (dict, list)):
+                # json_extract returns objects and arrays as minified JSON text
+                value = value_codec.dumps(value)
+        
+        token = {"o": query["order_by"], "v": value, "k": data_id}
+        if query["order_direction"] == "desc":
+            token["d"] = "desc"
+        if reading is not None:
+            token["r"] = list(reading)
+        token = value_codec.dumps_bytes(token)
+        return base64.urlsafe_b64encode(token).decode().rstrip("=")
+    
+    @staticmethod
+    def decode_cursor(token: str) -> Dict[str, Any]:
+        """Decode a cursor created by encode_cursor"""
+        try:
+            padded = token + "=" * (-len(token) % 4)
+            cursor = value_codec.loads(base64.urlsafe_b64decode(padded.encode()))
+            reading = tuple(cursor["r"]) if cursor.get("r") else None
+            return {"order_by": cursor["o"], "order_direction": cursor.get("d", "asc"), "value": cursor["v"],
+                    "id": cursor["k"], "reading": reading}
+        except Exception:
+            raise ValueError("Invalid cursor")
 
 class QueryEngine:
     """Execute queries on data"""
@@ -96,46 +167,66 @@ class QueryEngine:
         """Apply where conditions to filter data"""
         if not conditions:
             return data
-        
-        filtered_data = []
-        for item in data:
-            matches_all = True
-            
-            for condition in conditions:
-                field = condition["field"]
-                op_func = QueryEngine.OPERATORS.get(condition["operator"])
-                value = condition["value"]
-                
-                # Get field value from nested data
-                field_value = QueryEngine._get_nested_value(item["data"], field)
-                
-                # Check if field exists for existence checks
-                if condition["operator"] == "==" and value is True:
-                    if field_value is None:
-                        matches_all = False
-                        break
-                    continue
-                
-                # Apply operator
-                if field_value is None or op_func is None or not op_func(field_value, value):
-                    matches_all = False
-                    break
-            
-            if matches_all:
-                filtered_data.append(item)
-        
-        return filtered_data
+        # Same semantics as the SQL path, so values of another type compare instead of raising
+        return [item for item in data if QueryEngine.matches_sql(item["data"], conditions)]
+    
+    @staticmethod
+    def sql_sort_key(value: Any) -> tuple:
+        """Key ordering values the way SQLite orders json_extract() results:
+        missing (NULL) first, then numbers and booleans, then text, objects and arrays"""
+        if value is None:
+            return (0, 0)
+        if isinstance(value, bool):
+            return (1, int(value))
+        if isinstance(value, (int, float)):
+            return (1, value)
+        if isinstance(value, (dict, list)):
+            # json_extract returns objects and arrays as minified JSON text
+            return (2, value_codec.dumps(value))
+        return (2, str(value))
+    
+    @staticmethod
+    def matches_sql(data: Any, conditions: List[Dict]) -> bool:
+        """Evaluate where conditions on one document with the semantics of the SQL translation"""
+        for condition in conditions:
+            field_value = QueryEngine._get_nested_value(data, condition["field"])
+            if condition["operator"] == "==" and condition["value"] is True:
+                if field_value is None:
+                    return False
+                continue
+            op_func = QueryEngine.OPERATORS.get(condition["operator"])
+            if field_value is None or op_func is None:
+                return False
+            if not op_func(QueryEngine.sql_sort_key(field_value), QueryEngine.sql_sort_key(condition["value"])):
+                return False
+        return True
+    
+    @staticmethod
+    def _row_key(item: Dict, field: Optional[str]) -> tuple:
+        """(field value, key): the (order field, id) order of the SQL path within one collection"""
+        value = QueryEngine._get_nested_value(item["data"], field) if field else None
+        # Values of mixed types (and missing ones) sort like SQLite does
+        return (QueryEngine.sql_sort_key(value), item["key"])
     
     @staticmethod
     def apply_order_by(data: List[Dict], field: str, direction: str = "asc") -> List[Dict]:
-        """Sort data by field"""
-        if not field:
+        """Sort data by field, then key (by key alone without a field)"""
+        return sorted(data, key=lambda item: QueryEngine._row_key(item, field), reverse=(direction == "desc"))
+    
+    @staticmethod
+    def apply_start_after(data: List[Dict], cursor: Optional[Dict], collection: str, field: str = None,
+                          direction: str = "asc") -> List[Dict]:
+        """Keep the rows after the cursor position of data sorted by apply_order_by"""
+        if not cursor:
             return data
-        
-        def get_sort_key(item):
-            return QueryEngine._get_nested_value(item["data"], field) or ""
-        
-        return sorted(data, key=get_sort_key, reverse=(direction == "desc"))
+        # Compare positions like keyset_condition, so a deleted cursor row still
+        # resumes at the right place
+        prefix = f"{collection}:"
+        cursor_id = cursor["id"][len(prefix):] if cursor["id"].startswith(prefix) else cursor["id"]
+        cursor_key = (QueryEngine.sql_sort_key(cursor["value"] if field else None), cursor_id)
+        if direction == "desc":
+            return [item for item in data if QueryEngine._row_key(item, field) < cursor_key]
+        return [item for item in data if QueryEngine._row_key(item, field) > cursor_key]
     
     @staticmethod
     def apply_limit(data: List[Dict], limit: int) -> List[Dict]:
@@ -156,6 +247,229 @@ class QueryEngine:
                 return None
         return current
 
+class BinaryMergeQuery:
+    """A compiled query on JSON rows, merged in query order with the collection's
+    compressed or binary rows, which JSON1 can't read and are matched in Python"""
+    
+    def __init__(self, sql_query: Query, binary_query: Query, query: Dict[str, Any]):
+        self.sql_query = sql_query
+        self.binary_query = binary_query
+        self.query = query
+    
+    # The Query methods the read endpoints use
+    def filter(self, *criteria) -> "BinaryMergeQuery":
+        return BinaryMergeQuery(self.sql_query.filter(*criteria), self.binary_query.filter(*criteria), self.query)
+    
+    def limit(self, limit: int) -> "BinaryMergeQuery":
+        # Binary rows are filtered after they are read, so only the SQL side can be limited
+        return BinaryMergeQuery(self.sql_query.limit(limit), self.binary_query, self.query)
+    
+    def with_session(self, session: Session) -> "BinaryMergeQuery":
+        return BinaryMergeQuery(self.sql_query.with_session(session), self.binary_query.with_session(session),
+                                self.query)
+    
+    def yield_per(self, count: int):
+        return heapq.merge(self.sql_query.yield_per(count), self._binary_rows(count), key=self._sort_key,
+                           reverse=self.query.get("order_direction") == "desc")
+    
+    def _sort_key(self, row) -> tuple:
+        """(order field, id): the ORDER BY of the compiled query"""
+        if not self.query["order_by"]:
+            return ((0, 0), row.id)
+        value = QueryEngine._get_nested_value(value_codec.decode(row), self.query["order_by"])
+        return (QueryEngine.sql_sort_key(value), row.id)
+    
+    def _binary_rows(self, count: int) -> List:
+        """Binary rows matching where and lying after the cursor, in query order"""
+        cursor = self.query["start_after"]
+        descending = self.query.get("order_direction") == "desc"
+        # Same shape as _sort_key (a cursor without orderBy has value None)
+        cursor_key = (QueryEngine.sql_sort_key(cursor["value"]), cursor["id"]) if cursor else None
+        
+        rows = []
+        for row in self.binary_query.yield_per(count):
+            if not QueryEngine.matches_sql(value_codec.decode(row), self.query["where"]):
+                continue
+            key = self._sort_key(row)
+            if cursor_key and (key >= cursor_key if descending else key <= cursor_key):
+                continue
+            rows.append(row)
+        rows.sort(key=self._sort_key, reverse=descending)
+        return rows
+
+class QueryCompiler:
+    """Compile parsed queries into SQLite JSON1 queries on the data table"""
+    
+    # Value types that can be bound as SQL parameters
+    BINDABLE_TYPES = (str, int, float, bool)
+    
+    @staticmethod
+    def json_path(field: str) -> Optional[str]:
+        """Convert dot notation into a quoted JSON path like '$."a"."b"'"""
+        segments = field.split('.')
+        if any(not segment or '"' in segment for segment in segments):
+            return None
+        return '$.' + '.'.join(f'"{segment}"' for segment in segments)
+    
+    @staticmethod
+    def path_literal(field: str) -> Optional[str]:
+        """Quote a field's JSON path as an SQL string literal"""
+        path = QueryCompiler.json_path(field)
+        if path is None:
+            return None
+        return "'" + path.replace("'", "''") + "'"
+    
+    @staticmethod
+    def field_expression(field: str, model=DataDB):
+        """Build a json_extract() expression for a field, or None if untranslatable"""
+        quoted_path = QueryCompiler.path_literal(field)
+        if quoted_path is None:
+            return None
+        # The path is inlined (not bound) so SQLite can match expression indexes
+        column = model.payload if model is TimeSeriesDB else model.value
+        return func.json_extract(column, literal_column(quoted_path))
+    
+    def condition_clause(self, condition: Dict[str, Any], model=DataDB):
+        """SQL condition for one where condition, or None if untranslatable"""
+        field, value = condition["field"], condition["value"]
+        
+        # Existence check, same semantics as QueryEngine.matches_sql
+        if condition["operator"] == "==" and value is True:
+            expression = self.field_expression(field, model)
+            return None if expression is None else expression.isnot(None)
+        
+        op_func = QueryEngine.OPERATORS.get(condition["operator"])
+        if op_func is None or not isinstance(value, self.BINDABLE_TYPES):
+            return None
+        
+        # Numeric comparisons on time-series fields use their typed column; it is
+        # NULL for non-numeric values, so != keeps going through the JSON
+        if (field in getattr(model, "typed_fields", ()) and condition["operator"] != "!="
+                and isinstance(value, (int, float)) and not isinstance(value, bool)):
+            return op_func(getattr(model, field), value)
+        
+        expression = self.field_expression(field, model)
+        if isinstance(value, bool):
+            # json_extract returns true/false as 1/0
+            value = int(value)
+        return None if expression is None else op_func(expression, value)
+    
+    def compile(self, db: Session, collection: str, query: Dict[str, Any], model=DataDB) -> Optional[Query]:
+        """Compile where/orderBy into a SQL query, or None to fall back to QueryEngine"""
+        sql_query = db.query(model).filter(model.collection == collection)
+        
+        for condition in query["where"]:
+            clause = self.condition_clause(condition, model)
+            if clause is None:
+                return None
+            sql_query = sql_query.filter(clause)
+        
+        if query["order_by"]:
+            expression = self.field_expression(query["order_by"], model)
+            if expression is None:
+                return None
+            if query.get("order_direction") == "desc":
+                sql_query = sql_query.order_by(expression.desc(), model.id.desc())
+            else:
+                sql_query = sql_query.order_by(expression, model.id)
+        else:
+            sql_query = sql_query.order_by(model.id)
+        
+        if query.get("start_after"):
+            sql_query = sql_query.filter(self.keyset_condition(query, model))
+        
+        # JSON1 can't look inside compressed or binary values; only those rows are matched in Python
+        if (query["where"] or query["order_by"]) and value_codec.has_binary_rows(db, collection):
+            binary_query = db.query(model).filter(model.collection == collection, model.value_blob.isnot(None))
+            return BinaryMergeQuery(sql_query.filter(model.value_blob.is_(None)), binary_query, query)
+        
+        return sql_query
+    
+    def compile_readings(self, db: Session, query: Dict[str, Any]) -> Optional[Query]:
+        """Compile where into a query on time-series readings in primary key order, or None"""
+        sql_query = db.query(TimeSeriesDB)
+        for condition in query["where"]:
+            clause = self.condition_clause(condition, TimeSeriesDB)
+            if clause is None:
+                return None
+            sql_query = sql_query.filter(clause)
+        
+        reading = query["start_after"] and query["start_after"].get("reading")
+        if reading:
+            device_id, ts = reading
+            # The redundant >= gives SQLite a range start on the primary key
+            sql_query = sql_query.filter(TimeSeriesDB.device_id >= device_id,
+                                         tuple_(TimeSeriesDB.device_id, TimeSeriesDB.ts) > tuple_(device_id, ts))
+        return sql_query.order_by(TimeSeriesDB.device_id, TimeSeriesDB.ts)
+    
+    def keyset_condition(self, query: Dict[str, Any], model=DataDB):
+        """Rows strictly after the cursor in (order field, id) order"""
+        cursor = query["start_after"]
+        last_value, last_id = cursor["value"], cursor["id"]
+        if isinstance(last_value, bool):
+            # json_extract returns true/false as 1/0
+            last_value = int(last_value)
+        
+        if not query["order_by"]:
+            return model.id > last_id
+        
+        # SQLite sorts NULL (missing fields) first ascending and last descending
+        expression = self.field_expression(query["order_by"], model)
+        if query.get("order_direction") == "desc":
+            if last_value is None:
+                return and_(expression.is_(None), model.id < last_id)
+            return or_(tuple_(expression, model.id) < tuple_(last_value, last_id), expression.is_(None))
+        
+        if last_value is None:
+            return or_(and_(expression.is_(None), model.id > last_id), expression.isnot(None))
+        # The redundant >= gives SQLite a range start on the expression index
+        return and_(expression >= last_value, tuple_(expression, model.id) > tuple_(last_value, last_id))
+    
+    def fallback_reason(self, query: Dict[str, Any]) -> str:
+        """Why compile() returned None for a query"""
+        for condition in query["where"]:
+            if self.json_path(condition["field"]) is None:
+                return f"Field {condition['field']!r} can't be addressed with a JSON path"
+            if condition["operator"] not in QueryEngine.OPERATORS:
+                return f"Operator {condition['operator']!r} has no SQL translation"
+            if not isinstance(condition["value"], self.BINDABLE_TYPES):
+                return f"Value of {condition['field']!r} can't be bound as a SQL parameter"
+        if query["order_by"] and self.json_path(query["order_by"]) is None:
+            return f"orderBy field {query['order_by']!r} can't be addressed with a JSON path"
+        return "Query could not be translated to SQL"
+    
+    def explain(self, db: Session, sql_query, query: Dict[str, Any] = None) -> Dict[str, Any]:
+        """Describe how a query will be executed"""
+        if sql_query is None:
+            return {
+                "strategy": "python",
+                "reason": self.fallback_reason(query) if query else "Query could not be translated to SQL"
+            }
+        
+        if isinstance(sql_query, BinaryMergeQuery):
+            plan = self.explain(db, sql_query.sql_query)
+            plan.update({
+                "strategy": "sql+python",
+                "reason": "Compressed or binary values can't be read by JSON1; "
+                          "those rows are matched in Python and merged in order",
+                "binary_rows": sql_query.binary_query.count()
+            })
+            return plan
+        
+        compiled = sql_query.statement.compile(dialect=db.get_bind().dialect)
+        params = [compiled.params[name] for name in compiled.positiontup]
+        plan_rows = db.connection().exec_driver_sql(
+            f"EXPLAIN QUERY PLAN {compiled}", tuple(params)
+        ).fetchall()
+        
+        return {
+            "strategy": "sql",
+            "sql": str(compiled),
+            "params": params,
+            "sqlite_plan": [row[-1] for row in plan_rows]
+        }
+
 # Create global instances
 query_parser = QueryParser()
-query_engine = QueryEngine()
\ No newline at end of file
+query_engine = QueryEngine()
+query_compiler = QueryCompiler()
\ No newline at end of file
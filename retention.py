@@ -0,0 +1,386 @@
+# retention.py
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Session
+
+from models import engine, SessionLocal, DataDB, TimeSeriesDB, RollupDB, RetentionPolicyDB
+from query_system import QueryCompiler
+from timeseries import timeseries_store
+from data_cache import data_cache
+from change_log import change_log
+from value_codec import value_codec
+
+class RetentionManager:
+    """Enforce per-collection retention rules with small incremental deletes"""
+    
+    # Rows deleted per transaction, and the pause between transactions so
+    # ingestion and reads can get the write lock in between
+    DELETE_BATCH_SIZE = 500
+    BATCH_PAUSE = 0.05
+    
+    # Pages released per PRAGMA incremental_vacuum after a run
+    VACUUM_PAGES = 2000
+    
+    DEFAULT_INTERVAL = 300  # seconds between background runs
+    
+    # Set to 1 to rebuild a file without incremental auto-vacuum when the server starts
+    VACUUM_ON_START_VARIABLE = "ALPHABASE_VACUUM_ON_START"
+    
+    # Values of PRAGMA auto_vacuum
+    AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+    
+    # Readings are stamped in milliseconds since this (naive UTC, like updated_at)
+    EPOCH = datetime(1970, 1, 1)
+    
+    def __init__(self):
+        self.stats = {
+            "runs": 0,
+            "last_run": None,
+            "last_duration_ms": 0.0,
+            "last_deleted": {},
+            "total_deleted": 0
+        }
+    
+    # -------------------------------------------------------------------------
+    # Policies
+    # -------------------------------------------------------------------------
+    
+    def set_policy(self, db: Session, collection: str, max_age_days: float = None,
+                   raw_max_age_days: float = None, max_rows_per_device: int = None) -> Dict[str, Any]:
+        """Create or replace the retention policy of a collection"""
+        for name, value in (("max_age_days", max_age_days), ("raw_max_age_days", raw_max_age_days),
+                            ("max_rows_per_device", max_rows_per_device)):
+            if value is not None and value <= 0:
+                raise ValueError(f"{name} must be positive")
+        
+        policy = db.query(RetentionPolicyDB).filter(RetentionPolicyDB.collection == collection).first()
+        if not policy:
+            policy = RetentionPolicyDB(collection=collection)
+            db.add(policy)
+        policy.max_age_days = max_age_days
+        policy.raw_max_age_days = raw_max_age_days
+        policy.max_rows_per_device = max_rows_per_device
+        policy.updated_at = datetime.utcnow()
+        db.commit()
+        return self._describe(policy)
+    
+    def remove_policy(self, db: Session, collection: str) -> bool:
+        deleted = db.query(RetentionPolicyDB).filter(RetentionPolicyDB.collection == collection).delete()
+        db.commit()
+        return deleted > 0
+    
+    def list_policies(self, db: Session) -> List[Dict[str, Any]]:
+        policies = db.query(RetentionPolicyDB).order_by(RetentionPolicyDB.collection).all()
+        return [self._describe(policy) for policy in policies]
+    
+    @staticmethod
+    def _describe(policy: RetentionPolicyDB) -> Dict[str, Any]:
+        return {
+            "collection": policy.collection,
+            "max_age_days": policy.max_age_days,
+            "raw_max_age_days": policy.raw_max_age_days,
+            "max_rows_per_device": policy.max_rows_per_device,
+            "updated_at": policy.updated_at.isoformat() if policy.updated_at else None
+        }
+    
+    # -------------------------------------------------------------------------
+    # Enforcement
+    # -------------------------------------------------------------------------
+    
+    def enforce_all(self) -> Dict[str, int]:
+        """Apply every policy, then give free pages back and checkpoint the WAL"""
+        started = time.perf_counter()
+        db = SessionLocal()
+        try:
+            policies = [self._describe(policy) for policy in db.query(RetentionPolicyDB).all()]
+        finally:
+            db.close()
+        
+        deleted = {}
+        for policy in policies:
+            try:
+                deleted[policy["collection"]] = self.enforce(policy)
+            except Exception as e:
+                print(f"❌ Retention failed for {policy['collection']}: {e}")
+        
+        self._trim_change_log()
+        self._migrate_values()
+        self.compact()
+        
+        total = sum(deleted.values())
+        self.stats["runs"] += 1
+        self.stats["last_run"] = datetime.now().isoformat()
+        self.stats["last_duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        self.stats["last_deleted"] = deleted
+        self.stats["total_deleted"] += total
+        if total:
+            print(f"🧹 Retention removed {total} rows: {deleted}")
+        return deleted
+    
+    def enforce(self, policy: Dict[str, Any]) -> int:
+        """Apply one collection's policy; returns the number of rows deleted"""
+        collection = policy["collection"]
+        now = datetime.utcnow()
+        deleted = 0
+        
+        raw_ages = [age for age in (policy["max_age_days"], policy["raw_max_age_days"]) if age]
+        if raw_ages:
+            cutoff = now - timedelta(days=min(raw_ages))
+            deleted += self._delete_raw_before(collection, cutoff)
+        
+        if policy["max_age_days"]:
+            cutoff = now - timedelta(days=policy["max_age_days"])
+            deleted += self._delete_rollups_before(collection, cutoff)
+        
+        if policy["max_rows_per_device"]:
+            deleted += self._trim_devices(collection, policy["max_rows_per_device"])
+        
+        return deleted
+    
+    def purge_collection(self, collection: str) -> int:
+        """Delete every raw row of a collection in small batches"""
+        return self._delete_raw_before(collection, None)
+    
+    def _delete_raw_before(self, collection: str, cutoff: Optional[datetime]) -> int:
+        deleted = self._delete_data_batches(collection, cutoff)
+        if collection == timeseries_store.COLLECTION:
+            cutoff_ms = int((cutoff - self.EPOCH).total_seconds() * 1000) if cutoff else None
+            # One device at a time keeps each batch a primary-key range scan
+            for device_id in self._reading_devices():
+                deleted += self._delete_readings_batches(device_id, cutoff_ms)
+        if deleted:
+            data_cache.invalidate_collection(collection)
+        return deleted
+    
+    @staticmethod
+    def _reading_devices() -> List[str]:
+        db = SessionLocal()
+        try:
+            return [row[0] for row in db.query(TimeSeriesDB.device_id).distinct().all()]
+        finally:
+            db.close()
+    
+    def _delete_data_batches(self, collection: str, cutoff: Optional[datetime],
+                             device_expression=None, device_id=None) -> int:
+        """Delete data rows last written before cutoff (all rows when cutoff is None)"""
+        deleted = 0
+        while True:
+            db = SessionLocal()
+            try:
+                query = db.query(DataDB.id, DataDB.key, DataDB.owner).filter(DataDB.collection == collection)
+                if cutoff is not None:
+                    query = query.filter(DataDB.updated_at < cutoff)
+                if device_expression is not None:
+                    query = query.filter(device_expression == device_id)
+                rows = query.limit(self.DELETE_BATCH_SIZE).all()
+                if not rows:
+                    return deleted
+                ids = [row.id for row in rows]
+                db.query(DataDB).filter(DataDB.id.in_(ids)).delete(synchronize_session=False)
+                change_log.append(db, [(collection, row.key, "delete", row.owner) for row in rows])
+                db.commit()
+                deleted += len(ids)
+            finally:
+                db.close()
+            time.sleep(self.BATCH_PAUSE)
+    
+    def _delete_data_rows(self, collection: str, rows: List[tuple]) -> int:
+        """Delete known (id, key, owner) data rows in batches"""
+        for start in range(0, len(rows), self.DELETE_BATCH_SIZE):
+            batch = rows[start:start + self.DELETE_BATCH_SIZE]
+            db = SessionLocal()
+            try:
+                db.query(DataDB).filter(DataDB.id.in_([row[0] for row in batch])).delete(synchronize_session=False)
+                change_log.append(db, [(collection, key, "delete", owner) for _, key, owner in batch])
+                db.commit()
+            finally:
+                db.close()
+            time.sleep(self.BATCH_PAUSE)
+        return len(rows)
+    
+    def _delete_readings_batches(self, device_id: str, cutoff_ms: Optional[int]) -> int:
+        """Delete a device's time-series readings older than cutoff_ms (all when None)"""
+        deleted = 0
+        while True:
+            db = SessionLocal()
+            try:
+                query = db.query(TimeSeriesDB.device_id, TimeSeriesDB.ts).filter(TimeSeriesDB.device_id == device_id)
+                if cutoff_ms is not None:
+                    query = query.filter(TimeSeriesDB.ts < cutoff_ms)
+                keys = [tuple(row) for row in query.limit(self.DELETE_BATCH_SIZE).all()]
+                if not keys:
+                    return deleted
+                db.query(TimeSeriesDB).filter(
+                    tuple_(TimeSeriesDB.device_id, TimeSeriesDB.ts).in_(keys)
+                ).delete(synchronize_session=False)
+                change_log.append(db, [(timeseries_store.COLLECTION, timeseries_store.key_for(device, ts), "delete",
+                                        TimeSeriesDB.OWNER) for device, ts in keys])
+                db.commit()
+                deleted += len(keys)
+            finally:
+                db.close()
+            time.sleep(self.BATCH_PAUSE)
+    
+    def _delete_rollups_before(self, collection: str, cutoff: datetime) -> int:
+        cutoff_ms = int((cutoff - self.EPOCH).total_seconds() * 1000)
+        deleted = 0
+        while True:
+            db = SessionLocal()
+            try:
+                keys = [tuple(row) for row in db.query(
+                    RollupDB.field, RollupDB.resolution, RollupDB.series, RollupDB.bucket_start
+                ).filter(
+                    RollupDB.collection == collection,
+                    RollupDB.bucket_start < cutoff_ms
+                ).limit(self.DELETE_BATCH_SIZE).all()]
+                if not keys:
+                    return deleted
+                db.query(RollupDB).filter(
+                    RollupDB.collection == collection,
+                    tuple_(RollupDB.field, RollupDB.resolution, RollupDB.series, RollupDB.bucket_start).in_(keys)
+                ).delete(synchronize_session=False)
+                db.commit()
+                deleted += len(keys)
+            finally:
+                db.close()
+            time.sleep(self.BATCH_PAUSE)
+    
+    def _trim_devices(self, collection: str, max_rows: int) -> int:
+        """Keep only the newest max_rows raw rows of each device, counted across data rows and readings"""
+        deleted = 0
+        device_expression = QueryCompiler.field_expression("device_id")
+        
+        db = SessionLocal()
+        try:
+            # Compressed/binary rows are invisible to json_extract; read their device in Python
+            binary_rows = self._binary_rows_by_device(db, collection)
+            devices = {row[0] for row in db.query(device_expression).filter(
+                DataDB.collection == collection, device_expression.isnot(None)
+            ).distinct().all()}
+            # Sensors devices also have readings; one cutoff covers both stores
+            reading_devices = set(self._reading_devices()) if collection == timeseries_store.COLLECTION else set()
+            cutoffs = []
+            stale_binary = []
+            for device_id in sorted(devices | set(binary_rows) | reading_devices, key=str):
+                binary = binary_rows.get(device_id, [])
+                written = [row[0] for row in binary]
+                if device_id in devices:
+                    written += [row[0] for row in db.query(DataDB.updated_at).filter(
+                        DataDB.collection == collection, device_expression == device_id, DataDB.updated_at.isnot(None)
+                    ).order_by(DataDB.updated_at.desc()).limit(max_rows).all()]
+                if device_id in reading_devices:
+                    written += [self.EPOCH + timedelta(milliseconds=row[0]) for row in db.query(TimeSeriesDB.ts).filter(
+                        TimeSeriesDB.device_id == device_id
+                    ).order_by(TimeSeriesDB.ts.desc()).limit(max_rows).all()]
+                if len(written) < max_rows:
+                    continue
+                cutoff = sorted(written, reverse=True)[max_rows - 1]
+                cutoffs.append((device_id, cutoff))
+                stale_binary.extend(row[1:] for row in binary if row[0] < cutoff)
+        finally:
+            db.close()
+        
+        for device_id, cutoff in cutoffs:
+            if device_id in devices:
+                deleted += self._delete_data_batches(collection, cutoff, device_expression, device_id)
+            if device_id in reading_devices:
+                # Round up: a reading earlier in the cutoff's millisecond is older than the cutoff
+                cutoff_ms = -((self.EPOCH - cutoff) // timedelta(milliseconds=1))
+                deleted += self._delete_readings_batches(device_id, cutoff_ms)
+        deleted += self._delete_data_rows(collection, stale_binary)
+        if deleted:
+            data_cache.invalidate_collection(collection)
+        return deleted
+    
+    @staticmethod
+    def _binary_rows_by_device(db: Session, collection: str) -> Dict[Any, List[tuple]]:
+        """device_id -> [(updated_at, id, key, owner)] for rows stored in value_blob"""
+        devices = {}
+        rows = db.query(DataDB).filter(
+            DataDB.collection == collection, DataDB.value_blob.isnot(None)
+        ).yield_per(100)
+        for row in rows:
+            try:
+                value = value_codec.decode(row)
+            except Exception:
+                continue
+            device_id = value.get("device_id") if isinstance(value, dict) else None
+            if device_id is not None and not isinstance(device_id, (dict, list)):
+                devices.setdefault(device_id, []).append((row.updated_at or row.created_at, row.id, row.key, row.owner))
+        return devices
+    
+    def _trim_change_log(self):
+        """Keep the change log bounded; clients further behind get a reset"""
+        db = SessionLocal()
+        try:
+            change_log.trim(db)
+        except Exception as e:
+            print(f"⚠️  Change log trim skipped: {e}")
+        finally:
+            db.close()
+    
+    def _migrate_values(self):
+        """Re-encode a batch of rows written before value codecs, a little per run"""
+        db = SessionLocal()
+        try:
+            migrated = value_codec.migrate(db)
+            if migrated:
+                print(f"🗜️  Re-encoded {migrated} data rows")
+        except Exception as e:
+            print(f"⚠️  Value migration skipped: {e}")
+        finally:
+            db.close()
+    
+    def auto_vacuum_mode(self) -> str:
+        with engine.connect() as conn:
+            return self.AUTO_VACUUM_MODES.get(conn.exec_driver_sql("PRAGMA auto_vacuum").scalar(), "unknown")
+    
+    def vacuum_on_start(self) -> bool:
+        return os.environ.get(self.VACUUM_ON_START_VARIABLE, "").lower() in ("1", "true", "yes")
+    
+    def enable_incremental_vacuum(self) -> bool:
+        """Rebuild the database file in incremental auto-vacuum mode; False if it already is"""
+        # Files created before auto_vacuum was set never give pages back to the OS, and
+        # only VACUUM can change the mode of a populated file. It rewrites the whole file
+        # and blocks every other connection while it runs, so it is never automatic.
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2:
+                return False
+            print("🗜️  Rebuilding database file for incremental auto-vacuum...")
+            started = time.perf_counter()
+            conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.exec_driver_sql("VACUUM")
+        print(f"✅ Database rebuilt in {time.perf_counter() - started:.1f}s")
+        return True
+    
+    def compact(self):
+        """Release free pages and truncate the WAL"""
+        connection = engine.raw_connection()
+        try:
+            # executescript steps the pragma to completion; a plain execute()
+            # frees only one page per step
+            connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({self.VACUUM_PAGES});")
+            connection.driver_connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        except Exception as e:
+            print(f"⚠️  Compaction skipped: {e}")
+        finally:
+            connection.close()
+    
+    async def run_forever(self, interval: float = DEFAULT_INTERVAL):
+        """Background loop: enforce policies every interval seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.enforce_all)
+            except Exception as e:
+                print(f"❌ Retention run failed: {e}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return dict(self.stats, auto_vacuum=self.auto_vacuum_mode())
+
+# Create global instance
+retention_manager = RetentionManager()
@@ -0,0 +1,158 @@
+# rollups.py
+import time
+from typing import List, Dict, Any, Optional, Tuple
+from sqlalchemy import func, case
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from models import RollupDB
+
+class RollupManager:
+    """Incremental min/max/avg/count/last rollups of numeric fields"""
+    
+    # Finest first; bucket widths in milliseconds
+    RESOLUTIONS = {
+        "1m": 60 * 1000,
+        "1h": 60 * 60 * 1000,
+        "1d": 24 * 60 * 60 * 1000
+    }
+    
+    # Numeric fields that are clocks or ids rather than measurements
+    EXCLUDED_FIELDS = ("timestamp", "ts")
+    
+    # Series used when a record has no device_id
+    ALL_SERIES = "*"
+    
+    # Rows per INSERT statement (10 bound values per row)
+    INSERT_CHUNK_SIZE = 1000
+    
+    DEFAULT_WINDOW_MS = 24 * 60 * 60 * 1000
+    DEFAULT_MAX_POINTS = 500
+    
+    @staticmethod
+    def series_for(payload: Dict[str, Any]) -> str:
+        """Rollups are kept per device when the record names one"""
+        device_id = payload.get("device_id")
+        return str(device_id) if device_id is not None else RollupManager.ALL_SERIES
+    
+    @classmethod
+    def numeric_fields(cls, payload: Dict[str, Any]):
+        for field, value in payload.items():
+            if field in cls.EXCLUDED_FIELDS or isinstance(value, bool):
+                continue
+            if isinstance(value, (int, float)):
+                yield field, float(value)
+    
+    def record(self, db: Session, events: List[Tuple[str, int, Dict[str, Any]]]):
+        """Fold (collection, ts_ms, payload) events into the rollups (caller commits)"""
+        buckets = {}
+        for collection, ts, payload in events:
+            series = self.series_for(payload)
+            for field, value in self.numeric_fields(payload):
+                for resolution, width in self.RESOLUTIONS.items():
+                    bucket_key = (collection, field, resolution, series, ts - ts % width)
+                    bucket = buckets.get(bucket_key)
+                    if bucket is None:
+                        buckets[bucket_key] = {"min": value, "max": value, "sum": value,
+                                               "count": 1, "last": value, "last_ts": ts}
+                        continue
+                    bucket["min"] = min(bucket["min"], value)
+                    bucket["max"] = max(bucket["max"], value)
+                    bucket["sum"] += value
+                    bucket["count"] += 1
+                    if ts >= bucket["last_ts"]:
+                        bucket["last"], bucket["last_ts"] = value, ts
+        
+        rows = [{
+            "collection": collection, "field": field, "resolution": resolution,
+            "series": series, "bucket_start": bucket_start, **bucket
+        } for (collection, field, resolution, series, bucket_start), bucket in buckets.items()]
+        
+        for start in range(0, len(rows), self.INSERT_CHUNK_SIZE):
+            stmt = insert(RollupDB).values(rows[start:start + self.INSERT_CHUNK_SIZE])
+            excluded = stmt.excluded
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[RollupDB.collection, RollupDB.field, RollupDB.resolution,
+                                RollupDB.series, RollupDB.bucket_start],
+                set_={
+                    "min": func.min(RollupDB.min, excluded.min),
+                    "max": func.max(RollupDB.max, excluded.max),
+                    "sum": RollupDB.sum + excluded.sum,
+                    "count": RollupDB.count + excluded.count,
+                    "last": case((excluded.last_ts >= RollupDB.last_ts, excluded.last), else_=RollupDB.last),
+                    "last_ts": func.max(RollupDB.last_ts, excluded.last_ts)
+                }
+            )
+            db.execute(stmt)
+    
+    def choose_resolution(self, interval_ms: int) -> str:
+        """Coarsest resolution whose buckets still fit inside the requested interval"""
+        chosen = next(iter(self.RESOLUTIONS))
+        for resolution, width in self.RESOLUTIONS.items():
+            if width <= interval_ms:
+                chosen = resolution
+        return chosen
+    
+    def aggregate(self, db: Session, collection: str, field: str, series: Optional[str] = None,
+                  start: Optional[int] = None, end: Optional[int] = None, interval_ms: Optional[int] = None,
+                  max_points: Optional[int] = None) -> Dict[str, Any]:
+        """Downsample a field into at most max_points buckets (or buckets of interval_ms)"""
+        end = end if end is not None else int(time.time() * 1000)
+        start = start if start is not None else end - self.DEFAULT_WINDOW_MS
+        if not interval_ms:
+            interval_ms = -(-(end - start) // (max_points or self.DEFAULT_MAX_POINTS))
+        
+        resolution = self.choose_resolution(interval_ms)
+        width = self.RESOLUTIONS[resolution]
+        # Output buckets are whole multiples of the rollup buckets they merge
+        interval_ms = max(width, interval_ms - interval_ms % width)
+        
+        query = db.query(RollupDB).filter(
+            RollupDB.collection == collection,
+            RollupDB.field == field,
+            RollupDB.resolution == resolution,
+            RollupDB.bucket_start >= start - start % width,
+            RollupDB.bucket_start <= end
+        )
+        if series is not None:
+            query = query.filter(RollupDB.series == series)
+        
+        points = {}
+        for rollup in query.yield_per(1000):
+            t = rollup.bucket_start - rollup.bucket_start % interval_ms
+            point = points.get(t)
+            if point is None:
+                points[t] = {"t": t, "min": rollup.min, "max": rollup.max, "sum": rollup.sum,
+                             "count": rollup.count, "last": rollup.last, "last_ts": rollup.last_ts}
+                continue
+            point["min"] = min(point["min"], rollup.min)
+            point["max"] = max(point["max"], rollup.max)
+            point["sum"] += rollup.sum
+            point["count"] += rollup.count
+            if rollup.last_ts >= point["last_ts"]:
+                point["last"], point["last_ts"] = rollup.last, rollup.last_ts
+        
+        results = []
+        for t in sorted(points):
+            point = points[t]
+            results.append({
+                "t": t,
+                "min": point["min"],
+                "max": point["max"],
+                "avg": point["sum"] / point["count"],
+                "count": point["count"],
+                "last": point["last"]
+            })
+        
+        return {
+            "field": field,
+            "series": series,
+            "from": start,
+            "to": end,
+            "resolution": resolution,
+            "interval_ms": interval_ms,
+            "points": results
+        }
+
+# Create global instance
+rollup_manager = RollupManager()
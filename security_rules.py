@@ -1,6 +1,266 @@
 # security_rules.py
+import re
+from typing import Dict, Tuple, Any, Callable, Optional
+from sqlalchemy import and_, or_, true, false
+
+# A rule is parsed into a small AST of tuples:
+#   ("const", bool)                   true / false
+#   ("and", left, right)              left && right
+#   ("or", left, right)               left || right
+#   ("not", operand)                  !operand
+#   ("cmp", "=="|"!=", left, right)   comparison of two values
+#   ("truthy", value)                 a bare value used as a condition
+# and values are:
+#   ("auth", path)                    auth, auth.uid, ...
+#   ("resource", path)                resource.owner, resource.id, ...
+#   ("literal", value)                'text', "text", 42, true, false, null
+
+class RuleSyntaxError(ValueError):
+    """Raised when a rule string cannot be parsed"""
+
+class RuleParser:
+    """Recursive-descent parser for the rule language"""
+    
+    TOKEN_PATTERN = re.compile(r"""
+        \s*(?:
+            (?P<op>==|!=|&&|\|\||!|\(|\)|\.)
+          | (?P<string>'[^']*'|"[^"]*")
+          | (?P<number>-?\d+(?:\.\d+)?)
+          | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+        )""", re.VERBOSE)
+    
+    def __init__(self, source: str):
+        self.source = source
+        self.tokens = self._tokenize(source)
+        self.position = 0
+    
+    def _tokenize(self, source: str):
+        tokens = []
+        position = 0
+        source = source.rstrip()
+        while position < len(source):
+            match = self.TOKEN_PATTERN.match(source, position)
+            if not match:
+                raise RuleSyntaxError(f"Unexpected character in rule at {position}: {source!r}")
+            kind = match.lastgroup
+            text = match.group(kind)
+            if kind == "string":
+                tokens.append(("literal", text[1:-1]))
+            elif kind == "number":
+                tokens.append(("literal", float(text) if "." in text else int(text)))
+            else:
+                tokens.append((kind, text))
+            position = match.end()
+        return tokens
+    
+    def parse(self) -> tuple:
+        if not self.tokens:
+            raise RuleSyntaxError("Empty rule")
+        node = self._parse_or()
+        if self.position != len(self.tokens):
+            raise RuleSyntaxError(f"Unexpected {self.tokens[self.position][1]!r} in rule: {self.source!r}")
+        return node
+    
+    def _peek(self) -> Optional[Tuple[str, Any]]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+    
+    def _accept(self, kind: str, text: str = None) -> bool:
+        token = self._peek()
+        if token and token[0] == kind and (text is None or token[1] == text):
+            self.position += 1
+            return True
+        return False
+    
+    def _expect_name(self) -> str:
+        token = self._peek()
+        if not token or token[0] != "name":
+            raise RuleSyntaxError(f"Expected a field name in rule: {self.source!r}")
+        self.position += 1
+        return token[1]
+    
+    def _parse_or(self) -> tuple:
+        node = self._parse_and()
+        while self._accept("op", "||"):
+            node = ("or", node, self._parse_and())
+        return node
+    
+    def _parse_and(self) -> tuple:
+        node = self._parse_unary()
+        while self._accept("op", "&&"):
+            node = ("and", node, self._parse_unary())
+        return node
+    
+    def _parse_unary(self) -> tuple:
+        if self._accept("op", "!"):
+            return ("not", self._parse_unary())
+        if self._accept("op", "("):
+            node = self._parse_or()
+            if not self._accept("op", ")"):
+                raise RuleSyntaxError(f"Missing ')' in rule: {self.source!r}")
+            return node
+        
+        left = self._parse_value()
+        token = self._peek()
+        if token and token[0] == "op" and token[1] in ("==", "!="):
+            self.position += 1
+            return ("cmp", token[1], left, self._parse_value())
+        if left[0] == "literal" and isinstance(left[1], bool):
+            return ("const", left[1])
+        return ("truthy", left)
+    
+    def _parse_value(self) -> tuple:
+        token = self._peek()
+        if token is None:
+            raise RuleSyntaxError(f"Unexpected end of rule: {self.source!r}")
+        self.position += 1
+        
+        if token[0] == "literal":
+            return token
+        if token[0] == "name":
+            name = token[1]
+            if name in ("auth", "resource"):
+                path = []
+                while self._accept("op", "."):
+                    path.append(self._expect_name())
+                return (name, tuple(path))
+            constants = {"true": True, "false": False, "null": None}
+            if name in constants:
+                return ("literal", constants[name])
+        raise RuleSyntaxError(f"Unexpected {token[1]!r} in rule: {self.source!r}")
+
+class CompiledRule:
+    """A parsed rule and the predicate compiled from it"""
+    
+    # resource.<field> -> column of the data models, for rules pushed into SQL
+    RESOURCE_COLUMNS = {"owner": "owner", "id": "id"}
+    
+    def __init__(self, source: str, version: int):
+        self.source = source
+        self.version = version
+        self.ast = RuleParser(source).parse()
+        self.depends_on_resource = self._uses_resource(self.ast)
+        self.sql_translatable = self._translatable(self.ast)
+        self.predicate: Callable[[Optional[str], Optional[dict]], bool] = self._compile(self.ast)
+    
+    def __call__(self, user: Optional[str], resource: Optional[dict]) -> bool:
+        return bool(self.predicate(user, resource))
+    
+    @classmethod
+    def _uses_resource(cls, node: tuple) -> bool:
+        kind = node[0]
+        if kind in ("resource", "auth", "literal", "const"):
+            return kind == "resource"
+        if kind == "cmp":
+            return cls._uses_resource(node[2]) or cls._uses_resource(node[3])
+        return any(cls._uses_resource(child) for child in node[1:])
+    
+    @classmethod
+    def _translatable(cls, node: tuple) -> bool:
+        """Whether to_sql() can express the rule exactly"""
+        kind = node[0]
+        if kind == "resource":
+            return len(node[1]) == 1 and node[1][0] in cls.RESOURCE_COLUMNS
+        if kind in ("auth", "literal", "const"):
+            return True
+        if kind == "truthy":
+            # Python truthiness of a column value has no exact SQL equivalent
+            return not cls._uses_resource(node)
+        if kind == "cmp":
+            return cls._translatable(node[2]) and cls._translatable(node[3])
+        return all(cls._translatable(child) for child in node[1:])
+    
+    def to_sql(self, user: Optional[str], model):
+        """SQL condition on model rows equivalent to this rule for user"""
+        return self._to_sql(self.ast, user, model)
+    
+    @classmethod
+    def _to_sql(cls, node: tuple, user: Optional[str], model, negate: bool = False):
+        kind = node[0]
+        if not cls._uses_resource(node):
+            # Only depends on the user: decide now
+            return true() if bool(cls._compile(node)(user, None)) != negate else false()
+        # Negation is pushed down to the comparisons (De Morgan) rather than wrapped
+        # in not_(), which SQLAlchemy drops around IS with a non-NULL value
+        if kind == "not":
+            return cls._to_sql(node[1], user, model, not negate)
+        if kind in ("and", "or"):
+            combine = and_ if (kind == "and") != negate else or_
+            return combine(cls._to_sql(node[1], user, model, negate), cls._to_sql(node[2], user, model, negate))
+        
+        op, left, right = node[1], node[2], node[3]
+        if user is None and cls._compares_auth_field(node):
+            return true() if negate else false()
+        if left[0] != "resource":
+            left, right = right, left
+        column = getattr(model, cls.RESOURCE_COLUMNS[left[1][0]])
+        if right[0] == "resource":
+            other = getattr(model, cls.RESOURCE_COLUMNS[right[1][0]])
+        else:
+            other = cls._compile_value(right)(user, None)
+        # IS / IS NOT compare NULLs like Python does and still use the index
+        return column.is_(other) if (op == "==") != negate else column.is_not(other)
+    
+    @classmethod
+    def _compile(cls, node: tuple) -> Callable:
+        kind = node[0]
+        if kind == "const":
+            value = node[1]
+            return lambda user, resource: value
+        if kind == "and":
+            left, right = cls._compile(node[1]), cls._compile(node[2])
+            return lambda user, resource: left(user, resource) and right(user, resource)
+        if kind == "or":
+            left, right = cls._compile(node[1]), cls._compile(node[2])
+            return lambda user, resource: left(user, resource) or right(user, resource)
+        if kind == "not":
+            operand = cls._compile(node[1])
+            return lambda user, resource: not operand(user, resource)
+        if kind == "truthy":
+            value = cls._compile_value(node[1])
+            return lambda user, resource: bool(value(user, resource))
+        
+        op, left, right = node[1], cls._compile_value(node[2]), cls._compile_value(node[3])
+        if cls._compares_auth_field(node):
+            # Without a user there is no auth.uid to match (not even a null owner)
+            if op == "==":
+                return lambda user, resource: user is not None and left(user, resource) == right(user, resource)
+            return lambda user, resource: user is not None and left(user, resource) != right(user, resource)
+        if op == "==":
+            return lambda user, resource: left(user, resource) == right(user, resource)
+        return lambda user, resource: left(user, resource) != right(user, resource)
+    
+    @staticmethod
+    def _compares_auth_field(node: tuple) -> bool:
+        """Whether a comparison reads a field of auth (auth.uid, ...) rather than auth itself"""
+        return any(value[0] == "auth" and value[1] for value in node[2:])
+    
+    @staticmethod
+    def _compile_value(node: tuple) -> Callable:
+        kind = node[0]
+        if kind == "literal":
+            value = node[1]
+            return lambda user, resource: value
+        
+        path = node[1]
+        if kind == "auth":
+            # The principal is just a username: auth is null or {"uid": user}
+            if path in ((), ("uid",)):
+                return lambda user, resource: user
+            return lambda user, resource: None
+        
+        def resource_value(user, resource):
+            current = resource
+            for name in path:
+                if not isinstance(current, dict):
+                    return None
+                current = current.get(name)
+            return current
+        return resource_value
 
 class SecurityRules:
+    # Cached decisions kept before the cache is reset
+    MAX_CACHED_DECISIONS = 10000
+    
     def __init__(self):
         # Default rules - similar to Firebase
         self.rules = {
@@ -11,7 +271,7 @@ class SecurityRules:
             },
             # Only authenticated users can access
             "devices": {
-                "read": "auth != null", 
+                "read": "auth != null",
                 "write": "auth != null"
             },
             # Only owner can access their own data
@@ -30,59 +290,84 @@ class SecurityRules:
                 "write": "auth != null"
             }
         }
+        
+        # Bumped on every rule change; cached decisions carry the version they were made under
+        self.version = 0
+        self.compiled: Dict[Tuple[str, str], CompiledRule] = {}
+        self.decisions: Dict[Tuple[str, str, Optional[str], int], bool] = {}
+        
+        for collection, actions in self.rules.items():
+            for action, rule in actions.items():
+                self.compiled[(collection, action)] = self.compile_rule(rule)
+    
+    def compile_rule(self, rule: str, version: int = None) -> CompiledRule:
+        """Parse and compile a rule string; raises ValueError on bad syntax"""
+        if not isinstance(rule, str):
+            raise RuleSyntaxError("Rules must be strings")
+        return CompiledRule(rule, self.version if version is None else version)
+    
+    def set_rule(self, collection: str, action: str, rule: str):
+        """Compile and install a read or write rule under a new version"""
+        if action not in ("read", "write"):
+            raise ValueError(f"Unknown rule action: {action}")
+        compiled = self.compile_rule(rule, self.version + 1)
+        self.version += 1
+        self.compiled[(collection, action)] = compiled
+        self.rules.setdefault(collection, {})[action] = rule
+        self.decisions.clear()
     
     def validate_read(self, collection: str, user: str = None, resource: dict = None) -> bool:
         """Check if user can read from collection"""
-        if collection not in self.rules:
-            # Default: authenticated users only for unknown collections
-            return user is not None
-        
-        rule = self.rules[collection]["read"]
-        return self._evaluate_rule(rule, user, resource)
+        return self._check(collection, "read", user, resource)
+    
+    def validate_collection_read(self, collection: str, user: str = None) -> bool:
+        """Check if user may read from a collection whose rows are then filtered by the rule"""
+        # Resource rules (e.g. owner-only) are decided per row, so the collection itself is open
+        return self.depends_on_resource(collection, "read") or self.validate_read(collection, user)
     
     def validate_write(self, collection: str, user: str = None, resource: dict = None) -> bool:
         """Check if user can write to collection"""
-        if collection not in self.rules:
-            # Default: authenticated users only for unknown collections
-            return user is not None
-        
-        rule = self.rules[collection]["write"]
-        return self._evaluate_rule(rule, user, resource)
+        return self._check(collection, "write", user, resource)
     
-    def _evaluate_rule(self, rule: str, user: str, resource: dict) -> bool:
-        """Evaluate a security rule"""
-        # Simple rule evaluation - in production you'd use a proper parser
-        
-        # auth != null  --> user is authenticated
-        if rule == "auth != null":
+    def sql_filter(self, collection: str, action: str, user: str = None, model=None):
+        """SQL condition selecting the rows a resource rule allows, or None if rows need no filter
+        or the rule can't be expressed in SQL (check rows with validate_* then)"""
+        rule = self.compiled.get((collection, action))
+        if rule is None or not rule.depends_on_resource or not rule.sql_translatable:
+            return None
+        return rule.to_sql(user, model)
+    
+    def needs_row_check(self, collection: str, action: str = "read") -> bool:
+        """Whether rows must still be checked one by one after sql_filter()"""
+        rule = self.compiled.get((collection, action))
+        return rule is not None and rule.depends_on_resource and not rule.sql_translatable
+    
+    def is_admin(self, user: str = None) -> bool:
+        """Admin user, as in the "auth.uid == 'admin'" rule"""
+        return user == "admin"
+    
+    def depends_on_resource(self, collection: str, action: str = "read") -> bool:
+        """Check if a collection rule needs the resource to be evaluated"""
+        rule = self.compiled.get((collection, action))
+        return rule is not None and rule.depends_on_resource
+    
+    def _check(self, collection: str, action: str, user: Optional[str], resource: Optional[dict]) -> bool:
+        rule = self.compiled.get((collection, action))
+        if rule is None:
+            # Default: authenticated users only for unknown collections (and missing actions)
             return user is not None
         
-        # auth == null --> user is not authenticated  
-        if rule == "auth == null":
-            return user is None
+        if rule.depends_on_resource:
+            return rule(user, resource)
         
-        # true --> always allow
-        if rule == "true":
-            return True
-        
-        # false --> never allow
-        if rule == "false":
-            return False
-        
-        # resource.owner == auth.uid --> user owns the resource
-        if rule == "resource.owner == auth.uid":
-            return resource and resource.get("owner") == user
-        
-        # resource.id == auth.uid --> user matches resource ID
-        if rule == "resource.id == auth.uid":
-            return resource and resource.get("id") == user
-        
-        # auth.uid == 'admin' --> user is admin
-        if "auth.uid == 'admin'" in rule:
-            return user == "admin"
-        
-        # Default: deny access
-        return False
+        cache_key = (collection, action, user, rule.version)
+        decision = self.decisions.get(cache_key)
+        if decision is None:
+            if len(self.decisions) >= self.MAX_CACHED_DECISIONS:
+                self.decisions.clear()
+            decision = rule(user, resource)
+            self.decisions[cache_key] = decision
+        return decision
 
 # Create global instance
 security_rules = SecurityRules()
\ No newline at end of file
@@ -0,0 +1,66 @@
+# conftest.py - Run the app against a throwaway database
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+# models binds sqlite:///./alphabase.db when it is imported, so move to an empty
+# directory first; uploads and the database then stay out of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="alphabase-tests-"))
+
+from fastapi.testclient import TestClient
+
+import main
+from models import SessionLocal, DataDB
+from value_codec import value_codec
+
+@pytest.fixture(scope="session")
+def client():
+    # Entering the client runs the lifespan, which creates the tables
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+def register(client, username: str) -> dict:
+    """Register a user and return its Authorization header"""
+    response = client.post("/auth/register", json={
+        "username": username, "email": f"{username}@example.com", "password": "secret"
+    })
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+@pytest.fixture(scope="session")
+def headers(client):
+    return register(client, "tester")
+
+@pytest.fixture(scope="session")
+def admin_headers(client):
+    return register(client, "admin")
+
+@pytest.fixture(scope="session")
+def other_headers(client):
+    """A second user, for ownership checks"""
+    return register(client, "intruder")
+
+@pytest.fixture
+def collection():
+    """A collection name no other test writes to"""
+    return f"c{uuid.uuid4().hex[:12]}"
+
+@pytest.fixture
+def db(client):
+    # The client's lifespan creates the tables
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+def add_document(db, collection: str, key: str, value, owner: str = "tester", **columns):
+    """Insert a data row directly, encoded like the write endpoints do"""
+    db.add(DataDB(id=f"{collection}:{key}", collection=collection, key=key, owner=owner,
+                  **value_codec.encode(value), **columns))
+    db.commit()
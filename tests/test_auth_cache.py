@@ -0,0 +1,41 @@
+# test_auth_cache.py - Cached token verification and /auth/me
+import time
+
+from auth_cache import AuthCache, auth_cache
+
+def test_me_is_served_from_the_cache_until_the_user_changes(client, headers):
+    token = headers["Authorization"].split()[1]
+    assert client.get("/auth/me", headers=headers).json()["username"] == "tester"
+    assert auth_cache.get_user(token)["username"] == "tester"
+
+    auth_cache.invalidate_user("tester")
+    assert auth_cache.get_user(token) is None
+    # The token itself is still valid and is verified again
+    assert client.get("/auth/me", headers=headers).json()["username"] == "tester"
+
+def test_invalidation_drops_every_token_of_a_user():
+    cache = AuthCache()
+    cache.put("t1", {"sub": "bob"})
+    cache.put("t2", {"sub": "bob"})
+    cache.put("t3", {"sub": "eve"})
+    cache.invalidate_user("bob")
+    assert cache.get("t1") is None and cache.get("t2") is None
+    assert cache.get("t3")["claims"]["sub"] == "eve"
+
+def test_entries_expire_with_the_token():
+    cache = AuthCache(ttl_seconds=300)
+    cache.put("old", {"sub": "bob", "exp": time.time() - 1})
+    assert cache.get("old") is None
+    assert "bob" not in cache.by_user
+
+def test_eviction_keeps_the_user_index_in_step():
+    cache = AuthCache(max_entries=2)
+    for n in range(3):
+        cache.put(f"t{n}", {"sub": f"user{n}"})
+    assert cache.get("t0") is None
+    assert set(cache.by_user) == {"user1", "user2"}
+
+def test_raw_tokens_are_not_stored():
+    cache = AuthCache()
+    cache.put("secret-token", {"sub": "bob"})
+    assert "secret-token" not in cache.entries
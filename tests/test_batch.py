@@ -0,0 +1,62 @@
+# test_batch.py - Transactional POST /data/batch
+import pytest
+
+from security_rules import security_rules
+
+def _batch(client, headers, *operations):
+    return client.post("/data/batch", json={"operations": [
+        {"op": op, "collection": collection, "key": key, **({"value": value} if value is not None else {})}
+        for op, collection, key, value in operations
+    ]}, headers=headers)
+
+def _get(client, headers, collection: str, key: str):
+    response = client.get(f"/data/get/{collection}/{key}", headers=headers)
+    return response.json()["data"] if response.status_code == 200 else None
+
+def test_sets_and_deletes_apply_together(client, headers, collection):
+    assert _batch(client, headers, ("set", collection, "a", {"n": 1}), ("set", collection, "b", {"n": 2})).status_code == 200
+    response = _batch(client, headers, ("set", collection, "a", {"n": 10}), ("delete", collection, "b", None))
+    assert response.status_code == 200, response.text
+    results = response.json()["results"]
+    assert [(result["key"], result["action"]) for result in results] == [("a", "update"), ("b", "delete")]
+    assert results[0]["seq"] < results[1]["seq"]
+    assert _get(client, headers, collection, "a") == {"n": 10}
+    assert _get(client, headers, collection, "b") is None
+
+@pytest.mark.parametrize("operations", [
+    [("set", "new", {"n": 1}), ("delete", "new", None)],
+    [("delete", "old", None), ("set", "old", {"n": 2})],
+    [("set", "old", {"n": 3}), ("set", "old", {"n": 4})]
+])
+def test_same_document_twice_is_rejected(client, headers, collection, operations):
+    _batch(client, headers, ("set", collection, "old", {"n": 0}))
+    response = _batch(client, headers, *[(op, collection, key, value) for op, key, value in operations])
+    assert response.status_code == 400
+    assert "more than once" in response.json()["detail"]
+    assert _get(client, headers, collection, "old") == {"n": 0}
+    assert _get(client, headers, collection, "new") is None
+
+def test_missing_document_fails_whole_batch(client, headers, collection):
+    response = _batch(client, headers, ("set", collection, "a", {"n": 1}), ("delete", collection, "ghost", None))
+    assert response.status_code == 404
+    assert _get(client, headers, collection, "a") is None
+
+def test_owner_rule_is_checked_per_document(client, headers, other_headers, collection):
+    security_rules.set_rule(collection, "write", "resource == null || resource.owner == auth.uid")
+    assert _batch(client, headers, ("set", collection, "mine", {"n": 1})).status_code == 200
+
+    response = _batch(client, other_headers, ("set", collection, "theirs", {"n": 1}),
+                      ("delete", collection, "mine", None))
+    assert response.status_code == 403
+    assert _get(client, headers, collection, "mine") == {"n": 1}
+    assert _get(client, headers, collection, "theirs") is None
+
+def test_collection_rule_is_checked(client, headers, collection):
+    security_rules.set_rule(collection, "write", "auth.uid == 'admin'")
+    response = _batch(client, headers, ("set", collection, "a", {"n": 1}))
+    assert response.status_code == 403
+
+def test_invalid_operations(client, headers, collection):
+    assert _batch(client, headers).status_code == 400
+    assert _batch(client, headers, ("upsert", collection, "a", {"n": 1})).status_code == 400
+    assert _batch(client, headers, ("set", collection, "a", None)).status_code == 400
@@ -0,0 +1,67 @@
+# test_changes.py - /data/changes paging and reset semantics
+from change_log import change_log
+
+def _set(client, headers, collection: str, key: str, value) -> int:
+    response = client.post("/data/set", json={"collection": collection, "key": key, "value": value}, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()["seq"]
+
+def _changes(client, headers, **params) -> dict:
+    response = client.get("/data/changes", params=params, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def test_pages_continue_from_last_seq(client, headers, collection):
+    first = _set(client, headers, collection, "a", {"n": 1})
+    for n in range(2, 6):
+        _set(client, headers, collection, f"k{n}", {"n": n})
+    latest = _set(client, headers, collection, "a", {"n": 6})
+
+    keys = []
+    since = first - 1
+    while True:
+        page = _changes(client, headers, since=since, limit=2, collection=collection)
+        assert not page["reset"]
+        keys.extend(change["key"] for change in page["changes"])
+        since = page["lastSeq"]
+        if not page["hasMore"]:
+            break
+    assert since == latest
+    # Changes are reduced per page, so "a" from the first page shows up again in the last
+    assert keys == ["a", "k2", "k3", "k4", "k5", "a"]
+
+def test_filtered_client_continues_from_the_newest_entry(client, headers, collection):
+    seq = _set(client, headers, collection, "a", {"n": 1})
+    latest = _set(client, headers, f"{collection}_other", "b", {"n": 2})
+    page = _changes(client, headers, since=seq, collection=collection)
+    assert page["changes"] == [] and not page["reset"]
+    assert page["lastSeq"] == latest
+
+def test_values_are_the_current_ones(client, headers, collection):
+    seq = _set(client, headers, collection, "a", {"n": 1})
+    _set(client, headers, collection, "a", {"n": 2})
+    page = _changes(client, headers, since=seq - 1, collection=collection, values="true")
+    assert [(change["key"], change["data"]) for change in page["changes"]] == [("a", {"n": 2})]
+
+def test_since_from_another_database_resets(client, headers, collection):
+    latest = _set(client, headers, collection, "a", {"n": 1})
+    page = _changes(client, headers, since=latest + 100)
+    assert page["reset"] and page["changes"] == []
+    assert page["lastSeq"] == latest
+
+def test_trimmed_history_resets(client, headers, db, collection, monkeypatch):
+    for n in range(4):
+        latest = _set(client, headers, collection, f"k{n}", {"n": n})
+    monkeypatch.setattr(change_log, "max_entries", 2)
+    change_log.trim(db)
+
+    # The two newest entries are still there: resuming right before them is fine
+    page = _changes(client, headers, since=latest - 2, collection=collection)
+    assert not page["reset"]
+    assert [change["key"] for change in page["changes"]] == ["k2", "k3"]
+
+    page = _changes(client, headers, since=latest - 3)
+    assert page["reset"] and page["lastSeq"] == latest
+
+def test_negative_since_is_rejected(client, headers):
+    assert client.get("/data/changes", params={"since": -1}, headers=headers).status_code == 400
@@ -0,0 +1,122 @@
+# test_cursors.py - Keyset cursors for /data/list and /data/query
+import json
+
+import pytest
+
+import main
+from query_system import query_parser, query_engine
+from timeseries import timeseries_store
+from conftest import add_document
+
+# Compressed: JSON1 can't read it, so ordered queries merge it in Python
+LARGE = "x" * 20000
+
+def _walk(client, headers, url: str) -> list:
+    """Keys of every page, following nextCursor"""
+    keys = []
+    cursor = None
+    seen = set()
+    while True:
+        page_url = url + (f"&startAfter={cursor}" if cursor else "")
+        response = client.get(page_url, headers=headers)
+        assert response.status_code == 200, response.text
+        body = response.json()
+        keys.extend(body["items"])
+        cursor = body["nextCursor"]
+        if not cursor:
+            return keys
+        assert cursor not in seen, f"{url} does not advance past {keys[-1]}"
+        seen.add(cursor)
+
+def _stream(client, headers, url: str):
+    response = client.get(url, headers={**headers, "Accept": main.NDJSON_MEDIA_TYPE})
+    assert response.status_code == 200, response.text
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    return [line["key"] for line in lines[:-1]], lines[-1]
+
+@pytest.fixture
+def documents(db, collection):
+    """Values with ties, a missing field, booleans and a compressed row"""
+    values = [3, 1, 2, 3, None, 1, True, False, 2, 3]
+    for n, value in enumerate(values):
+        document = {"label": f"doc{n}"} if value is None else {"n": value}
+        if n == 2:
+            document["big"] = LARGE
+        add_document(db, collection, f"k{n}", document)
+    return collection
+
+def test_cursor_round_trip():
+    query = query_parser.parse_query_params({"orderBy": "n", "orderDirection": "desc"})
+    token = query_parser.encode_cursor(query, {"n": {"a": 1}}, "c:k1", ("dev", 5))
+    cursor = query_parser.decode_cursor(token)
+    assert cursor == {"order_by": "n", "order_direction": "desc", "value": '{"a":1}', "id": "c:k1",
+                      "reading": ("dev", 5)}
+
+def test_cursor_must_match_query():
+    token = query_parser.encode_cursor(query_parser.parse_query_params({"orderBy": "n"}), {"n": 1}, "c:k1")
+    with pytest.raises(ValueError):
+        query_parser.parse_query_params({"orderBy": "n", "orderDirection": "desc", "startAfter": token})
+    with pytest.raises(ValueError):
+        query_parser.parse_query_params({"startAfter": "not-a-cursor"})
+
+def test_python_start_after_skips_through_cursor():
+    data = [{"key": f"k{n}", "data": {"n": n % 3}} for n in range(6)]
+    ordered = query_engine.apply_order_by(data, "n", "desc")
+    query = query_parser.parse_query_params({"orderBy": "n", "orderDirection": "desc"})
+    cursor = query_parser.decode_cursor(query_parser.encode_cursor(query, ordered[2]["data"], "c:" + ordered[2]["key"]))
+    rest = query_engine.apply_start_after(ordered, cursor, "c", "n", "desc")
+    assert rest == ordered[3:]
+
+def test_list_pages_cover_collection(client, headers, documents):
+    everything = list(client.get(f"/data/list/{documents}", headers=headers).json()["items"])
+    assert _walk(client, headers, f"/data/list/{documents}?pageSize=3") == everything
+    assert len(everything) == 10
+
+@pytest.mark.parametrize("direction", ["asc", "desc"])
+def test_query_pages_match_full_ordering(client, headers, documents, direction):
+    url = f"/data/query/{documents}?orderBy=n&orderDirection={direction}"
+    everything = list(client.get(url, headers=headers).json()["items"])
+    assert sorted(everything) == [f"k{n}" for n in range(10)]
+    assert _walk(client, headers, url + "&pageSize=3") == everything
+
+def test_filtered_pages_include_compressed_rows(client, headers, documents):
+    keys = _walk(client, headers, f"/data/query/{documents}?where=n>=2&orderBy=n&pageSize=2")
+    assert keys == ["k2", "k8", "k0", "k3", "k9"]
+
+def test_stream_reads_in_chunks(client, headers, documents, monkeypatch):
+    monkeypatch.setattr(main, "STREAM_BATCH_SIZE", 2)
+    url = f"/data/query/{documents}?orderBy=n&orderDirection=desc&pageSize=7"
+    page = client.get(url, headers=headers).json()
+    keys, done = _stream(client, headers, url)
+    assert keys == list(page["items"])
+    assert done == {"done": True, "count": 7, "nextCursor": page["nextCursor"]}
+    rest, done = _stream(client, headers, url + f"&startAfter={done['nextCursor']}")
+    assert len(keys + rest) == 10 and done["nextCursor"] is None
+    assert main.engine.pool.checkedout() == 0
+
+def test_sensors_pages_cross_from_documents_to_readings(client, headers, db):
+    collection = timeseries_store.COLLECTION
+    add_document(db, collection, "legacy", {"device_id": "old", "temperature": 5}, owner="mqtt_bridge")
+    timeseries_store.append(db, [{"device_id": device_id, "ts": 1700000000000 + n,
+                                  "payload": {"device_id": device_id, "temperature": 20 + n}}
+                                 for device_id in ("t1", "t2") for n in range(3)])
+    db.commit()
+
+    everything = list(client.get(f"/data/list/{collection}", headers=headers).json()["items"])
+    assert _walk(client, headers, f"/data/list/{collection}?pageSize=2") == everything
+    assert everything[0] == "legacy" and len(everything) == 7
+
+    keys = _walk(client, headers, f"/data/query/{collection}?where=temperature>=21&pageSize=2")
+    assert keys == [f"{device_id}_{1700000000000 + n}" for device_id in ("t1", "t2") for n in (1, 2)]
+
+def test_pages_ordered_by_objects_with_non_ascii_text(client, headers, db, collection):
+    names = ["é", "a", "ü", "a", "z", "é"]
+    for n, name in enumerate(names):
+        document = {"tag": {"name": name, "n": n % 2}}
+        if n == 4:
+            document["big"] = LARGE
+        add_document(db, collection, f"k{n}", document)
+    url = f"/data/query/{collection}?orderBy=tag"
+    everything = list(client.get(url, headers=headers).json()["items"])
+    assert len(everything) == 6
+    assert _walk(client, headers, url + "&pageSize=2") == everything
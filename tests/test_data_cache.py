@@ -0,0 +1,73 @@
+# test_data_cache.py - Hot-key cache for /data/get and the writes that invalidate it
+from datetime import datetime, timedelta
+
+import pytest
+
+from data_cache import DataCache, data_cache
+from retention import retention_manager
+from conftest import add_document
+
+def _get(client, headers, collection: str, key: str):
+    response = client.get(f"/data/get/{collection}/{key}", headers=headers)
+    return response.json()["data"] if response.status_code == 200 else None
+
+def _cached(collection: str, key: str) -> bool:
+    return f"{collection}:{key}" in data_cache.entries
+
+@pytest.fixture
+def cached(client, headers, collection):
+    """A document read once through /data/get, so it sits in the cache"""
+    client.post("/data/set", json={"collection": collection, "key": "a", "value": {"n": 1}}, headers=headers)
+    assert _get(client, headers, collection, "a") == {"n": 1}
+    assert _cached(collection, "a")
+    return collection
+
+def test_set_replaces_cached_value(client, headers, cached):
+    client.post("/data/set", json={"collection": cached, "key": "a", "value": {"n": 2}}, headers=headers)
+    assert not _cached(cached, "a")
+    assert _get(client, headers, cached, "a") == {"n": 2}
+
+def test_delete_drops_cached_value(client, headers, cached):
+    assert client.delete(f"/data/delete/{cached}/a", headers=headers).status_code == 200
+    assert _get(client, headers, cached, "a") is None
+
+def test_batch_drops_cached_values(client, headers, cached):
+    response = client.post("/data/batch", json={"operations": [
+        {"op": "set", "collection": cached, "key": "a", "value": {"n": 3}}
+    ]}, headers=headers)
+    assert response.status_code == 200, response.text
+    assert _get(client, headers, cached, "a") == {"n": 3}
+
+def test_retention_drops_cached_collection(client, headers, db, collection, monkeypatch):
+    monkeypatch.setattr(retention_manager, "BATCH_PAUSE", 0)
+    add_document(db, collection, "old", {"n": 1}, updated_at=datetime.utcnow() - timedelta(days=10))
+    assert _get(client, headers, collection, "old") == {"n": 1}
+    policy = {"collection": collection, "max_age_days": 5, "raw_max_age_days": None, "max_rows_per_device": None}
+    assert retention_manager.enforce(policy) == 1
+    assert not _cached(collection, "old")
+    assert _get(client, headers, collection, "old") is None
+
+def test_fill_started_before_a_write_is_rejected():
+    cache = DataCache()
+    token = cache.read_token()
+    cache.invalidate("c:a")
+    cache.put("c:a", {"data": {"n": 1}}, 10, token)
+    assert cache.get("c:a") is None
+    cache.put("c:a", {"data": {"n": 2}}, 10, cache.read_token())
+    assert cache.get("c:a")["data"] == {"n": 2}
+
+def test_collection_invalidation_rejects_older_fills_of_any_key():
+    cache = DataCache()
+    token = cache.read_token()
+    cache.invalidate_collection("c")
+    cache.put("c:never-written", {"data": {}}, 10, token)
+    assert cache.get("c:never-written") is None
+
+def test_byte_budget_evicts_least_recently_used():
+    cache = DataCache(max_bytes=3 * (DataCache.ENTRY_OVERHEAD + 100))
+    for key in ("a", "b", "c"):
+        cache.put(f"c:{key}", {"data": key}, 100, cache.read_token())
+    cache.get("c:a")
+    cache.put("c:d", {"data": "d"}, 100, cache.read_token())
+    assert set(cache.entries) == {"c:a", "c:c", "c:d"}
+    assert cache.bytes == 3 * (DataCache.ENTRY_OVERHEAD + 100)
@@ -0,0 +1,18 @@
+# test_file_storage.py - Blob store garbage collection and resumable upload sessions
+import os
+import time
+
+from file_storage import file_storage
+
+def test_expired_sessions_release_their_locks(client):
+    upload_id = "expired-session"
+    path = file_storage.session_path(upload_id)
+    with open(path, "wb") as partial:
+        partial.write(b"abc")
+    old = time.time() - file_storage.UPLOAD_SESSION_SECONDS - 60
+    os.utime(path, (old, old))
+    file_storage.session_lock(upload_id)
+
+    file_storage.collect_garbage()
+    assert not os.path.exists(path)
+    assert upload_id not in file_storage._session_locks
@@ -0,0 +1,17 @@
+# test_indexes.py - Declared JSON field indexes
+def test_only_admin_manages_indexes(client, headers, admin_headers, collection):
+    response = client.post(f"/indexes/{collection}", json={"field": "n"}, headers=headers)
+    assert response.status_code == 403
+
+    response = client.post(f"/indexes/{collection}", json={"field": "n"}, headers=admin_headers)
+    assert response.status_code == 200, response.text
+    listed = client.get(f"/indexes/{collection}", headers=headers).json()
+    assert [index["field"] for index in listed["indexes"]] == ["n"]
+
+    assert client.delete(f"/indexes/{collection}/n", headers=headers).status_code == 403
+    assert client.delete(f"/indexes/{collection}/n", headers=admin_headers).status_code == 200
+    assert client.get(f"/indexes/{collection}", headers=headers).json()["count"] == 0
+
+def test_invalid_field_is_rejected(client, admin_headers, collection):
+    response = client.post(f"/indexes/{collection}", json={"field": "a..b"}, headers=admin_headers)
+    assert response.status_code == 400
@@ -0,0 +1,24 @@
+# test_ingest_buffer.py - Write-behind queue configuration
+import pytest
+
+from ingest_buffer import IngestBuffer
+
+def test_settings_come_from_the_environment(monkeypatch):
+    monkeypatch.setenv("ALPHABASE_INGEST_QUEUE_SIZE", "50")
+    monkeypatch.setenv("ALPHABASE_INGEST_FLUSH_MS", "20")
+    monkeypatch.setenv("ALPHABASE_INGEST_POLICY", "drop_oldest")
+    buffer = IngestBuffer.from_environment()
+    assert buffer.queue.maxsize == 50
+    assert buffer.flush_interval == 0.02
+    assert buffer.policy == "drop_oldest"
+    assert buffer.batch_size == 200
+
+@pytest.mark.parametrize("variable, value", [
+    ("ALPHABASE_INGEST_BATCH_SIZE", "many"),
+    ("ALPHABASE_INGEST_QUEUE_SIZE", "0"),
+    ("ALPHABASE_INGEST_POLICY", "drop_everything")
+])
+def test_invalid_settings_are_rejected(monkeypatch, variable, value):
+    monkeypatch.setenv(variable, value)
+    with pytest.raises(ValueError):
+        IngestBuffer.from_environment()
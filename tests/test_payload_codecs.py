@@ -0,0 +1,57 @@
+# test_payload_codecs.py - Ingestion payload decoding for MQTT and /data/set
+import json
+
+import pytest
+
+from payload_codecs import PayloadCodecs
+
+msgpack = pytest.importorskip("msgpack")
+cbor2 = pytest.importorskip("cbor2")
+
+DOCUMENT = {"device_id": "esp32-01", "temperature": 21.5, "ok": True, "tags": ["a", None]}
+
+@pytest.mark.parametrize("codec, encode", [
+    ("json", lambda value: json.dumps(value).encode()),
+    ("msgpack", msgpack.packb),
+    ("cbor", cbor2.dumps)
+])
+def test_sniffed_documents_decode(codec, encode):
+    codecs = PayloadCodecs()
+    payload = encode(DOCUMENT)
+    assert codecs.sniff(payload) == codec
+    assert codecs.decode_document(payload) == DOCUMENT
+    assert codecs.get_stats()["codecs"][codec]["decoded"] == 1
+
+def test_content_types():
+    codecs = PayloadCodecs()
+    assert codecs.codec_for_content_type(None) == "json"
+    assert codecs.codec_for_content_type("application/vnd.msgpack; charset=binary") == "msgpack"
+    with pytest.raises(ValueError):
+        codecs.codec_for_content_type("text/plain")
+
+def test_topic_codecs():
+    codecs = PayloadCodecs()
+    codecs.set_topic_codec("alphabase/status", "cbor")
+    assert codecs.codec_for_topic("alphabase/status") == "cbor"
+    assert codecs.codec_for_topic("alphabase/other") == "auto"
+    with pytest.raises(ValueError):
+        codecs.set_topic_codec("alphabase/#", "xml")
+
+@pytest.mark.parametrize("codec, payload, message", [
+    ("msgpack", b"\xc1", "Malformed msgpack"),
+    ("msgpack", msgpack.packb([1, 2]), "must be an object"),
+    ("msgpack", msgpack.packb({"raw": b"\x00"}), "Unsupported value type: bytes"),
+    ("cbor", cbor2.dumps({"nested": {(1, 2): "y"}}), "Unsupported map key type")
+])
+def test_rejected_documents(codec, payload, message):
+    with pytest.raises(ValueError, match=message):
+        PayloadCodecs().decode_document(payload, codec)
+
+def test_set_accepts_binary_bodies(client, headers, collection):
+    body = cbor2.dumps({"collection": collection, "key": "k", "value": DOCUMENT})
+    response = client.post("/data/set", content=body, headers={**headers, "Content-Type": "application/cbor"})
+    assert response.status_code == 200, response.text
+    assert client.get(f"/data/get/{collection}/k", headers=headers).json()["data"] == DOCUMENT
+
+    response = client.post("/data/set", content=b"{}", headers={**headers, "Content-Type": "text/plain"})
+    assert response.status_code == 415
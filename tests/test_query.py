@@ -0,0 +1,39 @@
+# test_query.py - /data/query in SQL and in the Python fallback
+import pytest
+
+from conftest import add_document
+
+# A field name with a quote has no JSON path, so it is evaluated in Python
+FALLBACK_FIELD = 'm"x'
+
+@pytest.fixture
+def mixed(db, collection):
+    """The same values under an SQL-addressable field and a fallback-only one"""
+    values = {"int": 10, "small": 3, "text": "abc", "flag": True, "nested": {"a": 1}, "missing": None}
+    for key, value in values.items():
+        document = {} if value is None else {"n": value, FALLBACK_FIELD: value}
+        add_document(db, collection, key, document)
+    return collection
+
+def _query(client, headers, collection: str, **params) -> dict:
+    response = client.get(f"/data/query/{collection}", params={**params, "explain": "true"}, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+@pytest.mark.parametrize("operator", [">", ">=", "<", "<=", "==", "!="])
+@pytest.mark.parametrize("value", ["5", "abc", "true"])
+def test_fallback_agrees_with_sql(client, headers, mixed, operator, value):
+    in_sql = _query(client, headers, mixed, where=f"n{operator}{value}")
+    in_python = _query(client, headers, mixed, where=f"{FALLBACK_FIELD}{operator}{value}")
+    assert in_sql["plan"]["strategy"] == "sql"
+    assert in_python["plan"]["strategy"] == "python"
+    assert sorted(in_python["items"]) == sorted(in_sql["items"])
+
+def test_fallback_orders_mixed_types_like_sql(client, headers, mixed):
+    in_sql = _query(client, headers, mixed, orderBy="n")
+    in_python = _query(client, headers, mixed, orderBy=FALLBACK_FIELD)
+    assert list(in_python["items"]) == list(in_sql["items"])
+    assert list(in_sql["items"])[0] == "missing"
+
+def test_existence_check(client, headers, mixed):
+    assert sorted(_query(client, headers, mixed, where="n")["items"]) == ["flag", "int", "nested", "small", "text"]
@@ -0,0 +1,116 @@
+# test_retention.py - Retention policies on data rows and time-series readings
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+
+import retention
+from models import DataDB, TimeSeriesDB
+from retention import retention_manager
+from timeseries import timeseries_store
+from conftest import add_document
+
+LARGE = "x" * 20000
+
+@pytest.fixture(autouse=True)
+def no_batch_pause(monkeypatch):
+    monkeypatch.setattr(retention_manager, "BATCH_PAUSE", 0)
+
+def _policy(collection: str, **settings) -> dict:
+    policy = {"collection": collection, "max_age_days": None, "raw_max_age_days": None, "max_rows_per_device": None}
+    policy.update(settings)
+    return policy
+
+def _keys(db, collection: str) -> set:
+    db.expire_all()
+    return {row.key for row in db.query(DataDB.key).filter(DataDB.collection == collection)}
+
+def test_age_is_measured_from_the_last_write(db, collection):
+    now = datetime.utcnow()
+    add_document(db, collection, "rewritten", {"n": 1}, created_at=now - timedelta(days=30), updated_at=now)
+    add_document(db, collection, "stale", {"n": 2}, created_at=now - timedelta(days=30),
+                 updated_at=now - timedelta(days=10))
+    add_document(db, collection, "stale_compressed", {"big": LARGE}, updated_at=now - timedelta(days=10))
+
+    assert retention_manager.enforce(_policy(collection, max_age_days=5)) == 2
+    assert _keys(db, collection) == {"rewritten"}
+
+def test_trim_keeps_newest_rows_per_device(db, collection):
+    start = datetime.utcnow() - timedelta(hours=1)
+    for n in range(6):
+        value = {"device_id": "d1", "n": n}
+        if n % 2:
+            # Compressed rows can't be read by json_extract and are trimmed in Python
+            value["big"] = LARGE
+        add_document(db, collection, f"d1-{n}", value, updated_at=start + timedelta(minutes=n))
+    add_document(db, collection, "d2-0", {"device_id": "d2", "big": LARGE}, updated_at=start)
+    add_document(db, collection, "no-device", {"n": 0}, updated_at=start)
+
+    assert retention_manager.enforce(_policy(collection, max_rows_per_device=3)) == 3
+    assert _keys(db, collection) == {"d1-3", "d1-4", "d1-5", "d2-0", "no-device"}
+
+def test_trim_keeps_newest_readings(db):
+    device_id = "retention-device"
+    timeseries_store.append(db, [{"device_id": device_id, "ts": 1700000000000 + n, "payload": {"temperature": n}}
+                                 for n in range(5)])
+    db.commit()
+
+    retention_manager.enforce(_policy(timeseries_store.COLLECTION, max_rows_per_device=2))
+    kept = [row.ts for row in db.query(TimeSeriesDB.ts).filter(TimeSeriesDB.device_id == device_id)]
+    assert kept == [1700000000003, 1700000000004]
+
+def test_trim_counts_documents_and_readings_together(db):
+    collection = timeseries_store.COLLECTION
+    device_id = "retention-mixed"
+    start = datetime(2023, 11, 14, 22, 0)
+    stamp = lambda minutes: int((start - retention_manager.EPOCH + timedelta(minutes=minutes)) / timedelta(milliseconds=1))
+    # Legacy data rows and readings interleave in time: d0 < r1 < d2 < r3 < d4 < r5
+    for n in (0, 2, 4):
+        add_document(db, collection, f"{device_id}-{n}", {"device_id": device_id, "n": n}, owner="mqtt_bridge",
+                     updated_at=start + timedelta(minutes=n))
+    timeseries_store.append(db, [{"device_id": device_id, "ts": stamp(n), "payload": {"temperature": n}}
+                                 for n in (1, 3, 5)])
+    db.commit()
+
+    retention_manager.enforce(_policy(collection, max_rows_per_device=3))
+    assert {key for key in _keys(db, collection) if key.startswith(device_id)} == {f"{device_id}-4"}
+    kept = [row.ts for row in db.query(TimeSeriesDB.ts).filter(TimeSeriesDB.device_id == device_id)]
+    assert kept == [stamp(3), stamp(5)]
+
+def test_policies_need_positive_limits(client, headers, collection):
+    response = client.post(f"/retention/{collection}", json={"max_rows_per_device": 0}, headers=headers)
+    assert response.status_code == 400
+    response = client.post(f"/retention/{collection}", json={"max_age_days": 7}, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["policy"]["max_age_days"] == 7
+    assert client.delete(f"/retention/{collection}", headers=headers).status_code == 200
+
+def test_only_admin_runs_retention(client, headers):
+    assert client.post("/retention/run", headers=headers).status_code == 403
+
+def test_vacuum_is_an_admin_action(client, headers, admin_headers):
+    assert client.post("/retention/vacuum", headers=headers).status_code == 403
+    response = client.post("/retention/vacuum", headers=admin_headers)
+    assert response.status_code == 200
+    # Files created by this server are incremental from the start
+    assert response.json() == {"success": True, "rebuilt": False, "auto_vacuum": "incremental"}
+
+def test_older_files_are_rebuilt_only_on_request(tmp_path, monkeypatch):
+    path = tmp_path / "old.db"
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE t (x)")
+    connection.executemany("INSERT INTO t VALUES (?)", [("x" * 1000,)] * 100)
+    connection.commit()
+    connection.close()
+    monkeypatch.setattr(retention, "engine", create_engine(f"sqlite:///{path}"))
+
+    assert retention_manager.auto_vacuum_mode() == "none"
+    monkeypatch.delenv(retention_manager.VACUUM_ON_START_VARIABLE, raising=False)
+    assert not retention_manager.vacuum_on_start()
+    monkeypatch.setenv(retention_manager.VACUUM_ON_START_VARIABLE, "1")
+    assert retention_manager.vacuum_on_start()
+
+    assert retention_manager.enable_incremental_vacuum()
+    assert retention_manager.auto_vacuum_mode() == "incremental"
+    assert not retention_manager.enable_incremental_vacuum()
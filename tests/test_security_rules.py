@@ -0,0 +1,85 @@
+# test_security_rules.py - Rule compilation, SQL pushdown and decision caching
+import pytest
+
+from models import DataDB
+from security_rules import SecurityRules, CompiledRule, RuleSyntaxError, security_rules
+from conftest import add_document
+
+OWNER_RULE = "resource.owner == auth.uid"
+
+def test_anonymous_user_never_matches_a_null_owner():
+    rule = CompiledRule(OWNER_RULE, 0)
+    assert not rule(None, {"owner": None})
+    assert not rule(None, {})
+    assert not CompiledRule("resource.owner != auth.uid", 0)(None, {"owner": "bob"})
+    assert rule("bob", {"owner": "bob"})
+    # auth itself still compares with null
+    assert CompiledRule("auth == null", 0)(None, None)
+
+def test_anonymous_sql_filter_selects_nothing(db, collection):
+    rules = SecurityRules()
+    rules.set_rule(collection, "read", OWNER_RULE)
+    add_document(db, collection, "orphan", {"n": 1}, owner=None)
+    add_document(db, collection, "mine", {"n": 2}, owner="bob")
+
+    def readable(user):
+        condition = rules.sql_filter(collection, "read", user, DataDB)
+        query = db.query(DataDB.key).filter(DataDB.collection == collection, condition)
+        return {row.key for row in query}
+
+    assert readable(None) == set()
+    assert readable("bob") == {"mine"}
+    assert not rules.validate_read(collection, None, {"owner": None, "id": f"{collection}:orphan"})
+
+@pytest.mark.parametrize("rule", [
+    "resource.owner == auth.uid || resource.id == 'PUBLIC'",
+    "!(resource.owner == 'mqtt_bridge') && auth != null",
+    "resource.owner != null && auth.uid == 'admin'",
+    "!(resource.owner == auth.uid)",
+    "!(resource.owner == 'alice' || resource.owner == null)"
+])
+def test_sql_pushdown_matches_predicate(db, collection, rule):
+    rules = SecurityRules()
+    rules.set_rule(collection, "read", rule.replace("PUBLIC", f"{collection}:public"))
+    owners = {"a": "bob", "b": "mqtt_bridge", "c": None, "public": "alice"}
+    for key, owner in owners.items():
+        add_document(db, collection, key, {"n": 1}, owner=owner)
+
+    for user in (None, "bob", "admin"):
+        condition = rules.sql_filter(collection, "read", user, DataDB)
+        in_sql = {row.key for row in db.query(DataDB.key).filter(DataDB.collection == collection, condition)}
+        in_python = {key for key, owner in owners.items()
+                     if rules.validate_read(collection, user, {"owner": owner, "id": f"{collection}:{key}"})}
+        assert in_sql == in_python, (rule, user)
+
+def test_untranslatable_rules_are_checked_per_row():
+    rules = SecurityRules()
+    rules.set_rule("notes", "read", "resource.data.public == true")
+    assert rules.sql_filter("notes", "read", "bob", DataDB) is None
+    assert rules.needs_row_check("notes", "read")
+    assert not rules.needs_row_check("sensors", "read")
+
+def test_rule_changes_invalidate_cached_decisions():
+    rules = SecurityRules()
+    assert rules.validate_read("devices", "bob")
+    assert not rules.validate_read("devices", None)
+    rules.set_rule("devices", "read", "auth.uid == 'admin'")
+    assert not rules.validate_read("devices", "bob")
+    assert rules.validate_read("devices", "admin")
+
+def test_collection_read_is_open_for_resource_rules():
+    rules = SecurityRules()
+    rules.set_rule("notes", "read", OWNER_RULE)
+    assert rules.validate_collection_read("notes", None)
+    assert not rules.validate_read("unknown", None)
+
+def test_owner_only_collections_are_listed(client, headers, db, collection):
+    security_rules.set_rule(collection, "read", OWNER_RULE)
+    add_document(db, collection, "mine", {"n": 1})
+    response = client.get("/data/collections", headers=headers)
+    assert collection in response.json()["collections"]
+
+@pytest.mark.parametrize("source", ["", "resource.owner ==", "auth.uid = 'x'", "(true", "foo == 1"])
+def test_syntax_errors(source):
+    with pytest.raises(RuleSyntaxError):
+        CompiledRule(source, 0)
@@ -0,0 +1,53 @@
+# test_value_codec.py - Stored value encodings and the legacy row migration
+import math
+
+import pytest
+
+from models import DataDB
+from value_codec import ValueCodec, value_codec
+
+def test_small_values_stay_json_text():
+    columns = ValueCodec().encode({"t": 21.5, "ok": True})
+    assert columns == {"value": '{"t":21.5,"ok":true}', "value_blob": None, "codec": "json"}
+
+def test_large_values_are_compressed():
+    codec = ValueCodec(compress_threshold=100)
+    value = {"samples": [1.5] * 200}
+    columns = codec.encode(value)
+    assert columns["value"] is None and columns["codec"] == codec.compress_codec
+    assert len(columns["value_blob"]) < len(ValueCodec.dumps_bytes(value))
+    assert codec.decode(DataDB(**columns)) == value
+
+def test_binary_codec_round_trip():
+    pytest.importorskip("msgpack")
+    codec = ValueCodec(binary_codec="msgpack")
+    columns = codec.encode({"a": [1, 2], "b": None})
+    assert columns["codec"] == "msgpack" and columns["value"] is None
+    assert codec.decode(DataDB(**columns)) == {"a": [1, 2], "b": None}
+
+def test_unknown_codec_is_an_error():
+    with pytest.raises(ValueError):
+        value_codec.decode(DataDB(value=None, value_blob=b"...", codec="lz4"))
+
+def test_json_outside_orjson_range():
+    # Beyond 64 bits and NaN are written and read by the stdlib fallback
+    assert ValueCodec.loads(ValueCodec.dumps({"n": 2 ** 70})) == {"n": 2 ** 70}
+    assert math.isnan(ValueCodec.loads('{"n": NaN}')["n"])
+
+def test_migrate_re_encodes_legacy_rows(db, collection):
+    rows = {"good": '{"n": 1}', "broken": "{not json", "empty": None}
+    for key, text in rows.items():
+        db.add(DataDB(id=f"{collection}:{key}", collection=collection, key=key, value=text, codec=None))
+    db.commit()
+
+    migrated = 0
+    while True:
+        batch = value_codec.migrate(db, batch_size=2)
+        if not batch:
+            break
+        migrated += batch
+    assert migrated == 3
+
+    stored = {row.key: value_codec.decode(row)
+              for row in db.query(DataDB).filter(DataDB.collection == collection)}
+    assert stored == {"good": {"n": 1}, "broken": "{not json", "empty": None}
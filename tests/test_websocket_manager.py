@@ -0,0 +1,25 @@
+# test_websocket_manager.py - WebSocket fan-out configuration
+import pytest
+
+from websocket_manager import ConnectionManager
+
+def test_settings_come_from_the_environment(monkeypatch):
+    monkeypatch.setenv("ALPHABASE_WS_QUEUE_SIZE", "8")
+    monkeypatch.setenv("ALPHABASE_WS_SLOW_CONSUMER_POLICY", "disconnect")
+    monkeypatch.setenv("ALPHABASE_WS_BATCH_WINDOW_MS", "50")
+    manager = ConnectionManager.from_environment()
+    assert manager.max_queue_size == 8
+    assert manager.slow_consumer_policy == "disconnect"
+    assert manager.batch_window_ms == 50
+    assert manager.max_payload_bytes == ConnectionManager.DEFAULT_MAX_PAYLOAD_BYTES
+
+@pytest.mark.parametrize("variable, value", [
+    ("ALPHABASE_WS_QUEUE_SIZE", "lots"),
+    ("ALPHABASE_WS_QUEUE_SIZE", "0"),
+    ("ALPHABASE_WS_SLOW_CONSUMER_POLICY", "ignore"),
+    ("ALPHABASE_WS_BATCH_WINDOW_MS", "0")
+])
+def test_invalid_settings_are_rejected(monkeypatch, variable, value):
+    monkeypatch.setenv(variable, value)
+    with pytest.raises(ValueError):
+        ConnectionManager.from_environment()
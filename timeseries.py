@@ -0,0 +1,130 @@
+# timeseries.py
+import threading
+from typing import List, Dict, Any, Optional
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from models import TimeSeriesDB
+from value_codec import value_codec
+
+class TimeSeriesStore:
+    """Append-only storage for sensor readings, clustered by (device_id, ts)"""
+    
+    COLLECTION = "sensors"
+    
+    # Payload fields stored in typed columns (the rest stays in payload)
+    NUMERIC_FIELDS = TimeSeriesDB.typed_fields
+    
+    # Compatibility view so /data/* reads of "sensors" see both storage engines.
+    # The typed columns let where conditions on them skip json_extract for readings;
+    # SQLite pushes such conditions down into both halves of the UNION ALL.
+    VIEW_SQL = """
+        CREATE VIEW IF NOT EXISTS sensors_view AS
+        SELECT id, collection, "key", value, value_blob, codec, owner, created_at,
+               {data_columns}
+        FROM data WHERE collection = 'sensors'
+        UNION ALL
+        SELECT 'sensors:' || device_id || '_' || ts, 'sensors', device_id || '_' || ts,
+               payload, NULL, 'json', 'mqtt_bridge',
+               strftime('%Y-%m-%d %H:%M:%S', ts / 1000, 'unixepoch') || '.' || printf('%06d', (ts % 1000) * 1000),
+               {reading_columns}
+        FROM timeseries
+    """.format(
+        data_columns=", ".join(f"json_extract(value, '$.{field}') AS {field}" for field in NUMERIC_FIELDS),
+        reading_columns=", ".join(NUMERIC_FIELDS)
+    )
+    
+    def __init__(self):
+        # Newest timestamp per device; seeded from the table the first time a
+        # device is seen, so a restart doesn't let new readings overwrite stored ones
+        self._last_ts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    def ensure_schema(self, db: Session):
+        """Create the compatibility view, replacing one from an older schema"""
+        columns = [row[1] for row in db.connection().exec_driver_sql("PRAGMA table_info(sensors_view)")]
+        if columns and not set(self.NUMERIC_FIELDS) <= set(columns):
+            db.connection().exec_driver_sql("DROP VIEW sensors_view")
+        db.connection().exec_driver_sql(self.VIEW_SQL)
+        db.commit()
+    
+    @staticmethod
+    def parse_key(key: str) -> Optional[tuple]:
+        """Split a '{device_id}_{ts}' key into its parts"""
+        device_id, _, ts = key.rpartition("_")
+        if not device_id or not ts.isdigit():
+            return None
+        return device_id, int(ts)
+    
+    @staticmethod
+    def key_for(device_id: str, ts: int) -> str:
+        """Key of a reading in the sensors collection"""
+        return f"{device_id}_{ts}"
+    
+    def append(self, db: Session, readings: List[Dict[str, Any]]) -> List[int]:
+        """Insert readings in one statement (caller commits); returns their final timestamps"""
+        rows = []
+        with self._lock:
+            for reading in readings:
+                device_id = reading["device_id"]
+                ts = reading["ts"]
+                # Readings in the same millisecond get consecutive timestamps
+                # instead of overwriting each other
+                if device_id not in self._last_ts:
+                    self._last_ts[device_id] = self._stored_last_ts(db, device_id)
+                last_ts = self._last_ts[device_id]
+                if last_ts is not None and ts <= last_ts:
+                    ts = last_ts + 1
+                self._last_ts[device_id] = ts
+                rows.append(self._make_row(device_id, ts, reading["payload"]))
+        
+        if not rows:
+            return []
+        
+        stmt = insert(TimeSeriesDB).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[TimeSeriesDB.device_id, TimeSeriesDB.ts],
+            set_={column: getattr(stmt.excluded, column) for column in self.NUMERIC_FIELDS + ("payload",)}
+        )
+        db.execute(stmt)
+        return [row["ts"] for row in rows]
+    
+    @staticmethod
+    def _stored_last_ts(db: Session, device_id: str) -> Optional[int]:
+        # max() over one device is a single seek on the (device_id, ts) primary key
+        return db.query(func.max(TimeSeriesDB.ts)).filter(TimeSeriesDB.device_id == device_id).scalar()
+    
+    def _make_row(self, device_id: str, ts: int, payload: Dict[str, Any]) -> Dict[str, Any]:
+        row = {"device_id": device_id, "ts": ts, "payload": value_codec.dumps(payload)}
+        for field in self.NUMERIC_FIELDS:
+            value = payload.get(field)
+            row[field] = float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+        return row
+    
+    def read_range(self, db: Session, device_id: str, start: int = None, end: int = None,
+                   limit: int = None) -> List[TimeSeriesDB]:
+        """Read a device's readings with start <= ts <= end, oldest first"""
+        query = db.query(TimeSeriesDB).filter(TimeSeriesDB.device_id == device_id)
+        if start is not None:
+            query = query.filter(TimeSeriesDB.ts >= start)
+        if end is not None:
+            query = query.filter(TimeSeriesDB.ts <= end)
+        query = query.order_by(TimeSeriesDB.ts)
+        if limit:
+            query = query.limit(limit)
+        return query.all()
+    
+    def get(self, db: Session, key: str) -> Optional[TimeSeriesDB]:
+        """Look up a reading by its sensors collection key"""
+        parts = self.parse_key(key)
+        if parts is None:
+            return None
+        device_id, ts = parts
+        return db.query(TimeSeriesDB).filter(TimeSeriesDB.device_id == device_id, TimeSeriesDB.ts == ts).first()
+    
+    def has_readings(self, db: Session) -> bool:
+        return db.query(TimeSeriesDB.device_id).first() is not None
+
+# Create global instance
+timeseries_store = TimeSeriesStore()
@@ -0,0 +1,202 @@
+# value_codec.py
+import json
+import threading
+import zlib
+from datetime import datetime, date
+from typing import Dict, Any, Callable, Optional, Tuple
+from sqlalchemy import bindparam, update
+from sqlalchemy.orm import Session
+
+from models import DataDB
+
+# Faster JSON and extra encodings are optional; stdlib json and zlib always work
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class ValueCodec:
+    """Encodes document values for DataDB rows and JSON for responses, using orjson when installed"""
+    
+    # Values whose JSON is larger than this are stored compressed in value_blob
+    DEFAULT_COMPRESS_THRESHOLD = 16 * 1024
+    
+    # Legacy rows re-encoded per migrate() call
+    MIGRATION_BATCH_SIZE = 1000
+    
+    def __init__(self, compress_threshold: Optional[int] = DEFAULT_COMPRESS_THRESHOLD,
+                 compress_codec: str = None, binary_codec: str = None):
+        # Serializers turn a value into bytes; compressors shrink its JSON bytes
+        self.serializers: Dict[str, Tuple[Callable, Callable]] = {}
+        self.compressors: Dict[str, Tuple[Callable, Callable]] = {
+            "zlib": (lambda data: zlib.compress(data, 6), zlib.decompress)
+        }
+        if msgpack is not None:
+            self.serializers["msgpack"] = (msgpack.packb, lambda data: msgpack.unpackb(data, raw=False))
+        if zstandard is not None:
+            self.compressors["zstd"] = (zstandard.ZstdCompressor(level=3).compress,
+                                        lambda data: zstandard.ZstdDecompressor().decompress(data))
+        
+        self.compress_threshold = compress_threshold
+        self.compress_codec = compress_codec or ("zstd" if zstandard is not None else "zlib")
+        # Store every value with a serializer (e.g. "msgpack") instead of JSON text.
+        # Such rows can't be filtered by SQLite JSON1, so /data/query falls back to Python.
+        self.binary_codec = binary_codec
+        
+        self._lock = threading.Lock()
+        self.stats = {
+            "encoded": {},
+            "json_bytes": 0,
+            "stored_bytes": 0,
+            "migrated": 0,
+            "unreadable": 0
+        }
+    
+    def register_serializer(self, name: str, encode: Callable[[Any], bytes], decode: Callable[[bytes], Any]):
+        self.serializers[name] = (encode, decode)
+    
+    def register_compressor(self, name: str, compress: Callable[[bytes], bytes], decompress: Callable[[bytes], bytes]):
+        self.compressors[name] = (compress, decompress)
+    
+    @staticmethod
+    def dumps_bytes(value: Any) -> bytes:
+        """Compact JSON as UTF-8 bytes"""
+        if orjson is not None:
+            try:
+                return orjson.dumps(value)
+            except TypeError:
+                # e.g. integers beyond 64 bits, which stdlib json handles
+                pass
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=_json_default).encode()
+    
+    @classmethod
+    def dumps(cls, value: Any) -> str:
+        """Compact JSON text"""
+        return cls.dumps_bytes(value).decode()
+    
+    @staticmethod
+    def loads(data) -> Any:
+        if orjson is not None:
+            try:
+                return orjson.loads(data)
+            except ValueError:
+                # Legacy text may hold NaN/Infinity, which only stdlib json reads
+                pass
+        return json.loads(data)
+    
+    def encode(self, value: Any) -> Dict[str, Any]:
+        """DataDB column values (value, value_blob, codec) for a document value"""
+        if self.binary_codec:
+            encode, _ = self.serializers[self.binary_codec]
+            blob = encode(value)
+            self._count(self.binary_codec, None, len(blob))
+            return {"value": None, "value_blob": blob, "codec": self.binary_codec}
+        
+        data = self.dumps_bytes(value)
+        if self.compress_threshold is not None and len(data) > self.compress_threshold:
+            compress, _ = self.compressors[self.compress_codec]
+            blob = compress(data)
+            # Incompressible values stay queryable text
+            if len(blob) < len(data):
+                self._count(self.compress_codec, len(data), len(blob))
+                return {"value": None, "value_blob": blob, "codec": self.compress_codec}
+        self._count("json", len(data), len(data))
+        return {"value": data.decode(), "value_blob": None, "codec": "json"}
+    
+    def decode(self, row) -> Any:
+        """Document value of a DataDB (or sensors view / time-series) row"""
+        blob = row.value_blob
+        if blob is None:
+            return self.loads(row.value)
+        codec = row.codec
+        if codec in self.compressors:
+            return self.loads(self.compressors[codec][1](blob))
+        if codec in self.serializers:
+            return self.serializers[codec][1](blob)
+        raise ValueError(f"Unknown value codec: {codec}")
+    
+    @staticmethod
+    def stored_size(row) -> int:
+        return len(row.value_blob if row.value_blob is not None else row.value)
+    
+    @staticmethod
+    def has_binary_rows(db: Session, collection: str) -> bool:
+        """Whether some rows of a collection can't be read by SQLite JSON1 functions"""
+        # Served by the partial index ix_data_binary
+        return db.query(DataDB.id).filter(
+            DataDB.collection == collection, DataDB.value_blob.isnot(None)
+        ).first() is not None
+    
+    def migrate(self, db: Session, batch_size: int = None) -> int:
+        """Re-encode up to batch_size rows written before codecs existed; returns how many"""
+        rows = db.query(DataDB.id, DataDB.value).filter(DataDB.codec.is_(None)).limit(
+            batch_size or self.MIGRATION_BATCH_SIZE
+        ).all()
+        if not rows:
+            return 0
+        
+        params = []
+        unreadable = []
+        for data_id, text in rows:
+            try:
+                value = self.loads(text)
+            except (ValueError, TypeError):
+                # Not JSON (or NULL): keep the raw text as a string value instead of
+                # leaving the row un-migrated, where it would come first in every batch
+                value = text
+                unreadable.append(data_id)
+            columns = self.encode(value)
+            params.append({"row_id": data_id, "old_value": text, "new_value": columns["value"],
+                           "new_blob": columns["value_blob"], "new_codec": columns["codec"]})
+        
+        # A row rewritten since it was read already has a codec and is left alone
+        table = DataDB.__table__
+        stmt = update(table).where(
+            table.c.id == bindparam("row_id"), table.c.codec.is_(None),
+            table.c.value.is_not_distinct_from(bindparam("old_value"))
+        ).values(value=bindparam("new_value"), value_blob=bindparam("new_blob"), codec=bindparam("new_codec"))
+        migrated = db.execute(stmt, params).rowcount
+        db.commit()
+        with self._lock:
+            self.stats["migrated"] += migrated
+            self.stats["unreadable"] += len(unreadable)
+        if unreadable:
+            print(f"⚠️  Stored {len(unreadable)} rows without valid JSON as text: {', '.join(unreadable[:10])}")
+        return migrated
+    
+    def _count(self, codec: str, json_bytes: Optional[int], stored_bytes: int):
+        with self._lock:
+            self.stats["encoded"][codec] = self.stats["encoded"].get(codec, 0) + 1
+            if json_bytes is not None:
+                self.stats["json_bytes"] += json_bytes
+                self.stats["stored_bytes"] += stored_bytes
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats, encoded=dict(self.stats["encoded"]))
+        stats.update({
+            "json_library": "orjson" if orjson is not None else "json",
+            "compress_codec": self.compress_codec,
+            "compress_threshold": self.compress_threshold,
+            "binary_codec": self.binary_codec,
+            "compression_ratio": round(stats["stored_bytes"] / stats["json_bytes"], 3) if stats["json_bytes"] else 1.0
+        })
+        return stats
+
+# Create global instance
+value_codec = ValueCodec()
@@ -8,7 +8,9 @@ const wsManager = {
 
     // Connect to WebSocket
     connect() {
-        const wsURL = 'ws://localhost:8000/ws';
+        // batch=true: the server collects changes for a short window and
+        // sends them as one frame, so we refresh at most once per window
+        const wsURL = 'ws://localhost:8000/ws?batch=true';
 
         console.log('🔌 Connecting to WebSocket...');
         this.ws = new WebSocket(wsURL);
@@ -58,7 +60,15 @@ const wsManager = {
         const { action, collection, key, source } = message;
 
         // Show notification for updates
-        if (action === 'update') {
+        if (action === 'batch') {
+            const collections = Object.keys(message.changes);
+            this.showAlert(
+                'Data Updated',
+                `${message.count} change${message.count === 1 ? '' : 's'} in ${collections.join(', ')}`,
+                'info',
+                3000
+            );
+        } else if (action === 'update') {
             this.showAlert(
                 'Data Updated',
                 `${collection}/${key} was ${source === 'mqtt' ? 'updated via MQTT' : 'updated'}`,
@@ -74,24 +84,58 @@ const wsManager = {
             );
         }
 
-        // Auto-refresh active views
-        if (app.currentView === 'dashboard') {
-            console.log('🔄 Auto-refreshing dashboard...');
-            dashboard.loadDashboard();
+        // Refresh active views with just the changed documents; other
+        // frames (errors, resume acknowledgements...) change no data
+        const changes = this.changesOf(message);
+        if (changes !== undefined) {
+            this.refreshViews(changes);
         }
+    },
 
-        if (app.currentView === 'analytics') {
-            console.log('🔄 Auto-refreshing analytics...');
-            charts.loadAnalytics();
+    // {collection: {key: action}} of a change frame, null if everything may
+    // have changed, undefined for frames that aren't changes
+    changesOf(message) {
+        if (message.action === 'batch') {
+            return message.changes;
         }
+        if (message.action === 'update' || message.action === 'delete') {
+            return { [message.collection]: { [message.key]: message.action } };
+        }
+        if (message.action === 'changes') {
+            // A reset means the server no longer has every change since our cursor
+            if (message.reset) {
+                return null;
+            }
+            const changes = {};
+            message.changes.forEach(change => {
+                changes[change.collection] = changes[change.collection] || {};
+                changes[change.collection][change.key] = change.action;
+            });
+            return changes;
+        }
+        return undefined;
+    },
 
-
-        if (app.currentView === 'collections') {
-            console.log('🔄 Auto-refreshing collections...');
-            dashboard.loadCollectionsView();
+    // Re-render the active view from the snapshot patched with changes
+    async refreshViews(changes) {
+        const view = app.currentView;
+        if (!['dashboard', 'analytics', 'collections'].includes(view)) {
+            return;
         }
 
+        const collections = changes && await api.applyChanges(changes);
+        if (!collections) {
+            // No snapshot to patch yet: load the view in full
+            console.log(`🔄 Auto-refreshing ${view}...`);
+            if (view === 'dashboard') dashboard.loadDashboard();
+            if (view === 'analytics') charts.loadAnalytics();
+            if (view === 'collections') dashboard.loadCollectionsView();
+            return;
+        }
 
+        if (view === 'dashboard') dashboard.renderDashboard(collections);
+        if (view === 'analytics') charts.renderAnalytics(collections);
+        if (view === 'collections') dashboard.renderCollectionsView(collections);
     },
 
     // Update real-time badge status
@@ -1,51 +1,582 @@
 # websocket_manager.py
 from fastapi import WebSocket, WebSocketDisconnect
-import json
-from typing import List
+import asyncio
+import itertools
+import os
+from collections import OrderedDict
+from typing import Dict, List, Set, Tuple, Any, Optional
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+from db_executor import db_executor
+from change_log import change_log
+from security_rules import security_rules
+from value_codec import value_codec
+
+# What a subscription receives with each change, in increasing order of detail:
+#   none  - {action, collection, key, seq} only; the client fetches the document itself
+#   patch - a JSON merge patch (RFC 7386) against the previous value, or the value if there is none
+#   value - the new value
+PAYLOAD_MODES = ("none", "patch", "value")
+
+def merge_patch(old: Any, new: Any) -> Optional[Dict[str, Any]]:
+    """JSON merge patch turning old into new, or None if one can't express it"""
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return None
+    patch = {}
+    for name in old:
+        if name not in new:
+            patch[name] = None
+    for name, value in new.items():
+        if value is None:
+            # null means "remove" in a merge patch
+            return None
+        if name not in old:
+            patch[name] = value
+        elif old[name] != value:
+            nested = merge_patch(old[name], value) if isinstance(value, dict) else None
+            patch[name] = nested if nested is not None else value
+    return patch
+
+class ClientConnection:
+    """One WebSocket client with its own bounded outbound queue and writer task"""
+    
+    def __init__(self, websocket: WebSocket, max_queue_size: int, policy: str, batch_window: float = 0,
+                 username: str = None):
+        self.websocket = websocket
+        # Set when the client connected with a token; needed for payload subscriptions
+        self.username = username
+        self.max_queue_size = max_queue_size
+        self.policy = policy
+        self.pending: "OrderedDict[Any, str]" = OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.writer: Optional[asyncio.Task] = None
+        self.closed = False
+        self.sequence = itertools.count()
+        
+        # Subscriptions and their payload modes; a client that never subscribes receives everything
+        self.subscribed_all = True
+        self.all_payload = "none"
+        self.collections: Dict[str, str] = {}
+        self.keys: Dict[Tuple[str, str], str] = {}
+        self.prefixes: Dict[Tuple[str, str], str] = {}
+        self.max_payload_bytes: Optional[int] = None
+        
+        # Batch mode: changes are collected per window and sent as one frame
+        self.batch_window = batch_window
+        self.batch: Dict[str, "OrderedDict[str, str]"] = {}
+        self.batch_size = 0
+        self.batch_seq: Optional[int] = None
+        self.batch_timer: Optional[asyncio.TimerHandle] = None
+        self.on_slow = None
+        
+        # While a resume replays the change log, live events wait here
+        self.held: Optional[List[Tuple[str, Any, Optional[int]]]] = None
+        
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+    
+    def wants(self, collection: str, key: str) -> bool:
+        """Whether this client's subscriptions cover collection/key"""
+        return (self.subscribed_all or collection in self.collections or (collection, key) in self.keys
+                or any(name == collection and key.startswith(prefix) for name, prefix in self.prefixes))
+    
+    def payload_mode(self, collection: str, key: str) -> str:
+        """Most detailed payload any matching subscription asked for"""
+        modes = [self.all_payload] if self.subscribed_all else []
+        modes.append(self.collections.get(collection, "none"))
+        modes.append(self.keys.get((collection, key), "none"))
+        modes.extend(mode for (name, prefix), mode in self.prefixes.items()
+                     if name == collection and key.startswith(prefix))
+        return max(modes, key=PAYLOAD_MODES.index)
+    
+    def add_to_batch(self, collection: str, key: str, action: str, seq: int = None):
+        """Record a change for the next batch frame; later changes to a key replace earlier ones"""
+        if self.closed:
+            return
+        if seq is not None:
+            self.batch_seq = max(self.batch_seq or 0, seq)
+        changes = self.batch.setdefault(collection, OrderedDict())
+        if key in changes:
+            self.coalesced += 1
+        else:
+            self.batch_size += 1
+        changes[key] = action
+        changes.move_to_end(key)
+        if self.batch_timer is None:
+            self.batch_timer = asyncio.get_running_loop().call_later(self.batch_window, self.flush_batch)
+    
+    def flush_batch(self):
+        """Queue the collected changes as one frame"""
+        self.batch_timer = None
+        if not self.batch or self.closed:
+            return
+        frame = {
+            "action": "batch",
+            "changes": {collection: dict(changes) for collection, changes in self.batch.items()},
+            "count": self.batch_size
+        }
+        seq = self.batch_seq
+        if seq is not None:
+            frame["seq"] = seq
+        self.batch = {}
+        self.batch_size = 0
+        self.batch_seq = None
+        if not self.enqueue(value_codec.dumps(frame), seq=seq) and self.on_slow:
+            self.on_slow(self)
+    
+    def enqueue(self, message: str, coalesce_key: Any = None, seq: int = None) -> bool:
+        """Queue a message without waiting; returns False if the client must be disconnected"""
+        if self.closed:
+            return True
+        if self.held is not None:
+            self.held.append((message, coalesce_key, seq))
+            return True
+        
+        if self.policy == "coalesce" and coalesce_key is not None:
+            # A newer event for the same document replaces the queued one
+            if coalesce_key in self.pending:
+                self.pending[coalesce_key] = message
+                self.pending.move_to_end(coalesce_key)
+                self.coalesced += 1
+                self.wakeup.set()
+                return True
+            queue_key = coalesce_key
+        else:
+            queue_key = next(self.sequence)
+        
+        if len(self.pending) >= self.max_queue_size:
+            if self.policy == "disconnect":
+                return False
+            self.pending.popitem(last=False)
+            self.dropped += 1
+        
+        self.pending[queue_key] = message
+        self.wakeup.set()
+        return True
+    
+    async def run_writer(self, on_error):
+        """Send queued messages in order until the connection closes"""
+        try:
+            while not self.closed:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.pending and not self.closed:
+                    _, message = self.pending.popitem(last=False)
+                    await self.websocket.send_text(message)
+                    self.sent += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"❌ Failed to send to client: {e}")
+            on_error(self)
 
-    async def connect(self, websocket: WebSocket):
+class ConnectionManager:
+    # What happens when a client's queue is full:
+    #   drop_oldest - discard the oldest queued message
+    #   coalesce    - keep only the newest event per (collection, key), then drop oldest
+    #   disconnect  - close the slow client
+    POLICIES = ("drop_oldest", "coalesce", "disconnect")
+    
+    # Change log entries replayed per resume; a client with more to catch up resumes again from lastSeq
+    REPLAY_LIMIT = 1000
+    
+    # Payloads larger than this are sent as notify-only events
+    DEFAULT_MAX_PAYLOAD_BYTES = 16 * 1024
+    
+    # Last published values kept to compute merge patches
+    MAX_TRACKED_VALUES = 10000
+    
+    # Environment variables overriding the defaults of the global instance, with their types
+    ENVIRONMENT = {
+        "max_queue_size": ("ALPHABASE_WS_QUEUE_SIZE", int),
+        "slow_consumer_policy": ("ALPHABASE_WS_SLOW_CONSUMER_POLICY", str),
+        "batch_window_ms": ("ALPHABASE_WS_BATCH_WINDOW_MS", int),
+        "max_payload_bytes": ("ALPHABASE_WS_MAX_PAYLOAD_BYTES", int)
+    }
+    
+    def __init__(self, max_queue_size: int = 256, slow_consumer_policy: str = "coalesce",
+                 batch_window_ms: int = 200, max_payload_bytes: int = DEFAULT_MAX_PAYLOAD_BYTES):
+        if slow_consumer_policy not in self.POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer_policy}")
+        # A zero window would silently turn batching off for clients that asked for it
+        for name, value in (("max_queue_size", max_queue_size), ("batch_window_ms", batch_window_ms)):
+            if value < 1:
+                raise ValueError(f"{name} must be at least 1")
+        self.max_queue_size = max_queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        # Window for clients that connect with /ws?batch=true
+        self.batch_window_ms = batch_window_ms
+        self.max_payload_bytes = max_payload_bytes
+        
+        # (collection, key) -> (seq, value) of the last event published with a value
+        self.last_values: "OrderedDict[Tuple[str, str], Tuple[Optional[int], Any]]" = OrderedDict()
+        
+        self.active_connections: Dict[WebSocket, ClientConnection] = {}
+        
+        # Subscription indexes, so fan-out only touches interested clients
+        self.all_subscribers: Set[ClientConnection] = set()
+        self.collection_subscribers: Dict[str, Set[ClientConnection]] = {}
+        self.key_subscribers: Dict[Tuple[str, str], Set[ClientConnection]] = {}
+        self.prefix_subscribers: Dict[str, Dict[str, Set[ClientConnection]]] = {}
+        
+        self.disconnected_slow = 0
+        self.payloads_sent = 0
+        self.payloads_too_large = 0
+    
+    @classmethod
+    def from_environment(cls) -> "ConnectionManager":
+        """Client queue size, slow consumer policy, batch window and payload limit from ALPHABASE_WS_* variables"""
+        settings = {}
+        for name, (variable, kind) in cls.ENVIRONMENT.items():
+            value = os.environ.get(variable)
+            if value:
+                try:
+                    settings[name] = kind(value)
+                except ValueError:
+                    raise ValueError(f"{variable} must be a number, got {value!r}")
+        return cls(**settings)
+    
+    async def connect(self, websocket: WebSocket, username: str = None) -> ClientConnection:
         await websocket.accept()
-        self.active_connections.append(websocket)
+        batch_window = 0
+        if websocket.query_params.get("batch", "").lower() in ("1", "true"):
+            batch_window = self.batch_window_ms / 1000
+        client = ClientConnection(websocket, self.max_queue_size, self.slow_consumer_policy, batch_window, username)
+        client.on_slow = self._drop_slow_client
+        client.writer = asyncio.create_task(client.run_writer(self._drop_client))
+        self.active_connections[websocket] = client
+        self.all_subscribers.add(client)
         print(f"✅ WebSocket connected. Total: {len(self.active_connections)}")
-
+        return client
+    
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        client = self.active_connections.pop(websocket, None)
+        if client:
+            client.closed = True
+            client.wakeup.set()
+            if client.batch_timer:
+                client.batch_timer.cancel()
+            if client.writer:
+                client.writer.cancel()
+            self._remove_subscriptions(client)
+            self.all_subscribers.discard(client)
             print(f"❌ WebSocket disconnected. Remaining: {len(self.active_connections)}")
-
-    async def broadcast(self, message: str):
-        if not self.active_connections:
+    
+    def _drop_slow_client(self, client: ClientConnection):
+        print("🐢 Disconnecting slow WebSocket client")
+        self.disconnected_slow += 1
+        self._drop_client(client)
+    
+    def _drop_client(self, client: ClientConnection):
+        self.disconnect(client.websocket)
+        asyncio.create_task(self._close(client.websocket))
+    
+    @staticmethod
+    async def _close(websocket: WebSocket):
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+    
+    # -------------------------------------------------------------------------
+    # Subscriptions
+    # -------------------------------------------------------------------------
+    
+    def subscribe(self, client: ClientConnection, collection: str, key: str = None, prefix: str = None,
+                  payload: str = "none"):
+        if client.subscribed_all and collection != "*":
+            # First explicit subscription: stop receiving everything
+            client.subscribed_all = False
+            client.all_payload = "none"
+            self.all_subscribers.discard(client)
+        
+        if collection == "*":
+            client.subscribed_all = True
+            client.all_payload = payload
+            self.all_subscribers.add(client)
+        elif key is not None:
+            client.keys[(collection, key)] = payload
+            self.key_subscribers.setdefault((collection, key), set()).add(client)
+        elif prefix is not None:
+            client.prefixes[(collection, prefix)] = payload
+            self.prefix_subscribers.setdefault(collection, {}).setdefault(prefix, set()).add(client)
+        else:
+            client.collections[collection] = payload
+            self.collection_subscribers.setdefault(collection, set()).add(client)
+    
+    def unsubscribe(self, client: ClientConnection, collection: str, key: str = None, prefix: str = None):
+        if collection == "*":
+            client.subscribed_all = False
+            client.all_payload = "none"
+            self.all_subscribers.discard(client)
+        elif key is not None:
+            client.keys.pop((collection, key), None)
+            self._discard(self.key_subscribers, (collection, key), client)
+        elif prefix is not None:
+            client.prefixes.pop((collection, prefix), None)
+            self._discard(self.prefix_subscribers.get(collection, {}), prefix, client)
+            if not self.prefix_subscribers.get(collection, True):
+                del self.prefix_subscribers[collection]
+        else:
+            client.collections.pop(collection, None)
+            self._discard(self.collection_subscribers, collection, client)
+    
+    def _remove_subscriptions(self, client: ClientConnection):
+        for collection in list(client.collections):
+            self.unsubscribe(client, collection)
+        for collection, key in list(client.keys):
+            self.unsubscribe(client, collection, key=key)
+        for collection, prefix in list(client.prefixes):
+            self.unsubscribe(client, collection, prefix=prefix)
+    
+    @staticmethod
+    def _discard(index: dict, index_key, client: ClientConnection):
+        subscribers = index.get(index_key)
+        if subscribers is not None:
+            subscribers.discard(client)
+            if not subscribers:
+                del index[index_key]
+    
+    def subscribers_for(self, collection: str, key: str = None) -> Set[ClientConnection]:
+        """Clients interested in a change to collection/key"""
+        recipients = set(self.all_subscribers)
+        recipients.update(self.collection_subscribers.get(collection, ()))
+        if key is not None:
+            recipients.update(self.key_subscribers.get((collection, key), ()))
+            for prefix, subscribers in self.prefix_subscribers.get(collection, {}).items():
+                if key.startswith(prefix):
+                    recipients.update(subscribers)
+        return recipients
+    
+    # -------------------------------------------------------------------------
+    # Fan-out
+    # -------------------------------------------------------------------------
+    
+    def publish(self, event: Dict[str, Any], value: Any = None, owner: str = None):
+        """Queue a change event for the clients subscribed to it (never waits on sockets)"""
+        # value and owner describe the document after the change; payload subscriptions
+        # get the value (or a merge patch) if their user may read the document
+        collection = event.get("collection")
+        key = event.get("key")
+        seq = event.get("seq")
+        recipients = self.subscribers_for(collection, key)
+        previous = self.last_values.pop((collection, key), None) if key is not None else None
+        if not recipients:
             return
-            
-        print(f"📢 Broadcasting to {len(self.active_connections)} clients: {message}")
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                print(f"❌ Failed to send to client: {e}")
-                disconnected.append(connection)
-        
-        # Clean up disconnected clients
-        for connection in disconnected:
-            self.active_connections.remove(connection)
-
-    async def websocket_endpoint(self, websocket: WebSocket):
-        await self.connect(websocket)
+        
+        modes = {}
+        for client in recipients:
+            if client.username and not client.batch_window and key is not None and value is not None:
+                modes[client] = client.payload_mode(collection, key)
+        if "patch" in modes.values():
+            # Base for the next patch of this document
+            self.last_values[(collection, key)] = (seq, value)
+            while len(self.last_values) > self.MAX_TRACKED_VALUES:
+                self.last_values.popitem(last=False)
+        
+        messages = {}
+        readable = {}
+        coalesce_key = (collection, key) if key is not None else None
+        for client in recipients:
+            if client.batch_window and key is not None:
+                client.add_to_batch(collection, key, event.get("action", "update"), seq)
+                continue
+            mode = modes.get(client, "none")
+            if mode != "none":
+                if client.username not in readable:
+                    resource_data = {"owner": owner, "id": f"{collection}:{key}"}
+                    readable[client.username] = security_rules.validate_read(collection, client.username, resource_data)
+                if not readable[client.username]:
+                    mode = "none"
+            limit = min(client.max_payload_bytes or self.max_payload_bytes, self.max_payload_bytes)
+            message = self._event_message(messages, event, mode, value, previous, limit)
+            if not client.enqueue(message, coalesce_key, seq):
+                self._drop_slow_client(client)
+    
+    def _event_message(self, messages: Dict[Any, str], event: Dict[str, Any], mode: str, value: Any,
+                       previous: Optional[Tuple[Optional[int], Any]], limit: int) -> str:
+        """Encoded event for one payload mode and size limit, shared by the clients that want the same"""
+        if mode == "none":
+            if "none" not in messages:
+                messages["none"] = value_codec.dumps(event)
+            return messages["none"]
+        
+        if mode not in messages:
+            body = None
+            if mode == "patch" and previous is not None:
+                patch = merge_patch(previous[1], value)
+                if patch is not None:
+                    # Clients apply the patch only to their copy at seq == base
+                    body = value_codec.dumps({**event, "patch": patch, "base": previous[0]})
+            if body is None:
+                body = value_codec.dumps({**event, "value": value})
+            messages[mode] = body
+        
+        body = messages[mode]
+        if len(body) > limit:
+            self.payloads_too_large += 1
+            if "truncated" not in messages:
+                messages["truncated"] = value_codec.dumps({**event, "truncated": True})
+            return messages["truncated"]
+        self.payloads_sent += 1
+        return body
+    
+    def publish_changes(self, changes: List[Dict[str, Any]]):
+        """Queue several changes ({collection, key, action, seq}) as one combined event per client"""
+        frames: Dict[ClientConnection, Dict[str, Dict[str, str]]] = {}
+        seq = max((change["seq"] for change in changes if change.get("seq") is not None), default=None)
+        for change in changes:
+            collection, key, action = change["collection"], change["key"], change["action"]
+            for client in self.subscribers_for(collection, key):
+                if client.batch_window:
+                    client.add_to_batch(collection, key, action, change.get("seq"))
+                else:
+                    frames.setdefault(client, {}).setdefault(collection, {})[key] = action
+        
+        # Same shape as batch-mode frames, filtered to each client's subscriptions
+        for client, grouped in frames.items():
+            frame = {"action": "batch", "changes": grouped, "count": sum(len(keys) for keys in grouped.values())}
+            if seq is not None:
+                frame["seq"] = seq
+            if not client.enqueue(value_codec.dumps(frame), seq=seq):
+                self._drop_slow_client(client)
+    
+    async def resume(self, client: ClientConnection, since: int):
+        """Replay the changes after since that the client subscribes to, then release held live events"""
+        if client.held is not None:
+            return
+        client.held = []
+        try:
+            page = await db_executor.run_session(change_log.since, since, self.REPLAY_LIMIT)
+        except Exception as e:
+            print(f"❌ WebSocket resume failed: {e}")
+            page = None
+        held, client.held = client.held, None
+        
+        if page is None:
+            client.enqueue(value_codec.dumps({"action": "resume_failed", "since": since}))
+        else:
+            changes = [{"seq": change["seq"], "collection": change["collection"], "key": change["key"],
+                        "action": change["action"]}
+                       for change in page["changes"]
+                       if client.wants(change["collection"], change["key"]) and self._can_read(client, change)]
+            client.enqueue(value_codec.dumps({
+                "action": "changes",
+                "since": since,
+                "lastSeq": page["lastSeq"],
+                "hasMore": page["hasMore"],
+                "reset": page["reset"],
+                "changes": changes
+            }))
+        
+        last_seq = page["lastSeq"] if page else None
+        for message, coalesce_key, seq in held:
+            # Events already covered by the replay are not sent twice
+            if seq is not None and last_seq is not None and seq <= last_seq:
+                continue
+            if not client.enqueue(message, coalesce_key, seq):
+                self._drop_slow_client(client)
+                return
+    
+    @staticmethod
+    def _can_read(client: ClientConnection, change: Dict[str, Any]) -> bool:
+        """Read rules for one replayed change, as /data/changes applies them"""
+        collection = change["collection"]
+        if not security_rules.validate_collection_read(collection, client.username):
+            return False
+        resource_data = {"owner": change["owner"], "id": f"{collection}:{change['key']}"}
+        return security_rules.validate_read(collection, client.username, resource_data)
+    
+    async def broadcast(self, message: str):
+        """Queue a raw message for every connected client"""
+        for client in list(self.active_connections.values()):
+            if not client.enqueue(message):
+                self._drop_slow_client(client)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        clients = list(self.active_connections.values())
+        return {
+            "clients": len(clients),
+            "subscribed_all": len(self.all_subscribers),
+            "batched": sum(1 for client in clients if client.batch_window),
+            "batch_window_ms": self.batch_window_ms,
+            "slow_consumer_policy": self.slow_consumer_policy,
+            "max_queue_size": self.max_queue_size,
+            "queued": sum(len(client.pending) for client in clients),
+            "sent": sum(client.sent for client in clients),
+            "dropped": sum(client.dropped for client in clients),
+            "coalesced": sum(client.coalesced for client in clients),
+            "disconnected_slow": self.disconnected_slow,
+            "max_payload_bytes": self.max_payload_bytes,
+            "payloads_sent": self.payloads_sent,
+            "payloads_too_large": self.payloads_too_large,
+            "tracked_values": len(self.last_values)
+        }
+    
+    # -------------------------------------------------------------------------
+    # Endpoint
+    # -------------------------------------------------------------------------
+    
+    async def websocket_endpoint(self, websocket: WebSocket, username: str = None):
+        client = await self.connect(websocket, username)
         print(f"✅ WebSocket connected. Total connections: {len(self.active_connections)}")
         
         try:
             while True:
-                # Keep connection alive
                 data = await websocket.receive_text()
-                print(f"📨 WebSocket message received: {data}")
+                self.handle_client_message(client, data)
         except WebSocketDisconnect:
+            pass
+        finally:
             self.disconnect(websocket)
-            print(f"❌ WebSocket disconnected. Remaining: {len(self.active_connections)}")
+    
+    def handle_client_message(self, client: ClientConnection, data: str):
+        """Handle subscribe/unsubscribe {collection, key?, prefix?, payload?, maxBytes?} and resume {since}"""
+        try:
+            message = value_codec.loads(data)
+        except ValueError:
+            # Plain text keeps the connection alive, as before
+            print(f"📨 WebSocket message received: {data}")
+            return
+        
+        action = message.get("action") if isinstance(message, dict) else None
+        if action == "resume":
+            since = message.get("since")
+            if isinstance(since, int) and not isinstance(since, bool) and since >= 0:
+                asyncio.create_task(self.resume(client, since))
+            else:
+                client.enqueue(value_codec.dumps({"action": "error", "detail": "resume needs a non-negative integer since"}))
+            return
+        
+        collection = message.get("collection") if action else None
+        if action not in ("subscribe", "unsubscribe") or not isinstance(collection, str):
+            print(f"📨 WebSocket message received: {data}")
+            return
+        
+        key = message.get("key")
+        prefix = message.get("prefix")
+        payload = message.get("payload") or "none"
+        if action == "subscribe":
+            if payload not in PAYLOAD_MODES:
+                client.enqueue(value_codec.dumps({"action": "error", "detail": f"Unknown payload mode: {payload}"}))
+                return
+            if payload != "none" and not client.username:
+                client.enqueue(value_codec.dumps({"action": "error", "detail": "Payload subscriptions need /ws?token=..."}))
+                return
+            max_bytes = message.get("maxBytes")
+            if isinstance(max_bytes, int) and not isinstance(max_bytes, bool) and max_bytes > 0:
+                client.max_payload_bytes = max_bytes
+            self.subscribe(client, collection, key, prefix, payload)
+        else:
+            self.unsubscribe(client, collection, key, prefix)
+        
+        client.enqueue(value_codec.dumps({
+            "action": f"{action}d",
+            "collection": collection,
+            "key": key,
+            "prefix": prefix,
+            "payload": payload if action == "subscribe" else None
+        }))
 
 # Create global instance
-manager = ConnectionManager()
\ No newline at end of file
+manager = ConnectionManager.from_environment()
\ No newline at end of file